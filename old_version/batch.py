@@ -0,0 +1,148 @@
+"""
+Пакетная обработка спецификаций без Telegram: каталог или zip-архив с .xls/.xlsx
+разбирается и пересчитывается тем же конвейером, что и в боте
+(_read_excel_to_sheets → _parse_corpus_rows → _recalculate_corpus), по файлу
+на ядро. Строки сводной таблицы дописываются по мере готовности файлов.
+
+    python batch.py ../specifications_examples -o result.csv
+    python batch.py kitchen.zip -o result.xlsx --width 3600
+    python batch.py specs/ -o result.csv --widths widths.csv -j 8
+
+Ширины: --width — для всех файлов, --widths — файл со строками «имя;ширина»
+(имя — путь внутри каталога или архива, имя файла или имя без расширения).
+widths.csv в самом каталоге или архиве подхватывается автоматически, строки
+из --widths важнее. Без ширины файл пересчитывается на свою исходную ширину.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+# main.py при импорте читает окружение и открывает файлы сессий и лога
+_BATCH_TMP = Path(tempfile.gettempdir()) / "wardrobe-batch"
+_BATCH_TMP.mkdir(parents=True, exist_ok=True)
+os.environ.setdefault("BOT_TOKEN", "batch")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("LOG_FILE", str(_BATCH_TMP / "batch.log"))
+os.environ.setdefault("SESSION_DB", str(_BATCH_TMP / "sessions.sqlite3"))
+os.environ.setdefault("SPEC_CACHE_DISK_SIZE", "0")
+# Лимиты бота на архив от пользователя к локальному запуску не относятся
+os.environ.setdefault("BATCH_MAX_FILES", "100000")
+os.environ.setdefault("MAX_UPLOAD_MB", "1024")
+
+import main
+
+
+def _dir_inputs(root: Path) -> Tuple[List[Tuple[str, Union[bytes, str]]], Dict[str, int]]:
+    """Спецификации в каталоге (рекурсивно) — воркеры читают их по пути сами."""
+    specs: List[Tuple[str, Union[bytes, str]]] = []
+    overrides: Dict[str, int] = {}
+    for path in sorted(root.rglob("*")):
+        name = path.relative_to(root).as_posix()
+        if not path.is_file() or path.name.startswith(("~$", ".")):
+            continue
+        if path.name.lower() in main.WIDTHS_FILE_NAMES:
+            overrides.update(main._parse_width_overrides(main._decode_text(path.read_bytes())))
+        elif path.name.lower().endswith(main.SPEC_EXTENSIONS):
+            specs.append((name, str(path)))
+    return specs, overrides
+
+
+def _zip_inputs(archive: zipfile.ZipFile, specs: List[Tuple[str, zipfile.ZipInfo]]) -> Iterator[Tuple[str, bytes]]:
+    """Файлы из архива распаковываются по одному, когда до них доходит очередь."""
+    for name, info in specs:
+        yield name, archive.read(info)
+
+
+def _run(
+    inputs: Iterator[Tuple[str, Union[bytes, str]]],
+    overrides: Dict[str, int],
+    width: Optional[int],
+    writer: main.BatchWriter,
+    jobs: int,
+) -> None:
+    # В работе не больше двух файлов на воркер: содержимое архива не распаковывается в память целиком
+    pending: Set[Future] = set()
+    names: Dict[Future, str] = {}
+
+    def drain(block_until: int) -> None:
+        nonlocal pending
+        while len(pending) > block_until:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = names.pop(future)
+                try:
+                    rows = future.result()
+                except MemoryError:
+                    # _batch_item пробрасывает нехватку памяти, чтобы пул бота пересоздал процесс
+                    rows = [main._batch_error_row(name, "не хватило памяти")]
+                writer.write(rows)
+                head = rows[0]
+                if head["status"] == "error":
+                    print(f"  ✗ {head['file']}: {head['note']}")
+                else:
+                    print(f"  ✓ {head['file']}: {len(rows) - 1} строк, ширина {head['new_width_mm']} мм")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for name, source in inputs:
+            drain(2 * jobs - 1)
+            future = executor.submit(main._batch_item, name, source, main._batch_width(name, overrides, width))
+            names[future] = name
+            pending.add(future)
+        drain(0)
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Пакетный пересчёт спецификаций из каталога или zip-архива")
+    parser.add_argument("path", type=Path, help="каталог или .zip со спецификациями")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="сводная таблица: .csv или .xlsx")
+    parser.add_argument("--width", type=int, help="новая ширина для всех файлов, мм")
+    parser.add_argument("--widths", type=Path, help="файл со строками «имя;ширина»")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="число процессов")
+    args = parser.parse_args()
+
+    fmt = args.output.suffix.lower().lstrip(".")
+    if fmt not in ("csv", "xlsx"):
+        parser.error("--output должен оканчиваться на .csv или .xlsx")
+    if args.width is not None and not main.MIN_WIDTH_MM <= args.width <= main.MAX_WIDTH_MM:
+        parser.error(f"--width должна быть от {main.MIN_WIDTH_MM} до {main.MAX_WIDTH_MM} мм")
+
+    started = time.perf_counter()
+    archive = zipfile.ZipFile(args.path) if args.path.is_file() else None
+    try:
+        if archive is not None:
+            zip_specs, overrides = main._zip_batch_inputs(archive)
+            count, inputs = len(zip_specs), _zip_inputs(archive, zip_specs)
+        else:
+            dir_specs, overrides = _dir_inputs(args.path)
+            count, inputs = len(dir_specs), iter(dir_specs)
+        if args.widths:
+            overrides.update(main._parse_width_overrides(main._decode_text(args.widths.read_bytes())))
+        if not count:
+            print(f"В {args.path} нет файлов .xls или .xlsx")
+            return 1
+
+        print(f"{args.path}: {count} файлов, {args.jobs} процессов → {args.output}")
+        with args.output.open("wb") as out:
+            writer = main.BatchWriter(out, fmt)
+            _run(inputs, overrides, args.width, writer, max(1, args.jobs))
+            writer.close()
+    finally:
+        if archive is not None:
+            archive.close()
+
+    print(
+        f"Готово за {time.perf_counter() - started:.1f} с: "
+        f"{writer.files - writer.failed} из {writer.files} без ошибок"
+    )
+    return 1 if writer.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,390 @@
+"""
+Воспроизводимый бенчмарк конвейера обработки файла — без Telegram.
+
+Прогоняет тот же путь, что handle_document и handle_text: чтение файла, разбор
+(_build_spec), ответ на загрузку, пересчёт на несколько ширин и ответ на
+пересчёт (XLSX и подпись к нему). Файлы — все книги из specifications_examples/ и синтетические книги,
+где строки деталей и фурнитуры размножены в 10×/100×/1000× раз, а к листам
+добавлены копии листа корпуса.
+
+    python bench.py                       # сверить результаты разбора с bench_baseline.json
+    python bench.py --update-baseline     # записать новые результаты разбора
+    python bench.py --save-timings        # сохранить время и память этой машины
+    python bench.py --timings             # сравнить время и память с сохранёнными
+    python bench.py --scales 10,100 --repeat 3
+
+Каждый случай считается в отдельном процессе, чтобы пиковый RSS не копился
+между файлами. Время этапа — лучшее из repeat прогонов после холодного
+(меньше всего зависит от шума машины), выделения памяти — отдельный прогон
+под tracemalloc.
+
+В репозитории лежит только то, что от машины не зависит: число строк и хеш
+разобранной спецификации — их расхождение всегда ошибка. Время и память
+зависят от машины, поэтому их базовые значения пишутся локально
+(data/bench_timings.json, не коммитится) и сравниваются только по --timings.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# main.py при импорте читает окружение и открывает файлы сессий и лога
+_BENCH_TMP = Path(tempfile.gettempdir()) / "wardrobe-bench"
+_BENCH_TMP.mkdir(parents=True, exist_ok=True)
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOG_FILE", str(_BENCH_TMP / "bench.log"))
+os.environ.setdefault("SESSION_DB", str(_BENCH_TMP / "sessions.sqlite3"))
+os.environ.setdefault("SPEC_CACHE_DISK_SIZE", "0")
+
+import openpyxl
+import xlrd
+
+import main
+
+try:
+    import xlwt
+except ImportError:
+    xlwt = None
+
+BASE_DIR = Path(__file__).resolve().parent
+EXAMPLES_DIR = BASE_DIR.parent / "specifications_examples"
+SYNTHETIC_DIR = BASE_DIR / "data" / "bench"
+BASELINE_FILE = BASE_DIR / "bench_baseline.json"
+TIMINGS_FILE = BASE_DIR / "data" / "bench_timings.json"
+# Поля результата, которые не зависят от машины и попадают в bench_baseline.json
+BASELINE_FIELDS = ("file", "corpus_rows", "furniture_items", "spec_sha")
+SYNTHETIC_SOURCE = "2.13 Шкаф 3000х600х2800.xls"
+DEFAULT_SCALES = (10, 100, 1000)
+# Лимит строк листа в формате .xls
+XLS_MAX_ROWS = 65536
+
+
+def _read_grid(path: Path) -> List[Tuple[str, List[List[Any]]]]:
+    """Все листы книги как списки строк значений ("" — пустая ячейка)."""
+    if path.suffix.lower() == ".xls":
+        book = xlrd.open_workbook(str(path))
+        return [(sh.name, [sh.row_values(r) for r in range(sh.nrows)]) for sh in book.sheets()]
+
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        return [
+            (ws.title, [["" if v is None else v for v in row] for row in ws.iter_rows(values_only=True)])
+            for ws in book.worksheets
+        ]
+    finally:
+        book.close()
+
+
+def _row_text(row: List[Any]) -> str:
+    return " ".join(str(v) for v in row).lower()
+
+
+def _detail_block(grid: List[List[Any]], is_header) -> Optional[Tuple[int, int]]:
+    """Строки таблицы под заголовком: от строки после него до первой строки без наименования."""
+    header_r = next((r for r, row in enumerate(grid) if is_header(_row_text(row))), None)
+    if header_r is None:
+        return None
+    header = [str(v).lower() for v in grid[header_r]]
+    name_idx = next((i for i, h in enumerate(header) if "наимен" in h), 0)
+    end = header_r + 1
+    while end < len(grid) and name_idx < len(grid[end]) and str(grid[end][name_idx]).strip():
+        end += 1
+    return header_r + 1, end
+
+
+def _is_corpus_header(text: str) -> bool:
+    return ("тлщн" in text or "толщ" in text) and "длина" in text and "кол" in text
+
+
+def _is_furniture_header(text: str) -> bool:
+    return "код фурнитуры" in text or "наименование фурнитуры" in text
+
+
+def _scale_block(grid: List[List[Any]], is_header, scale: int) -> List[List[Any]]:
+    block = _detail_block(grid, is_header)
+    if block is None:
+        return grid
+    start, end = block
+    return grid[:start] + grid[start:end] * scale + grid[end:]
+
+
+def _synthetic_sheets(source: Path, scale: int) -> List[Tuple[str, List[List[Any]]]]:
+    sheets = _read_grid(source)
+    names = [name for name, _ in sheets]
+    corpus_name = main._find_sheet_by_keywords(names, main.CORPUS_SHEET_KEYWORDS)
+    furniture_name = main._find_sheet_by_keywords(names, main.FURNITURE_SHEET_KEYWORDS)
+
+    result = []
+    for name, grid in sheets:
+        if name == corpus_name:
+            grid = _scale_block(grid, _is_corpus_header, scale)
+        elif name == furniture_name:
+            grid = _scale_block(grid, _is_furniture_header, scale)
+        result.append((name, grid))
+
+    # Лишние листы не должны читаться вовсе — добавляем копии листа корпуса
+    corpus_grid = dict(sheets)[corpus_name]
+    for k in range(1, min(scale // 10, 100) + 1):
+        result.append((f"Копия {k}", corpus_grid))
+    return result
+
+
+def _write_xlsx(path: Path, sheets: List[Tuple[str, List[List[Any]]]]) -> None:
+    book = openpyxl.Workbook(write_only=True)
+    for name, grid in sheets:
+        ws = book.create_sheet(name[:31])
+        for row in grid:
+            ws.append([None if v == "" else v for v in row])
+    book.save(path)
+
+
+def _write_xls(path: Path, sheets: List[Tuple[str, List[List[Any]]]]) -> None:
+    book = xlwt.Workbook(encoding="utf-8")
+    for name, grid in sheets:
+        ws = book.add_sheet(name[:31])
+        for r, row in enumerate(grid):
+            for c, v in enumerate(row):
+                if v != "":
+                    ws.write(r, c, v)
+    book.save(str(path))
+
+
+def _ensure_synthetic(scales: List[int], regenerate: bool) -> List[Path]:
+    """
+    Синтетические книги в data/bench/. .xlsx пишется через openpyxl; .xls —
+    только если установлен xlwt (в зависимостях бота его нет).
+    """
+    source = EXAMPLES_DIR / SYNTHETIC_SOURCE
+    if not source.exists():
+        source = sorted(EXAMPLES_DIR.glob("*.xls"))[0]
+    SYNTHETIC_DIR.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    for scale in scales:
+        sheets = None
+        exts = [".xlsx"] + ([".xls"] if xlwt is not None else [])
+        for ext in exts:
+            path = SYNTHETIC_DIR / f"synthetic_{scale}x{ext}"
+            if regenerate or not path.exists():
+                sheets = sheets or _synthetic_sheets(source, scale)
+                if ext == ".xls":
+                    if max(len(grid) for _, grid in sheets) > XLS_MAX_ROWS:
+                        print(f"  {path.name}: больше {XLS_MAX_ROWS} строк, .xls пропущен")
+                        continue
+                    _write_xls(path, sheets)
+                else:
+                    _write_xlsx(path, sheets)
+                print(f"  сгенерирован {path.name} ({path.stat().st_size // 1024} КБ)")
+            paths.append(path)
+    if xlwt is None:
+        print("  xlwt не установлен — синтетические .xls не создаются, только .xlsx")
+    return paths
+
+
+def _bench_widths(spec: main.ParsedSpec) -> List[int]:
+    widths = [spec.width_total_mm // 2, spec.width_total_mm * 3 // 2, spec.width_total_mm * 2]
+    return [min(max(w, main.MIN_WIDTH_MM), main.MAX_WIDTH_MM) for w in widths]
+
+
+def _pipeline(path: Path) -> main.ParsedSpec:
+    stats = main.STAGE_STATS
+    # Вместо скачивания из Telegram — чтение с диска
+    with stats.stage("download"):
+        file_bytes = path.read_bytes()
+    spec = main._build_spec(file_bytes, path.name)
+    with stats.stage("render"):
+        main._render_upload_message(spec)
+    for width in _bench_widths(spec):
+        with stats.stage("recalc"):
+            result = main._recalculate_corpus(spec, width)
+        sections = main.LAYOUT_TABLE.get(width).sections
+        corpus_parts, weight, cut_warnings, _, furniture_items = result
+        with stats.stage("render"):
+            main._render_recalc_xlsx(spec, width, sections, *result)
+            main._render_recalc_summary(spec, width, sections, corpus_parts, weight, cut_warnings, furniture_items)
+    return spec
+
+
+def _measure(path: Path) -> Tuple[main.ParsedSpec, Dict[str, float], Dict[str, int]]:
+    """Один прогон: суммарное время и наибольший пик памяти по каждому этапу."""
+    with main.STAGE_STATS.capture() as samples:
+        spec = _pipeline(path)
+    seconds: Dict[str, float] = {}
+    memory: Dict[str, int] = {}
+    for stage, sec, peak in samples:
+        seconds[stage] = seconds.get(stage, 0.0) + sec
+        memory[stage] = max(memory.get(stage, 0), peak)
+    return spec, seconds, memory
+
+
+def _run_case(path_str: str, repeat: int) -> Dict[str, Any]:
+    """Выполняется в отдельном процессе."""
+    path = Path(path_str)
+    spec, cold, rss_growth = _measure(path)
+
+    runs = [_measure(path)[1] for _ in range(repeat)]
+
+    tracemalloc.start()
+    try:
+        _, _, allocs = _measure(path)
+    finally:
+        tracemalloc.stop()
+
+    stages = {}
+    for stage in cold:
+        stages[stage] = {
+            "time_ms": round(min(r.get(stage, 0.0) for r in runs) * 1000, 3),
+            "cold_ms": round(cold[stage] * 1000, 3),
+            "alloc_peak_bytes": allocs.get(stage, 0),
+            "rss_growth_bytes": rss_growth[stage],
+        }
+    return {
+        "file": path.name,
+        "size_bytes": path.stat().st_size,
+        "corpus_rows": len(spec.corpus_rows),
+        "furniture_items": len(spec.furniture_items),
+        "spec_sha": hashlib.sha256(main._pack_spec(spec)).hexdigest(),
+        "total_ms": round(sum(s["time_ms"] for s in stages.values()), 3),
+        "peak_rss_bytes": main._max_rss_bytes(),
+        "stages": stages,
+    }
+
+
+def _case_name(path: Path) -> str:
+    return ("synthetic/" if path.parent == SYNTHETIC_DIR else "examples/") + path.name
+
+
+def _baseline_of(results: Dict[str, Any]) -> Dict[str, Any]:
+    return {case: {k: res[k] for k in BASELINE_FIELDS} for case, res in results.items()}
+
+
+def _compare_specs(baseline: Dict[str, Any], results: Dict[str, Any]) -> List[str]:
+    """Расхождения результата разбора с bench_baseline.json."""
+    problems = []
+    for case, res in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        for key in BASELINE_FIELDS:
+            if base.get(key) != res[key]:
+                problems.append(f"{case}: изменилось {key} ({base.get(key)} → {res[key]})")
+    return problems
+
+
+def _compare_timings(
+    baseline: Dict[str, Any], results: Dict[str, Any], tolerance: float, min_delta_ms: float, min_delta_bytes: int
+) -> List[str]:
+    """Регрессии: этап медленнее или прожорливее сохранённого на этой машине сверх допуска."""
+    problems = []
+    for case, res in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        for stage, st in res["stages"].items():
+            bst = base["stages"].get(stage)
+            if bst is None:
+                continue
+            if st["time_ms"] > bst["time_ms"] * (1 + tolerance) and st["time_ms"] - bst["time_ms"] > min_delta_ms:
+                problems.append(f"{case} [{stage}]: время {bst['time_ms']:.1f} → {st['time_ms']:.1f} мс")
+            if (
+                st["alloc_peak_bytes"] > bst["alloc_peak_bytes"] * (1 + tolerance)
+                and st["alloc_peak_bytes"] - bst["alloc_peak_bytes"] > min_delta_bytes
+            ):
+                problems.append(
+                    f"{case} [{stage}]: память {bst['alloc_peak_bytes'] // 1024} → {st['alloc_peak_bytes'] // 1024} КБ"
+                )
+    return problems
+
+
+def _write_json(path: Path, data: Dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора и пересчёта спецификаций")
+    parser.add_argument("--scales", default=",".join(str(s) for s in DEFAULT_SCALES),
+                        help="множители синтетических книг через запятую, пусто — без синтетики")
+    parser.add_argument("--repeat", type=int, default=5, help="число замеряемых прогонов на случай")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true", help="записать результаты разбора как базовые")
+    parser.add_argument("--timings", action="store_true", help="сравнить время и память с сохранёнными локально")
+    parser.add_argument("--save-timings", action="store_true", help="сохранить время и память как локальную базу")
+    parser.add_argument("--timings-file", type=Path, default=TIMINGS_FILE)
+    parser.add_argument("--regenerate", action="store_true", help="пересоздать синтетические книги")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимый относительный рост")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="рост времени меньше этого не считается")
+    parser.add_argument("--min-delta-kb", type=int, default=256, help="рост памяти меньше этого не считается")
+    parser.add_argument("--output", type=Path, help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    paths = sorted(EXAMPLES_DIR.glob("*.xls*"))
+    if scales:
+        print("Синтетические книги:")
+        paths += _ensure_synthetic(scales, args.regenerate)
+
+    results: Dict[str, Any] = {}
+    ctx = multiprocessing.get_context("spawn")
+    for path in paths:
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            res = executor.submit(_run_case, str(path), args.repeat).result()
+        case = _case_name(path)
+        results[case] = res
+        print(
+            f"{case}: {res['corpus_rows']} дет., {res['furniture_items']} фурн., "
+            f"{res['total_ms']:.1f} мс, RSS {res['peak_rss_bytes'] / 1048576:.0f} МБ "
+            f"({time.perf_counter() - started:.1f} с)"
+        )
+        for stage, st in res["stages"].items():
+            print(
+                f"    {stage:16} {st['time_ms']:9.2f} мс (холодный {st['cold_ms']:.2f})"
+                f"  выдел. {st['alloc_peak_bytes'] / 1024:9.0f} КБ  RSS +{st['rss_growth_bytes'] / 1024:.0f} КБ"
+            )
+
+    if args.output:
+        _write_json(args.output, results)
+
+    if args.save_timings:
+        _write_json(args.timings_file, results)
+        print(f"Время и память записаны в {args.timings_file}")
+
+    if args.update_baseline:
+        _write_json(args.baseline, _baseline_of(results))
+        print(f"Базовые результаты разбора записаны в {args.baseline}")
+        return 0
+
+    problems = []
+    if args.baseline.exists():
+        problems += _compare_specs(json.loads(args.baseline.read_text(encoding="utf-8")), results)
+    else:
+        print(f"Нет {args.baseline.name} — запусти с --update-baseline, чтобы сохранить результаты разбора")
+
+    if args.timings and not args.save_timings:
+        if args.timings_file.exists():
+            timings = json.loads(args.timings_file.read_text(encoding="utf-8"))
+            problems += _compare_timings(timings, results, args.tolerance, args.min_delta_ms, args.min_delta_kb * 1024)
+        else:
+            print(f"Нет {args.timings_file} — сначала запусти с --save-timings на этой машине")
+
+    if problems:
+        print("\nРЕГРЕССИИ:")
+        for p in problems:
+            print(f"  ✗ {p}")
+        return 1
+    print("\nРегрессий нет")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,24 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import copy
+import csv
+import hashlib
+import hmac
+import importlib
 import io
+import json
 import math
+import multiprocessing
 import os
+import queue
 import re
 import logging
-from dataclasses import dataclass, field
+import signal
+import tempfile
+import sqlite3
+import threading
+import time
+import tracemalloc
+import zipfile
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, replace
+from enum import IntFlag
+from functools import lru_cache, partial
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Dict, Optional, List, Tuple
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Iterable, Iterator, Optional, List, Set, Tuple, Union
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-import pandas as pd
 from dotenv import load_dotenv
 
 from telegram import Update, Document
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 
+# Отсчёт времени запуска: всё выше — стандартная библиотека и telegram
+_STARTED_AT = time.perf_counter()
+
+
+class _LazyModule:
+    """
+    Заглушка модуля, который импортируется при первом обращении к атрибуту.
+    После импорта глобальное имя (np, pd, ...) заменяется настоящим модулем,
+    так что дальше обращения идут напрямую, без посредника.
+    """
+
+    def __init__(self, name: str, alias: str) -> None:
+        self._name = name
+        self._alias = alias
+        self._module = None
+
+    def _load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            globals()[self._alias] = self._module
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+
+# pandas вместе с numpy и движки Excel нужны только для разбора и пересчёта:
+# бот отвечает на /start сразу после запуска, не дожидаясь их импорта
+np = _LazyModule("numpy", "np")
+pd = _LazyModule("pandas", "pd")
+xlrd = _LazyModule("xlrd", "xlrd")
+openpyxl = _LazyModule("openpyxl", "openpyxl")
+_LAZY_MODULES = [np, pd, xlrd, openpyxl]
+
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -26,34 +92,347 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_FILE_ENV = os.getenv("LOG_FILE", "bot.log")
 LOG_FILE = Path(LOG_FILE_ENV) if os.path.isabs(LOG_FILE_ENV) else BASE_DIR / LOG_FILE_ENV
 LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format="%(asctime)s %(levelname)s %(message)s",
-    handlers=[
+# json — одна JSON-строка на запись, text — прежний формат
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Построчные сообщения разбора: сколько пропускать с одного места вызова за окно, дальше — каждое N-е
+LOG_ROW_BURST = int(os.getenv("LOG_ROW_BURST", "20"))
+LOG_ROW_EVERY = int(os.getenv("LOG_ROW_EVERY", "500"))
+LOG_ROW_WINDOW_S = float(os.getenv("LOG_ROW_WINDOW_S", "10"))
+
+# Стандартные атрибуты LogRecord; всё прочее пришло через extra= и попадает в JSON отдельными полями
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Структурированная запись: время, уровень, место вызова, сообщение и поля из extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "where": f"{record.module}:{record.lineno}",
+            "process": record.process,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _LogQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь с уже подставленными аргументами и текстом исключения,
+    а форматирование и запись на диск делает поток QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RowLogSampler(logging.Filter):
+    """
+    Прореживает построчные сообщения (logger.*(..., extra=_PER_ROW)): с одного
+    места вызова за окно window_s проходят первые burst записей, затем каждая
+    every-я. Первая запись следующего окна сообщает, сколько было пропущено.
+    """
+
+    def __init__(self, burst: int, every: int, window_s: float) -> None:
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        self.window_s = window_s
+        self._state: Dict[Tuple[str, int], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "per_row", False):
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or record.created - state[0] >= self.window_s:
+                suppressed = int(state[2]) if state else 0
+                state = self._state[key] = [record.created, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} (ещё {suppressed} похожих сообщений пропущено)"
+            state[1] += 1
+            seen = state[1]
+            if seen <= self.burst or (self.every > 0 and (seen - self.burst) % self.every == 0):
+                return True
+            state[2] += 1
+            return False
+
+
+_PER_ROW = {"per_row": True}
+
+
+def _setup_logging() -> Tuple[_LogQueueHandler, QueueListener]:
+    """Логгеры пишут только в очередь; консоль и файл обслуживает фоновый поток."""
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    handlers: List[logging.Handler] = [
         logging.StreamHandler(),
         logging.FileHandler(LOG_FILE, encoding="utf-8", mode="a"),
-    ],
-)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = _LogQueueHandler(queue.SimpleQueue())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
+def _restart_log_listener() -> None:
+    # Поток записи не переживает fork: процессу пула разбора нужны своя очередь и свой поток
+    global _LOG_LISTENER
+    _LOG_QUEUE_HANDLER.queue = queue.SimpleQueue()
+    _LOG_LISTENER = QueueListener(_LOG_QUEUE_HANDLER.queue, *_LOG_LISTENER.handlers, respect_handler_level=True)
+    _LOG_LISTENER.start()
+
+
+def _stop_log_listener() -> None:
+    _LOG_LISTENER.stop()
+
+
+_LOG_QUEUE_HANDLER, _LOG_LISTENER = _setup_logging()
+os.register_at_fork(after_in_child=_restart_log_listener)
+atexit.register(_stop_log_listener)
+
 logger = logging.getLogger("wardrobe-bot")
+logger.addFilter(RowLogSampler(LOG_ROW_BURST, LOG_ROW_EVERY, LOG_ROW_WINDOW_S))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is missing in .env")
 
+# Кэш разобранных спецификаций
+SPEC_CACHE_SIZE = int(os.getenv("SPEC_CACHE_SIZE", "64"))
+SPEC_CACHE_DISK_SIZE = int(os.getenv("SPEC_CACHE_DISK_SIZE", "1000"))
+SPEC_CACHE_DIR_ENV = os.getenv("SPEC_CACHE_DIR", "data/spec_cache")
+SPEC_CACHE_DIR = Path(SPEC_CACHE_DIR_ENV) if os.path.isabs(SPEC_CACHE_DIR_ENV) else BASE_DIR / SPEC_CACHE_DIR_ENV
+# Увеличивать при изменении логики парсинга, чтобы не отдавать устаревшие записи с диска
+SPEC_CACHE_VERSION = 4
+
+# Сессии пользователей: SQLite-файл переживает перезапуск и может быть общим для нескольких процессов
+SESSION_DB_ENV = os.getenv("SESSION_DB", "data/sessions.sqlite3")
+SESSION_DB = Path(SESSION_DB_ENV) if os.path.isabs(SESSION_DB_ENV) else BASE_DIR / SESSION_DB_ENV
+SESSION_MEMORY_SIZE = int(os.getenv("SESSION_MEMORY_SIZE", "200"))
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", str(7 * 24 * 3600)))
+# Память пересчётов: сколько сессий и сколько последних ширин в каждой держать готовыми
+RECALC_MEMO_SESSIONS = int(os.getenv("RECALC_MEMO_SESSIONS", str(SESSION_MEMORY_SIZE)))
+RECALC_MEMO_WIDTHS = int(os.getenv("RECALC_MEMO_WIDTHS", "8"))
+
+# Пулы для CPU-задач: разбор файлов и пересчёт не выполняются в цикле событий.
+# sandbox — заранее запущенные процессы с лимитами памяти и CPU (только там, где есть resource)
+PARSE_POOL_KIND = os.getenv("PARSE_POOL_KIND", "sandbox" if resource is not None else "process").lower()
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", "10"))
+PARSE_TIMEOUT_S = float(os.getenv("PARSE_TIMEOUT_S", "60"))
+RECALC_POOL_KIND = os.getenv("RECALC_POOL_KIND", "thread").lower()
+RECALC_WORKERS = int(os.getenv("RECALC_WORKERS", "4"))
+RECALC_QUEUE_SIZE = int(os.getenv("RECALC_QUEUE_SIZE", "50"))
+RECALC_TIMEOUT_S = float(os.getenv("RECALC_TIMEOUT_S", "20"))
+# Песочница пула разбора: сколько памяти задача может добавить к процессу (RLIMIT_AS), сколько
+# секунд CPU потратить (RLIMIT_CPU); процесс пересоздаётся после SANDBOX_MAX_JOBS задач или
+# когда его пиковый RSS превысил SANDBOX_MAX_RSS_MB. Время на задачу — таймаут пула
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "1024"))
+SANDBOX_CPU_S = int(os.getenv("SANDBOX_CPU_S", str(int(PARSE_TIMEOUT_S))))
+SANDBOX_MAX_JOBS = int(os.getenv("SANDBOX_MAX_JOBS", "200"))
+SANDBOX_MAX_RSS_MB = int(os.getenv("SANDBOX_MAX_RSS_MB", "768"))
+
+# Загрузки: файлы больше MAX_UPLOAD_MB не скачиваются (Bot API и сам не отдаёт больше 20 МБ),
+# крупнее UPLOAD_SPOOL_KB пишутся во временный файл, а не держатся в памяти
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+UPLOAD_SPOOL_BYTES = int(float(os.getenv("UPLOAD_SPOOL_KB", "1024")) * 1024)
+# Наибольшее число спецификаций в одном zip-архиве
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "100"))
+
+# Чтение листов: direct — ячейки напрямую из xlrd/openpyxl, pandas — через read_excel (прежний путь)
+EXCEL_READER = os.getenv("EXCEL_READER", "direct").lower()
+
 # Constraints
 MAX_SECTION_WIDTH = 1200
 MAX_SHELF_SPAN = 800
 MAX_FACADE_WIDTH = 600
 PARTITION_THRESHOLD = 800
-
-# Плотность по умолчанию (кг/м³)
-MATERIAL_DENSITY = 720
+# Допустимый диапазон новой ширины шкафа
+MIN_WIDTH_MM = 300
+MAX_WIDTH_MM = 10000
+
+# Наибольшее число ширин в одном /sweep
+SWEEP_MAX_WIDTHS = int(os.getenv("SWEEP_MAX_WIDTHS", "500"))
+
+# Метрики этапов: размер кольцевого буфера, точный учёт памяти через tracemalloc
+# (заметно замедляет разбор), порт для Prometheus (0 — не поднимать)
+STATS_WINDOW = int(os.getenv("STATS_WINDOW", "1024"))
+STATS_TRACE_MEMORY = os.getenv("STATS_TRACE_MEMORY", "0") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Фоновый прогрев (импорт pandas, таблица раскладок, процессы пула) вскоре после старта
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+WARM_UP_DELAY_S = float(os.getenv("WARM_UP_DELAY_S", "1"))
+# Приём обновлений: без WEBHOOK_URL — long polling, с ним — вебхук на встроенном HTTP-сервере.
+# WEBHOOK_URL — внешний адрес без пути (https://bot.example.com), WEBHOOK_PATH добавляется к нему.
+# По умолчанию сервер слушает только localhost (за обратным прокси); в контейнере или без
+# прокси — WEBHOOK_LISTEN=0.0.0.0. WEBHOOK_SECRET обязателен: без него любой, кто знает адрес,
+# мог бы присылать поддельные обновления
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET не задан: режим вебхука без секретного токена не запускается")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# 0 — не вызывать setWebhook при старте (реплики за балансировщиком, вебхук ставит одна из них)
+WEBHOOK_SET_ON_START = os.getenv("WEBHOOK_SET_ON_START", "1") == "1"
+# Обновления делятся на полосы со своим числом одновременных обработчиков, чтобы поток тяжёлых
+# файлов не задерживал пересчёт ширин и команды. command — /start, /help и другие команды,
+# recalc — ширины, heavy — файлы, архивы и /sweep. Обновления одного пользователя — всегда по очереди
+LANE_COMMAND_CONCURRENCY = int(os.getenv("LANE_COMMAND_CONCURRENCY", "8"))
+LANE_RECALC_CONCURRENCY = int(os.getenv("LANE_RECALC_CONCURRENCY", str(RECALC_WORKERS * 2)))
+LANE_HEAVY_CONCURRENCY = int(os.getenv("LANE_HEAVY_CONCURRENCY", str(PARSE_WORKERS * 2)))
+# Сколько обновлений принимается одновременно вместе с ждущими в очередях полос
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+# Новая ширина или новый файл отменяют незаконченные пересчёты (и разборы) того же пользователя
+UPDATE_SUPERSEDE = os.getenv("UPDATE_SUPERSEDE", "1") == "1"
+# Адрес Bot API — для локальной проверки против заглушки (stub_telegram.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+# Telegram user_id через запятую, кому доступен /stats
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x}
+
+# Плотность по умолчанию (кг/м³)
+MATERIAL_DENSITY = 720
 # Добавляем русскую х и звездочку
 SIZE_RE = re.compile(r"(\d+)\s*[xх×*]\s*(\d+)", re.IGNORECASE)
 ГАБАРИТ_RE = re.compile(r"(\d{3,4})\s*[xх×*]\s*(\d+)\s*[xх×*]\s*(\d+)", re.IGNORECASE)
 
+# Ключевые слова для выбора листов книги
+CORPUS_SHEET_KEYWORDS = ["плит", "матер", "корпус", "детал", "дсп"]
+FURNITURE_SHEET_KEYWORDS = ["фурнит", "комплект", "метиз"]
 
-@dataclass
+
+class PartRole(IntFlag):
+    """
+    Роль корпусной детали по названию. Флаги, а не одно значение: «задняя стенка»
+    одновременно BACK и WALL, а «крышка/дно/полки» — SHELF и TOP_BOTTOM; пересчёт
+    проверяет флаги в своём порядке приоритета.
+    """
+
+    SHELF = 1 << 0
+    FACADE = 1 << 1
+    BACK = 1 << 2
+    TOP_BOTTOM = 1 << 3
+    SIDE = 1 << 4
+    MIDDLE = 1 << 5
+    PARTITION = 1 << 6
+    WALL = 1 << 7
+    PLINTH = 1 << 8
+    POST = 1 << 9
+    VISIBLE = 1 << 10
+    ROD = 1 << 11
+    DRAWER = 1 << 12
+
+
+class FurnitureRole(IntFlag):
+    """Роль позиции фурнитуры по названию (флаги, как у PartRole)."""
+
+    HINGE = 1 << 0
+    HANDLE = 1 << 1
+    SHELF_SUPPORT = 1 << 2
+    SECTION_TIE = 1 << 3
+    FACADE_CORRECTOR = 1 << 4
+    SCREW = 1 << 5
+    ROD = 1 << 6
+    LED = 1 << 7
+    LIGHT = 1 << 8
+
+
+class _RoleMatcher:
+    """
+    Все ключевые слова в одном скомпилированном регулярном выражении.
+    Поиск идёт опережающей проверкой с каждой позиции, поэтому находятся и
+    перекрывающиеся слова; слово несёт также флаги входящих в него слов
+    («подсветк» ⊃ «подсвет»), так что одно прохождение строки даёт все флаги.
+    """
+
+    def __init__(self, keywords: Dict[str, IntFlag], empty: IntFlag) -> None:
+        self._empty = empty
+        self._flags = {
+            kw: empty.__class__(sum({flag for other, flag in keywords.items() if other in kw}))
+            for kw in keywords
+        }
+        alternatives = "|".join(re.escape(kw) for kw in sorted(keywords, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternatives}))")
+
+    def classify(self, name: Optional[str]) -> IntFlag:
+        role = self._empty
+        if not name:
+            return role
+        for m in self._pattern.finditer(name.lower()):
+            role |= self._flags[m.group(1)]
+        return role
+
+
+PART_ROLE_MATCHER = _RoleMatcher(
+    {
+        "полк": PartRole.SHELF,
+        "фасад": PartRole.FACADE,
+        "задн": PartRole.BACK,
+        "крышк": PartRole.TOP_BOTTOM,
+        "дно": PartRole.TOP_BOTTOM,
+        "боков": PartRole.SIDE,
+        "средние": PartRole.MIDDLE,
+        "перегород": PartRole.PARTITION,
+        "стенк": PartRole.WALL,
+        "цоколь": PartRole.PLINTH,
+        "стойк": PartRole.POST,
+        "видим": PartRole.VISIBLE,
+        "наружн": PartRole.VISIBLE,
+        "внешн": PartRole.VISIBLE,
+        "штанг": PartRole.ROD,
+        "ящик": PartRole.DRAWER,
+    },
+    PartRole(0),
+)
+
+FURNITURE_ROLE_MATCHER = _RoleMatcher(
+    {
+        "петл": FurnitureRole.HINGE,
+        "чашк": FurnitureRole.HINGE,
+        "ручк": FurnitureRole.HANDLE,
+        "полкодерж": FurnitureRole.SHELF_SUPPORT,
+        "стяжка межсекцион": FurnitureRole.SECTION_TIE,
+        "корректор фасада": FurnitureRole.FACADE_CORRECTOR,
+        "винт": FurnitureRole.SCREW,
+        "ключ": FurnitureRole.SCREW,
+        "штанг": FurnitureRole.ROD,
+        "подсветк": FurnitureRole.LED,
+        "led": FurnitureRole.LED | FurnitureRole.LIGHT,
+        "освещен": FurnitureRole.LED,
+        "подсвет": FurnitureRole.LIGHT,
+        "освещ": FurnitureRole.LIGHT,
+    },
+    FurnitureRole(0),
+)
+
+
+@dataclass(slots=True)
 class ParsedRow:
     name: str
     thickness_mm: Optional[int] = None
@@ -61,32 +440,1217 @@ class ParsedRow:
     width_mm: Optional[int] = None
     qty: Optional[float] = None
     material: Optional[str] = None
+    role: Optional[PartRole] = None
+    # Номер строки в CorpusTable; -1 — строка ещё не в таблице
+    index: int = field(default=-1, compare=False, repr=False)
 
+    def __post_init__(self) -> None:
+        # Роль определяется один раз при разборе; из кэша приходит числом
+        if self.role is None:
+            self.role = PART_ROLE_MATCHER.classify(self.name)
+        elif not isinstance(self.role, PartRole):
+            self.role = PartRole(self.role)
 
-@dataclass
+
+@dataclass(slots=True)
 class FurnitureItem:
     name: str
     code: Optional[str] = None
     qty: Optional[float] = None
     unit: Optional[str] = None
+    role: Optional[FurnitureRole] = None
+    index: int = field(default=-1, compare=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.role is None:
+            self.role = FURNITURE_ROLE_MATCHER.classify(self.name)
+        elif not isinstance(self.role, FurnitureRole):
+            self.role = FurnitureRole(self.role)
+
+
+_MISSING_INT = -(2 ** 63)
+
+
+class _RowTable:
+    """
+    Строки спецификации столбцами. Целые поля, коды повторяющихся строк и роли
+    лежат в одной матрице int64 (строка таблицы × поле, _MISSING_INT или -1
+    вместо None), количество — в массиве float64 (NaN вместо None). Строки,
+    которые у каждой детали свои (название, артикул), хранятся кортежами, а
+    повторяющиеся (материал, единица) — один раз в словаре, в матрице — их
+    номера. Одна матрица вместо десятков объектов на строку: меньше памяти
+    в сессиях и быстрее pickle между процессами.
+
+    Снаружи таблица — последовательность строк ROW: итерация и индекс
+    собирают их по требованию, row.index — номер строки в таблице. Таблица
+    не меняется; изменённые данные — новая таблица из from_rows().
+    """
+
+    ROW: Any = None
+    ROLE: Any = None
+    TEXT: Tuple[str, ...] = ()
+    INT: Tuple[str, ...] = ()
+    CODED: Tuple[str, ...] = ()
+    FLOAT: Tuple[str, ...] = ()
+
+    __slots__ = ("_size", "_text", "_pools", "_ints", "_floats")
+
+    def __init__(self) -> None:
+        self._size = 0
+        self._text: Dict[str, Tuple[Optional[str], ...]] = {name: () for name in self.TEXT}
+        self._pools: Dict[str, Tuple[str, ...]] = {name: () for name in self.CODED}
+        self._ints: Any = np.zeros((0, len(self._int_fields())), dtype=np.int64)
+        self._floats: Any = np.zeros((0, len(self.FLOAT)), dtype=np.float64)
+
+    @classmethod
+    def field_names(cls) -> Tuple[str, ...]:
+        """Поля строки в порядке аргументов ROW (без index)."""
+        return tuple(f.name for f in fields(cls.ROW) if f.name != "index")
+
+    @classmethod
+    def _int_fields(cls) -> Tuple[str, ...]:
+        return cls.INT + cls.CODED + ("role",)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Any]) -> "_RowTable":
+        rows = list(rows)
+        return cls.from_columns({name: [getattr(r, name) for r in rows] for name in cls.field_names()})
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, List[Any]]) -> "_RowTable":
+        """Таблица из словаря «поле → значения по строкам» (как в to_columns)."""
+        table = cls()
+        size = len(columns["name"])
+        table._size = size
+        table._text = {name: tuple(columns[name]) for name in cls.TEXT}
+        int_columns = [[_MISSING_INT if v is None else int(v) for v in columns[name]] for name in cls.INT]
+        for name in cls.CODED:
+            pool: Dict[str, int] = {}
+            int_columns.append([-1 if v is None else pool.setdefault(v, len(pool)) for v in columns[name]])
+            table._pools[name] = tuple(pool)
+        int_columns.append([int(v) for v in columns["role"]])
+        table._ints = np.array(int_columns, dtype=np.int64).reshape(len(int_columns), size).T.copy()
+        table._floats = (
+            np.array([[np.nan if v is None else v for v in columns[name]] for name in cls.FLOAT], dtype=np.float64)
+            .reshape(len(cls.FLOAT), size).T.copy()
+        )
+        return table
+
+    def to_columns(self) -> Dict[str, List[Any]]:
+        """Значения по полям, как у исходных строк: None вместо пропусков, роли — числами."""
+        columns: Dict[str, List[Any]] = {name: list(values) for name, values in self._text.items()}
+        int_fields = self._int_fields()
+        for name, values in zip(int_fields, self._ints.T.tolist()):
+            if name in self._pools:
+                pool = self._pools[name]
+                columns[name] = [None if c < 0 else pool[c] for c in values]
+            elif name == "role":
+                columns[name] = values
+            else:
+                columns[name] = [None if v == _MISSING_INT else v for v in values]
+        for name, values in zip(self.FLOAT, self._floats.T.tolist()):
+            columns[name] = [None if v != v else v for v in values]
+        return {name: columns[name] for name in self.field_names()}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Any]:
+        row = self.ROW
+        columns = self.to_columns()
+        # Флаги ролей создаются по разу на значение, а не на строку
+        roles = {v: self.ROLE(v) for v in set(columns["role"])}
+        columns["role"] = [roles[v] for v in columns["role"]]
+        for i, values in enumerate(zip(*columns.values())):
+            yield row(*values, index=i)
+
+    def has_role(self, flag: int) -> bool:
+        """Есть ли строка с этим флагом роли — без сборки строк."""
+        return bool((self._ints[:, -1] & int(flag)).any())
+
+    def __getitem__(self, i: int) -> Any:
+        if not -self._size <= i < self._size:
+            raise IndexError(f"{type(self).__name__}: номер строки вне таблицы")
+        i %= self._size
+        values = []
+        ints = self._ints[i].tolist()
+        floats = self._floats[i].tolist()
+        for name in self.field_names():
+            if name in self._text:
+                values.append(self._text[name][i])
+            elif name in self.FLOAT:
+                v = floats[self.FLOAT.index(name)]
+                values.append(None if v != v else v)
+            else:
+                v = ints[self._int_fields().index(name)]
+                if name in self._pools:
+                    values.append(None if v < 0 else self._pools[name][v])
+                elif name == "role":
+                    values.append(v)
+                else:
+                    values.append(None if v == _MISSING_INT else v)
+        return self.ROW(*values, index=i)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, _RowTable):
+            return NotImplemented
+        return type(self) is type(other) and self.to_columns() == other.to_columns()
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self._size} rows)"
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        # Сырые байты массивов: pickle ndarray добавляет к каждому заметный заголовок
+        return self._size, self._text, self._pools, self._ints.tobytes(), self._floats.tobytes()
 
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        self._size, self._text, self._pools, ints, floats = state
+        self._ints = np.frombuffer(ints, dtype=np.int64).reshape(self._size, len(self._int_fields()))
+        self._floats = np.frombuffer(floats, dtype=np.float64).reshape(self._size, len(self.FLOAT))
 
-@dataclass
-class ParsedSpec:
-    source_filename: str
-    width_total_mm: int
-    depth_mm: int
-    height_mm: int
-    sections_count: int
-    section_width_mm: int
-    corpus_rows: List[ParsedRow] = field(default_factory=list)
-    furniture_items: List[FurnitureItem] = field(default_factory=list)
-    total_weight_kg: float = 0.0
-    base_cost: Optional[float] = None
-    final_price: Optional[float] = None
 
+class CorpusTable(_RowTable):
+    """Корпусные детали: строки — ParsedRow, материал хранится номером в словаре материалов."""
 
-USER_STATE: Dict[int, ParsedSpec] = {}
+    ROW = ParsedRow
+    ROLE = PartRole
+    TEXT = ("name",)
+    INT = ("thickness_mm", "length_mm", "width_mm")
+    CODED = ("material",)
+    FLOAT = ("qty",)
+    __slots__ = ()
+
+
+class FurnitureTable(_RowTable):
+    """Позиции фурнитуры: строки — FurnitureItem, единица измерения — номером в словаре."""
+
+    ROW = FurnitureItem
+    ROLE = FurnitureRole
+    TEXT = ("name", "code")
+    CODED = ("unit",)
+    FLOAT = ("qty",)
+    __slots__ = ()
+
+
+@dataclass
+class ParsedSpec:
+    source_filename: str
+    width_total_mm: int
+    depth_mm: int
+    height_mm: int
+    sections_count: int
+    section_width_mm: int
+    corpus_rows: CorpusTable = field(default_factory=CorpusTable)
+    furniture_items: FurnitureTable = field(default_factory=FurnitureTable)
+    total_weight_kg: float = 0.0
+    base_cost: Optional[float] = None
+    final_price: Optional[float] = None
+    # Как найдены габариты (см. GeometryGuess)
+    geometry_strategy: str = ""
+    geometry_confidence: float = 0.0
+
+
+def _spec_to_dict(spec: ParsedSpec) -> dict:
+    """Сериализует спецификацию в словарь из простых типов; детали и фурнитура — по столбцам."""
+    data = {f.name: getattr(spec, f.name) for f in fields(spec)}
+    data["corpus_rows"] = spec.corpus_rows.to_columns()
+    data["furniture_items"] = spec.furniture_items.to_columns()
+    return data
+
+
+def _spec_from_dict(data: dict) -> ParsedSpec:
+    """
+    Восстанавливает спецификацию из словаря, полученного через _spec_to_dict.
+    Понимает и прежний формат со списком строк — так читаются сессии,
+    сохранённые до перехода на таблицы.
+    """
+    data = dict(data)
+    for key, table_cls in (("corpus_rows", CorpusTable), ("furniture_items", FurnitureTable)):
+        value = data.get(key) or {}
+        if isinstance(value, list):
+            data[key] = table_cls.from_rows(table_cls.ROW(**r) for r in value)
+        else:
+            data[key] = table_cls.from_columns(value) if value else table_cls()
+    return ParsedSpec(**data)
+
+
+class SpecCache:
+    """
+    LRU-кэш готовых ParsedSpec в памяти с копией на диске.
+
+    Ключ — SHA-256 содержимого файла; file_unique_id из Telegram хранится как
+    псевдоним хэша и позволяет найти спецификацию ещё до скачивания файла.
+    Псевдонимы в памяти живут, пока жив их хэш (обратный индекс хэш →
+    псевдонимы); на диске их не больше ALIASES_PER_SPEC на запись, лишние —
+    самые давно не использованные — удаляются вместе с вытесненными записями.
+
+    Запись на диск (write_disk) блокирует: на событийном цикле её вызывают
+    через asyncio.to_thread, а в памяти спецификацию запоминает remember().
+    """
+
+    # Один файл может прийти под разными file_unique_id (пересохранён, загружен с другого устройства)
+    ALIASES_PER_SPEC = 4
+
+    def __init__(self, max_items: int, directory: Optional[Path], max_disk_items: int) -> None:
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self.directory = directory
+        self._items: "OrderedDict[str, ParsedSpec]" = OrderedDict()
+        self._aliases: Dict[str, str] = {}
+        self._aliases_by_digest: Dict[str, Set[str]] = {}
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            (self.directory / "by_file_id").mkdir(parents=True, exist_ok=True)
+
+    def get(self, file_unique_id: Optional[str] = None, digest: Optional[str] = None) -> Optional[ParsedSpec]:
+        """
+        Ищет спецификацию по file_unique_id или по хэшу содержимого.
+        Промах засчитывается только при поиске по хэшу — после него файл будет разобран.
+        """
+        by_digest = digest is not None
+        if digest is None and file_unique_id:
+            digest = self._aliases.get(file_unique_id) or self._read_alias(file_unique_id)
+            if digest is None:
+                return None
+
+        if digest is None:
+            return None
+
+        spec = self._items.get(digest)
+        if spec is not None:
+            self._items.move_to_end(digest)
+            self.hits += 1
+        else:
+            spec = self._read_disk(digest)
+            if spec is None:
+                if by_digest:
+                    self.misses += 1
+                return None
+            self._remember(digest, spec)
+            self.hits += 1
+            self.disk_hits += 1
+
+        if file_unique_id:
+            self._add_alias(file_unique_id, digest)
+        return spec
+
+    def put(self, digest: str, spec: ParsedSpec, file_unique_id: Optional[str] = None) -> None:
+        self.remember(digest, spec, file_unique_id)
+        self.write_disk(digest, spec, file_unique_id)
+
+    def remember(self, digest: str, spec: ParsedSpec, file_unique_id: Optional[str] = None) -> None:
+        """Только память — без обращения к диску."""
+        self._remember(digest, spec)
+        if file_unique_id:
+            self._add_alias(file_unique_id, digest)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "items": len(self._items),
+        }
+
+    def _remember(self, digest: str, spec: ParsedSpec) -> None:
+        self._items[digest] = spec
+        self._items.move_to_end(digest)
+        while len(self._items) > self.max_items:
+            evicted, _ = self._items.popitem(last=False)
+            for alias in self._aliases_by_digest.pop(evicted, ()):
+                del self._aliases[alias]
+
+    def _add_alias(self, file_unique_id: str, digest: str) -> None:
+        previous = self._aliases.get(file_unique_id)
+        if previous == digest:
+            return
+        if previous is not None:
+            self._aliases_by_digest[previous].discard(file_unique_id)
+        # Псевдоним хэша, которого нет в памяти, нечем вытеснить — не запоминаем
+        if digest in self._items:
+            self._aliases[file_unique_id] = digest
+            self._aliases_by_digest.setdefault(digest, set()).add(file_unique_id)
+        elif previous is not None:
+            del self._aliases[file_unique_id]
+
+    def _read_alias(self, file_unique_id: str) -> Optional[str]:
+        if self.directory is None:
+            return None
+        path = self.directory / "by_file_id" / file_unique_id
+        try:
+            digest = path.read_text(encoding="utf-8").strip() or None
+            os.utime(path)
+            return digest
+        except OSError:
+            return None
+
+    def _read_disk(self, digest: str) -> Optional[ParsedSpec]:
+        if self.directory is None:
+            return None
+        path = self.directory / f"{digest}.json"
+        try:
+            payload = json.loads(path.read_text(encoding="utf-8"))
+            if payload.get("version") != SPEC_CACHE_VERSION:
+                return None
+            spec = _spec_from_dict(payload["spec"])
+            os.utime(path)
+            return spec
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Повреждённая запись кэша %s: %s", path.name, e)
+            return None
+
+    def write_disk(self, digest: str, spec: ParsedSpec, file_unique_id: Optional[str] = None) -> None:
+        """Копия на диск и очистка каталога; вызывается и из потоков."""
+        if self.directory is None:
+            return
+        try:
+            path = self.directory / f"{digest}.json"
+            payload = {"version": SPEC_CACHE_VERSION, "spec": _spec_to_dict(spec)}
+            data = json.dumps(payload, ensure_ascii=False)
+            with self._disk_lock:
+                tmp_path = path.with_suffix(".tmp")
+                tmp_path.write_text(data, encoding="utf-8")
+                tmp_path.replace(path)
+                if file_unique_id:
+                    (self.directory / "by_file_id" / file_unique_id).write_text(digest, encoding="utf-8")
+                self._prune_disk()
+        except OSError as e:
+            logger.warning("Не удалось записать кэш спецификации на диск: %s", e)
+
+    @staticmethod
+    def _oldest_first(paths: Iterable[Path]) -> List[Path]:
+        stamped = []
+        for path in paths:
+            try:
+                stamped.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        stamped.sort()
+        return [path for _, path in stamped]
+
+    def _prune_disk(self) -> None:
+        specs = self._oldest_first(self.directory.glob("*.json"))
+        pruned = {path.stem for path in specs[: max(0, len(specs) - self.max_disk_items)]}
+        for digest in pruned:
+            (self.directory / f"{digest}.json").unlink(missing_ok=True)
+
+        # Псевдонимы: самые старые сверх лимита и все, что указывают на удалённые записи
+        aliases = self._oldest_first((self.directory / "by_file_id").iterdir())
+        extra = max(0, len(aliases) - self.max_disk_items * self.ALIASES_PER_SPEC)
+        for path in aliases[:extra]:
+            path.unlink(missing_ok=True)
+        if not pruned:
+            return
+        for path in aliases[extra:]:
+            try:
+                if path.read_text(encoding="utf-8").strip() in pruned:
+                    path.unlink(missing_ok=True)
+            except OSError:
+                continue
+
+
+def _pack_spec(spec: ParsedSpec) -> bytes:
+    """Компактная форма спецификации: JSON без пробелов, сжатый zlib."""
+    raw = json.dumps(_spec_to_dict(spec), ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(raw.encode("utf-8"), 6)
+
+
+def _unpack_spec(blob: bytes) -> ParsedSpec:
+    return _spec_from_dict(json.loads(zlib.decompress(blob).decode("utf-8")))
+
+
+class SessionStore:
+    """
+    Текущие спецификации пользователей (user_id → ParsedSpec).
+
+    Источник истины — таблица SQLite (WAL), поэтому сессии переживают перезапуск
+    и видны всем процессам бота с тем же файлом. В памяти держится LRU из
+    max_items последних сессий; перед выдачей из памяти сверяется версия
+    (updated_at) в базе, так что запись из другого процесса не теряется.
+    Сессии старше ttl_s удаляются и из памяти, и из базы.
+
+    Вместе со спецификацией хранится её отпечаток — SHA-256 упакованной формы:
+    одинаковые спецификации дают одинаковый отпечаток, по нему RecalcMemo
+    понимает, что готовые пересчёты ещё годятся.
+
+    Упаковка, хэширование и запросы к базе блокируют, поэтому обработчики
+    зовут методы через asyncio.to_thread; доступ из потоков защищён замком.
+    """
+
+    def __init__(self, path: Path, max_items: int, ttl_s: float) -> None:
+        self.path = path
+        self.max_items = max(1, max_items)
+        self.ttl_s = ttl_s
+        self._items: "OrderedDict[int, Tuple[float, ParsedSpec, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, spec BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def get(self, user_id: int) -> Optional[ParsedSpec]:
+        entry = self.get_entry(user_id)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, user_id: int) -> Optional[Tuple[ParsedSpec, str]]:
+        """Спецификация пользователя вместе с её отпечатком."""
+        with self._lock:
+            row = self._db.execute("SELECT updated_at FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None or self._expired(row[0]):
+                self._items.pop(user_id, None)
+                return None
+
+            cached = self._items.get(user_id)
+            if cached is not None and cached[0] == row[0]:
+                self._items.move_to_end(user_id)
+                return cached[1], cached[2]
+
+            blob_row = self._db.execute(
+                "SELECT spec, updated_at FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if blob_row is None:
+                return None
+            try:
+                spec = _unpack_spec(blob_row[0])
+            except Exception as e:
+                logger.warning("Не удалось прочитать сессию user_id=%s: %s", user_id, e)
+                self._db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                return None
+            fingerprint = hashlib.sha256(blob_row[0]).hexdigest()
+            self._remember(user_id, blob_row[1], spec, fingerprint)
+            return spec, fingerprint
+
+    def set(self, user_id: int, spec: ParsedSpec) -> str:
+        """Сохраняет спецификацию и возвращает её отпечаток."""
+        blob = _pack_spec(spec)
+        fingerprint = hashlib.sha256(blob).hexdigest()
+        updated_at = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, spec, updated_at) VALUES (?, ?, ?)",
+                (user_id, blob, updated_at),
+            )
+            self._remember(user_id, updated_at, spec, fingerprint)
+            self._prune_expired()
+        return fingerprint
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _expired(self, updated_at: float) -> bool:
+        return self.ttl_s > 0 and time.time() - updated_at > self.ttl_s
+
+    def _remember(self, user_id: int, updated_at: float, spec: ParsedSpec, fingerprint: str) -> None:
+        self._items[user_id] = (updated_at, spec, fingerprint)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def _prune_expired(self) -> None:
+        now = time.time()
+        if self.ttl_s <= 0 or now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        deleted = self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl_s,)).rowcount
+        for user_id in [uid for uid, (ts, _, _) in self._items.items() if now - ts > self.ttl_s]:
+            del self._items[user_id]
+        if deleted:
+            logger.info("Удалено устаревших сессий: %s", deleted)
+
+
+USER_STATE = SessionStore(SESSION_DB, SESSION_MEMORY_SIZE, SESSION_TTL_S)
+
+SPEC_CACHE = SpecCache(SPEC_CACHE_SIZE, SPEC_CACHE_DIR if SPEC_CACHE_DISK_SIZE > 0 else None, SPEC_CACHE_DISK_SIZE)
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых задач, идущих одновременно: первый вызов run() с ключом
+    запускает работу отдельной задачей, остальные ждут её же и получают тот же
+    результат или то же исключение. Работа не привязана к вызывающему: отмена
+    одного из ждущих не отменяет её для остальных, а когда отменены все
+    ждущие, отменяется и сама работа — результат больше никому не нужен.
+    После завершения ключ освобождается — дальше результат берётся из кэша,
+    а не отсюда.
+
+    Ключ — кортеж (вид, значение); счётчики ведутся по видам.
+    """
+
+    def __init__(self) -> None:
+        # Ключ → [задача, время запуска, число ждущих]
+        self._flights: Dict[Tuple[str, str], List[Any]] = {}
+        self.executed: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+        self.abandoned: Dict[str, int] = {}
+        self.saved_seconds: Dict[str, float] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: Tuple[str, str], factory: Callable[[], Awaitable[Any]]) -> Any:
+        kind = key[0]
+        flight = self._flights.get(key)
+        coalesced = flight is not None
+        if flight is None:
+            task = asyncio.ensure_future(factory())
+            flight = self._flights[key] = [task, time.perf_counter(), 0]
+            task.add_done_callback(partial(self._finished, key))
+            self.executed[kind] = self.executed.get(kind, 0) + 1
+        else:
+            self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+            logger.info("Такая же задача %s уже выполняется — ждём её результат", key)
+        task, started, _ = flight
+        flight[2] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if flight[2] == 1 and not task.done():
+                # Ушёл последний ждущий. Ключ освобождаем сразу, чтобы новый запрос
+                # не присоединился к уже отменённой задаче
+                logger.info("Задача %s больше никто не ждёт — отменяем", key)
+                self.abandoned[kind] = self.abandoned.get(kind, 0) + 1
+                self._flights.pop(key, None)
+                task.cancel()
+            raise
+        finally:
+            flight[2] -= 1
+            if coalesced:
+                # Сэкономлено столько, сколько ждущий простоял бы, выполняя работу сам
+                self.saved_seconds[kind] = self.saved_seconds.get(kind, 0.0) + time.perf_counter() - started
+
+    def _finished(self, key: Tuple[str, str], task: asyncio.Task) -> None:
+        if self._flights.get(key, [None])[0] is task:
+            del self._flights[key]
+        # Забираем исключение: ждущих могло уже не остаться
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            kind: {
+                "executed": self.executed.get(kind, 0),
+                "coalesced": self.coalesced.get(kind, 0),
+                "abandoned": self.abandoned.get(kind, 0),
+                "saved_s": round(self.saved_seconds.get(kind, 0.0), 1),
+            }
+            for kind in sorted(set(self.executed) | set(self.coalesced) | set(self.abandoned))
+        }
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, kind_, help_text, values in (
+            ("executed_total", "counter", "Distinct downloads or parses started.", self.executed),
+            ("coalesced_total", "counter", "Identical requests that waited for an in-flight one.", self.coalesced),
+            ("abandoned_total", "counter", "In-flight work cancelled after every waiter left.", self.abandoned),
+            ("saved_seconds_total", "counter", "Time not spent thanks to coalescing.", self.saved_seconds),
+        ):
+            lines.append(f"# HELP wardrobe_singleflight_{name} {help_text}")
+            lines.append(f"# TYPE wardrobe_singleflight_{name} {kind_}")
+            for kind, value in sorted(values.items()):
+                lines.append(f'wardrobe_singleflight_{name}{{kind="{kind}"}} {value:.6g}')
+        lines += [
+            "# HELP wardrobe_singleflight_in_flight Distinct downloads or parses running now.",
+            "# TYPE wardrobe_singleflight_in_flight gauge",
+            f"wardrobe_singleflight_in_flight {self.in_flight}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+UPLOAD_FLIGHTS = SingleFlight()
+
+
+def _max_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    # В Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageStats:
+    """
+    Время и пик памяти по этапам обработки. Последние window замеров каждого
+    этапа лежат в кольцевых буферах, по ним считаются p50/p95/p99; count и sum
+    накапливаются за всё время работы (для Prometheus).
+
+    Пик памяти — насколько выросла трассируемая память за этап (tracemalloc,
+    если включён STATS_TRACE_MEMORY), иначе — насколько этап поднял пиковый RSS
+    процесса. Второе дёшево, но показывает только новые максимумы; при
+    параллельных задачах оба значения приблизительны.
+    """
+
+    STAGES = (
+        "download",
+        "workbook_open",
+        "sheet_index",
+        "material_dict",
+        "corpus_parse",
+        "furniture_parse",
+        "geometry",
+        "recalc",
+        "sweep",
+        "render",
+        "send",
+        "startup",
+        "warm_up",
+        "queue_command",
+        "queue_recalc",
+        "queue_heavy",
+    )
+    _QUANTILES = (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99"))
+
+    def __init__(self, window: int) -> None:
+        self.window = max(1, window)
+        self._seconds: Dict[str, deque] = {}
+        self._memory: Dict[str, deque] = {}
+        self._count: Dict[str, int] = {}
+        self._sum: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, stage: str, seconds: float, peak_bytes: int) -> None:
+        captured = getattr(self._local, "captured", None)
+        if captured is not None:
+            captured.append((stage, seconds, peak_bytes))
+            return
+        with self._lock:
+            if stage not in self._seconds:
+                self._seconds[stage] = deque(maxlen=self.window)
+                self._memory[stage] = deque(maxlen=self.window)
+                self._count[stage] = 0
+                self._sum[stage] = 0.0
+            self._seconds[stage].append(seconds)
+            self._memory[stage].append(peak_bytes)
+            self._count[stage] += 1
+            self._sum[stage] += seconds
+
+    def extend(self, samples: Iterable[Tuple[str, float, int]]) -> None:
+        for sample in samples:
+            self.record(*sample)
+
+    @contextmanager
+    def capture(self) -> Iterator[List[Tuple[str, float, int]]]:
+        """Замеры текущего потока копятся в списке, а не в буферах — чтобы вернуть их из процесса пула."""
+        previous = getattr(self._local, "captured", None)
+        samples: List[Tuple[str, float, int]] = []
+        self._local.captured = samples
+        try:
+            yield samples
+        finally:
+            self._local.captured = previous
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # reset_peak общий на процесс, поэтому пик вложенного этапа передаём внешнему сами
+            frames = self._local.__dict__.setdefault("frames", [])
+            current, peak = tracemalloc.get_traced_memory()
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+            frames.append(frame)
+        else:
+            rss_before = _max_rss_bytes()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            if tracing:
+                frames.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+                if frames:
+                    frames[-1][1] = max(frames[-1][1], peak)
+                peak_bytes = peak - frame[0]
+            else:
+                peak_bytes = _max_rss_bytes() - rss_before
+            self.record(name, seconds, peak_bytes)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            data = {
+                stage: (list(self._seconds[stage]), list(self._memory[stage]), self._count[stage], self._sum[stage])
+                for stage in self._seconds
+            }
+
+        order = [s for s in self.STAGES if s in data] + sorted(s for s in data if s not in self.STAGES)
+        result: Dict[str, Dict[str, float]] = {}
+        for stage in order:
+            seconds, memory, count, total = data[stage]
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+            m50, m95, m99 = np.percentile(memory, [50, 95, 99])
+            result[stage] = {
+                "count": count,
+                "sum": total,
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "mem_p50": float(m50),
+                "mem_p95": float(m95),
+                "mem_p99": float(m99),
+            }
+        return result
+
+    def render_text(self) -> str:
+        snapshot = self.snapshot()
+        if not snapshot:
+            return "Замеров пока нет."
+        lines = []
+        for stage, st in snapshot.items():
+            lines.append(
+                f"{stage}: n={st['count']} • "
+                f"{st['p50'] * 1000:.0f}/{st['p95'] * 1000:.0f}/{st['p99'] * 1000:.0f} мс • "
+                f"память p95 {st['mem_p95'] / 1048576:.1f} МБ"
+            )
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP wardrobe_stage_seconds Wall time of a processing stage.",
+            "# TYPE wardrobe_stage_seconds summary",
+        ]
+        for stage, st in snapshot.items():
+            for q, key in self._QUANTILES:
+                lines.append(f'wardrobe_stage_seconds{{stage="{stage}",quantile="{q}"}} {st[key]:.6f}')
+            lines.append(f'wardrobe_stage_seconds_sum{{stage="{stage}"}} {st["sum"]:.6f}')
+            lines.append(f'wardrobe_stage_seconds_count{{stage="{stage}"}} {st["count"]}')
+        lines += [
+            "# HELP wardrobe_stage_peak_memory_bytes Peak memory growth during a processing stage.",
+            "# TYPE wardrobe_stage_peak_memory_bytes gauge",
+        ]
+        for stage, st in snapshot.items():
+            for q, key in self._QUANTILES:
+                lines.append(f'wardrobe_stage_peak_memory_bytes{{stage="{stage}",quantile="{q}"}} {st["mem_" + key]:.0f}')
+        return "\n".join(lines) + "\n"
+
+
+if STATS_TRACE_MEMORY:
+    tracemalloc.start()
+
+STAGE_STATS = StageStats(STATS_WINDOW)
+
+
+def _run_measured(stage: Optional[str], func: Callable[..., Any], *args: Any) -> Tuple[Any, List[Tuple[str, float, int]]]:
+    """Выполняет func в воркере и возвращает результат вместе с замерами этапов."""
+    with STAGE_STATS.capture() as samples:
+        if stage is None:
+            result = func(*args)
+        else:
+            with STAGE_STATS.stage(stage):
+                result = func(*args)
+    return result, samples
+
+
+class WorkerBusyError(RuntimeError):
+    """Очередь пула заполнена — задачу не принимаем."""
+
+
+class WorkerLimitError(RuntimeError):
+    """
+    Задача в песочнице упёрлась в лимит памяти, CPU или времени, убила процесс
+    или была прервана, потому что её результат больше не нужен (reason="cancelled").
+    """
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _vm_size_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _on_cpu_limit(signum: int, frame: Any) -> None:
+    raise WorkerLimitError("cpu")
+
+
+def _sandbox_worker(conn: Any, memory_bytes: int, cpu_s: int) -> None:
+    """
+    Цикл процесса песочницы: получает (func, args), возвращает ("ok", результат,
+    пиковый RSS) или ("error", исключение, пиковый RSS). None или закрытый канал — выход.
+
+    RLIMIT_AS ограничивает адресное пространство: текущий размер процесса плюс
+    memory_bytes, так что лимит считается от уже загруженных модулей. Мягкий
+    RLIMIT_CPU ставится на каждую задачу заново; сигнал SIGXCPU превращается в
+    WorkerLimitError, а если задача застряла в C-коде, процесс убьёт
+    родитель по таймауту.
+    """
+    if memory_bytes > 0:
+        limit = _vm_size_bytes() + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            func, args = message
+            try:
+                if cpu_s > 0:
+                    usage = resource.getrusage(resource.RUSAGE_SELF)
+                    soft = int(usage.ru_utime + usage.ru_stime) + cpu_s
+                    if cpu_hard == resource.RLIM_INFINITY or soft < cpu_hard:
+                        resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_hard))
+                try:
+                    reply = ("ok", func(*args))
+                finally:
+                    resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+            except MemoryError:
+                reply = ("error", WorkerLimitError("memory"))
+            except BaseException as e:
+                reply = ("error", e)
+            try:
+                conn.send((*reply, _max_rss_bytes()))
+            except Exception as e:
+                # Результат или исключение не сериализуются — отдаём хотя бы текст
+                conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}"), _max_rss_bytes()))
+    finally:
+        _stop_log_listener()
+
+
+class SandboxExecutor(Executor):
+    """
+    Пул из workers заранее запущенных процессов-песочниц (_sandbox_worker).
+    Каждым процессом управляет свой поток: берёт задачу из общей очереди,
+    отправляет её по каналу и ждёт ответа не дольше deadline_s. Не успел —
+    процесс убивается и запускается заново, задача завершается
+    WorkerLimitError("deadline"); так же поднимается новый процесс, если
+    старый умер (OOM, жёсткий лимит CPU). Процесс пересоздаётся после
+    max_jobs задач, после нехватки памяти и когда его пиковый RSS превысил
+    max_rss_bytes — память, набранную большим файлом, процесс назад не отдаёт.
+    abort() прерывает уже запущенную задачу, которую никто не ждёт: процесс
+    убивается и тоже заменяется новым.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        deadline_s: float,
+        memory_bytes: int,
+        cpu_s: int,
+        max_jobs: int,
+        max_rss_bytes: int,
+    ) -> None:
+        self.name = name
+        self.deadline_s = deadline_s
+        self.memory_bytes = memory_bytes
+        self.cpu_s = cpu_s
+        self.max_jobs = max(1, max_jobs)
+        self.max_rss_bytes = max_rss_bytes
+        self.recycled = 0
+        self.killed = 0
+        self.aborted = 0
+        self._lock = threading.Lock()
+        self._running: Dict[Future, Any] = {}
+        self._aborting: Set[Future] = set()
+        self._mp = multiprocessing.get_context("fork")
+        self._jobs: "queue.SimpleQueue[Optional[Tuple[Future, Callable[..., Any], Tuple[Any, ...]]]]" = queue.SimpleQueue()
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._manage, args=(self._spawn(),), name=f"{name}-sandbox-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _spawn(self) -> Tuple[Any, Any]:
+        parent_conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(
+            target=_sandbox_worker,
+            args=(child_conn, self.memory_bytes, self.cpu_s),
+            name=f"{self.name}-sandbox",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _stop(self, worker: Tuple[Any, Any], kill: bool) -> None:
+        process, conn = worker
+        if not kill:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+
+    def _manage(self, worker: Tuple[Any, Any]) -> None:
+        jobs = 0
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                self._stop(worker, kill=False)
+                return
+            future, func, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            process, conn = worker
+            with self._lock:
+                self._running[future] = process
+            reply = None
+            reason = "deadline"
+            error = None
+            try:
+                conn.send((func, args))
+                if conn.poll(self.deadline_s):
+                    reason = "crash"
+                    reply = conn.recv()
+            except (EOFError, OSError):
+                pass
+            except Exception as e:
+                error = e
+            with self._lock:
+                del self._running[future]
+                aborted = future in self._aborting
+                self._aborting.discard(future)
+            if error is not None and not aborted:
+                # Задачу не удалось сериализовать — процесс цел
+                future.set_exception(error)
+                continue
+
+            jobs += 1
+            recycle = None
+            if aborted:
+                # Процесс уже убит в abort(), даже если ответ успел прийти
+                reason = "cancelled"
+                self.aborted += 1
+                logger.info("Песочница %s: задача отменена, процесс pid=%s заменён", self.name, process.pid)
+                future.set_exception(WorkerLimitError(reason))
+            elif reply is None:
+                self.killed += 1
+                logger.warning("Песочница %s: задача прервана (%s), процесс pid=%s заменён", self.name, reason, process.pid)
+                future.set_exception(WorkerLimitError(reason))
+            else:
+                status, value, rss = reply
+                if status == "ok":
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+                reason = None
+                if isinstance(value, WorkerLimitError):
+                    recycle = value.reason
+                elif self.max_rss_bytes and rss > self.max_rss_bytes:
+                    recycle = f"RSS {rss / 1048576:.0f} МБ"
+                elif jobs >= self.max_jobs:
+                    recycle = f"выполнено задач: {jobs}"
+
+            if reason or recycle:
+                if recycle:
+                    self.recycled += 1
+                    logger.info(
+                        "Песочница %s: процесс pid=%s пересоздаётся, причина: %s", self.name, process.pid, recycle
+                    )
+                self._stop(worker, kill=bool(reason) or recycle == "cpu")
+                if self._shutdown:
+                    return
+                worker = self._spawn()
+                jobs = 0
+
+    def abort(self, future: Future) -> bool:
+        """Прерывает запущенную задачу, убивая её процесс. False — задача не выполняется."""
+        with self._lock:
+            process = self._running.get(future)
+            if process is None:
+                return False
+            self._aborting.add(future)
+        process.kill()
+        return True
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        if kwargs:
+            raise TypeError("SandboxExecutor не принимает именованные аргументы")
+        if self._shutdown:
+            raise RuntimeError(f"Песочница {self.name} остановлена, новые задачи не принимаются")
+        future: Future = Future()
+        self._jobs.put((future, fn, args))
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        for _ in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class WorkerPool:
+    """
+    Пул процессов или потоков для CPU-задач с ограниченной очередью и таймаутом.
+
+    Ограничение max_pending считает и выполняющиеся, и ожидающие задачи: при
+    переполнении run() сразу бросает WorkerBusyError, а не копит очередь.
+    Таймаут отсчитывается вместе с ожиданием в очереди. И по таймауту, и при
+    отмене самого вызова run() ответ больше никто не ждёт: задача, ещё не
+    начатая, снимается с очереди, а в пуле sandbox (SandboxExecutor)
+    прерывается и уже запущенная — её процесс убивается и заменяется новым.
+    В пулах process и thread запущенную задачу прервать нельзя: она
+    досчитывается в фоне и занимает слот до завершения.
+    """
+
+    def __init__(self, name: str, kind: str, workers: int, max_pending: int, timeout_s: float) -> None:
+        if kind not in ("process", "thread", "sandbox"):
+            raise ValueError(f"Неизвестный тип пула {name}: {kind} (ожидается process, thread или sandbox)")
+        self.name = name
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.timeout_s = timeout_s
+        self.pending = 0
+        self.cancelled = 0
+        self._executor: Optional[Executor] = None
+
+    @property
+    def is_full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "sandbox":
+                self._executor = SandboxExecutor(
+                    self.name,
+                    self.workers,
+                    self.timeout_s,
+                    SANDBOX_MEMORY_MB * 1024 * 1024,
+                    SANDBOX_CPU_S,
+                    SANDBOX_MAX_JOBS,
+                    SANDBOX_MAX_RSS_MB * 1024 * 1024,
+                )
+            elif self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self.is_full:
+            raise WorkerBusyError(f"Пул {self.name} занят: {self.pending} задач в очереди")
+
+        self.pending += 1
+        executor = self._get_executor()
+        job = executor.submit(func, *args)
+        future = asyncio.wrap_future(job)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout_s)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if job.cancel() or (isinstance(executor, SandboxExecutor) and executor.abort(job)):
+                self.cancelled += 1
+            raise
+
+    async def run_measured(self, stage: Optional[str], func: Callable[..., Any], *args: Any) -> Any:
+        """Как run(), но замеры этапов из воркера (в том числе из другого процесса) попадают в STAGE_STATS."""
+        result, samples = await self.run(_run_measured, stage, func, *args)
+        STAGE_STATS.extend(samples)
+        return result
+
+    def _release(self, future: "asyncio.Future[Any]") -> None:
+        self.pending -= 1
+        # Забираем исключение, чтобы задача, брошенная по таймауту, не сыпала предупреждениями
+        if not future.cancelled():
+            future.exception()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+PARSE_POOL = WorkerPool("parse", PARSE_POOL_KIND, PARSE_WORKERS, PARSE_QUEUE_SIZE, PARSE_TIMEOUT_S)
+RECALC_POOL = WorkerPool("recalc", RECALC_POOL_KIND, RECALC_WORKERS, RECALC_QUEUE_SIZE, RECALC_TIMEOUT_S)
+
+
+class Upload:
+    """
+    Файл, скачиваемый из Telegram. Не больше UPLOAD_SPOOL_BYTES — остаётся в
+    памяти и уходит в разбор как bytes без копий (BytesIO.getvalue отдаёт свой
+    буфер). Крупнее — пишется во временный файл, и в разбор уходит путь:
+    процесс пула открывает файл сам, не получая копию содержимого через pickle.
+
+    Загрузку могут держать несколько владельцев (retain): временный файл
+    удаляется, когда close() вызвал последний из них.
+    """
+
+    def __init__(self, size: Optional[int], suffix: str) -> None:
+        self.file: BinaryIO
+        self._refs = 1
+        if size is not None and size > UPLOAD_SPOOL_BYTES:
+            # openpyxl узнаёт формат по расширению пути
+            self.file = tempfile.NamedTemporaryFile(prefix="wardrobe-upload-", suffix=suffix)
+        else:
+            self.file = io.BytesIO()
+
+    def __enter__(self) -> "Upload":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return self.file.seek(0, io.SEEK_END)
+
+    def source(self) -> Union[bytes, str]:
+        """Что передать в _build_spec: содержимое или путь к временному файлу."""
+        if isinstance(self.file, io.BytesIO):
+            return self.file.getvalue()
+        self.file.flush()
+        return self.file.name
+
+    def digest(self) -> str:
+        self.file.seek(0)
+        return hashlib.file_digest(self.file, "sha256").hexdigest()
+
+    def retain(self) -> "Upload":
+        self._refs += 1
+        return self
+
+    def close(self) -> None:
+        self._refs -= 1
+        if self._refs == 0:
+            # Временный файл удаляется при закрытии
+            self.file.close()
 
 
 @dataclass
@@ -117,9 +1681,8 @@ def _distribute_items_per_section(total_qty: float, sections_count: int) -> List
     return distribution
 
 
-def _find_sheet_by_keywords(xl, keywords: List[str]) -> Optional[str]:
+def _find_sheet_by_keywords(sheet_names: List[str], keywords: List[str]) -> Optional[str]:
     """Ищет лист по ключевым словам"""
-    sheet_names = xl.sheet_names
     for s in sheet_names:
         s_lower = s.strip().lower()
         if any(kw in s_lower for kw in keywords):
@@ -127,42 +1690,325 @@ def _find_sheet_by_keywords(xl, keywords: List[str]) -> Optional[str]:
     return None
 
 
-def _read_excel_to_sheets(file_bytes: bytes, filename: str) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+class Sheet:
     """
-    Читает Excel и возвращает (корпус_df, фурнитура_df)
+    Лист как двумерный object-массив ячеек (строки × колонки) в той же
+    типизации, что у pd.read_excel(header=None): пустая ячейка — NaN,
+    колонка из одних целых — int, целые вперемешку с пустыми — float,
+    текст и даты — как прочитаны.
     """
-    ext = os.path.splitext(filename.lower())[1]
-    bio = io.BytesIO(file_bytes)
 
-    if ext == ".xls":
-        xl = pd.ExcelFile(bio, engine="xlrd")
+    __slots__ = ("values",)
+
+    def __init__(self, values: np.ndarray) -> None:
+        self.values = values
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+
+def _is_na(value: Any) -> bool:
+    """Пустая ячейка (None или NaN) — pd.isna для одного значения без импорта pandas."""
+    return value is None or value != value
+
+
+def _filled_mask(values: np.ndarray) -> np.ndarray:
+    """Маска непустых ячеек object-массива — pd.notna; NaN не равен сам себе."""
+    return (values == values) & (values != None)  # noqa: E711
+
+
+# Приведение типов колонки — как у парсера pandas (TextParser) для read_excel:
+# строки из _NA_STRINGS — пропуски, числовые строки — числа, колонка целиком
+# становится int, float или остаётся object
+_NA_STRINGS = frozenset({
+    "-1.#IND", "1.#QNAN", "1.#IND", "-1.#QNAN", "#N/A N/A", "#N/A", "N/A", "n/a", "NA", "<NA>",
+    "#NA", "NULL", "null", "NaN", "-NaN", "nan", "-nan", "None", "",
+})
+_NUMERIC_RE = re.compile(
+    r"\s*[-+]?(?:(\d+)|\d+\.\d*(?:[eE][-+]?\d+)?|\d*\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+|inf(?:inity)?)\s*",
+    re.IGNORECASE,
+)
+_BOOL_STRINGS = {"True": True, "TRUE": True, "true": True, "False": False, "FALSE": False, "false": False}
+_INT64_MIN, _INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+
+
+def _infer_column(column: Iterable[Any]) -> List[Any]:
+    """
+    Значения одной колонки после приведения типов. Совпадает с pandas для
+    текста, чисел и пустых ячеек; колонки из логических значений и из одних
+    дат pandas приводит иначе (bool/Timestamp), здесь они остаются как есть.
+    """
+    cells = list(column)
+    numbers: List[Any] = []
+    has_na = has_float = has_int = has_bool = has_big = False
+    for v in cells:
+        if isinstance(v, str):
+            if v in _NA_STRINGS:
+                has_na = True
+                numbers.append(math.nan)
+                continue
+            m = _NUMERIC_RE.fullmatch(v)
+            if m is None:
+                break
+            if m.group(1) is None:
+                has_float = True
+                numbers.append(float(v))
+                continue
+            iv = int(v)
+            if not _INT64_MIN <= iv <= _INT64_MAX:
+                break
+            has_int = True
+            numbers.append(iv)
+        elif isinstance(v, float):
+            if v != v:
+                has_na = True
+            else:
+                has_float = True
+            numbers.append(v)
+        elif isinstance(v, bool):
+            has_bool = True
+            numbers.append(v)
+        elif isinstance(v, int):
+            has_int = True
+            has_big = has_big or not _INT64_MIN <= v <= _INT64_MAX
+            numbers.append(v)
+        else:
+            break
     else:
-        xl = pd.ExcelFile(bio, engine="openpyxl")
+        if has_bool and not (has_na or has_float or has_int):
+            return numbers
+        if has_na or has_float or has_big:
+            return [float(v) for v in numbers]
+        return [int(v) for v in numbers]
+
+    # Колонка остаётся object: пропуски → NaN, «True»/«false» — только если вся колонка логическая
+    bool_like = True
+    for i, v in enumerate(cells):
+        if isinstance(v, str):
+            if v in _NA_STRINGS:
+                cells[i] = math.nan
+            elif v not in _BOOL_STRINGS:
+                bool_like = False
+        elif not isinstance(v, bool) and not (isinstance(v, float) and v != v):
+            bool_like = False
+    if bool_like:
+        cells = [_BOOL_STRINGS[v] if isinstance(v, str) else v for v in cells]
+    return cells
+
+
+def _open_workbook(source: Union[bytes, str], ext: str) -> Any:
+    """
+    Открывает книгу без разбора листов: для .xls — xlrd в режиме on_demand
+    (листы грузятся по одному при обращении), для .xlsx — openpyxl read_only.
+    source — содержимое файла или путь к нему: по пути xlrd отображает файл
+    через mmap, а openpyxl читает из архива только нужные части.
+    """
+    if ext == ".xls":
+        if isinstance(source, str):
+            return xlrd.open_workbook(source, on_demand=True)
+        return xlrd.open_workbook(file_contents=source, on_demand=True)
+    # BytesIO над bytes не копирует их
+    stream = source if isinstance(source, str) else io.BytesIO(source)
+    return openpyxl.load_workbook(stream, read_only=True, data_only=True, keep_links=False)
+
+
+def _read_rows_xlrd(book: Any, sheet_name: str) -> List[List[Any]]:
+    """Строки листа .xls; ячейки приводятся так же, как в pandas (целые числа — int, ошибки — NaN)."""
+    sheet = book.sheet_by_name(sheet_name)
+    number, date, error, boolean = xlrd.XL_CELL_NUMBER, xlrd.XL_CELL_DATE, xlrd.XL_CELL_ERROR, xlrd.XL_CELL_BOOLEAN
+    epoch1904 = book.datemode == 1
+    rows = []
+    for r in range(sheet.nrows):
+        row = sheet.row_values(r)
+        for c, kind in enumerate(sheet.row_types(r)):
+            v = row[c]
+            if kind == number:
+                if math.isfinite(v) and v == int(v):
+                    row[c] = int(v)
+            elif kind == date:
+                try:
+                    dt = xlrd.xldate.xldate_as_datetime(v, book.datemode)
+                except OverflowError:
+                    continue
+                # Время без даты Excel хранит как день 0
+                if dt.timetuple()[:3] == ((1904, 1, 1) if epoch1904 else (1899, 12, 31)):
+                    row[c] = dt.time()
+                else:
+                    row[c] = dt
+            elif kind == error:
+                row[c] = math.nan
+            elif kind == boolean:
+                row[c] = bool(v)
+        rows.append(row)
+    book.unload_sheet(sheet_name)
+    return rows
+
+
+def _read_rows_openpyxl(book: Any, sheet_name: str) -> List[List[Any]]:
+    """
+    Строки листа .xlsx с пустыми хвостами, обрезанными как в pandas: пустые
+    ячейки в конце строки и пустые строки в конце листа, затем строки
+    дополняются "" до общей ширины.
+    """
+    sheet = book[sheet_name]
+    # read_only доверяет размерам из файла, а они бывают неверными
+    sheet.reset_dimensions()
+    error_codes = frozenset(openpyxl.cell.cell.ERROR_CODES)
+    rows: List[List[Any]] = []
+    last_filled = -1
+    for r, values in enumerate(sheet.iter_rows(values_only=True)):
+        row = []
+        for v in values:
+            if v is None:
+                v = ""
+            elif isinstance(v, float):
+                if v.is_integer():
+                    v = int(v)
+            elif isinstance(v, str) and v in error_codes:
+                v = math.nan
+            row.append(v)
+        while row and row[-1] == "":
+            row.pop()
+        if row:
+            last_filled = r
+        rows.append(row)
+    del rows[last_filled + 1:]
+    width = max((len(row) for row in rows), default=0)
+    for row in rows:
+        row.extend([""] * (width - len(row)))
+    return rows
+
+
+def _trim_to_used_range(sheet: Sheet) -> Sheet:
+    """Обрезает хвостовые пустые строки и колонки (реальный используемый диапазон)."""
+    filled = _filled_mask(sheet.values)
+    if not filled.any():
+        return Sheet(np.empty((0, 0), dtype=object))
+    last_row = int(filled.any(axis=1).nonzero()[0][-1])
+    last_col = int(filled.any(axis=0).nonzero()[0][-1])
+    if last_row + 1 == sheet.shape[0] and last_col + 1 == sheet.shape[1]:
+        return sheet
+    return Sheet(sheet.values[: last_row + 1, : last_col + 1])
+
+
+def _rows_to_sheet(rows: List[List[Any]]) -> Sheet:
+    """Собирает прочитанные строки в Sheet, приводя типы по колонкам."""
+    values = np.empty((len(rows), len(rows[0]) if rows else 0), dtype=object)
+    for c, column in enumerate(zip(*rows)):
+        values[:, c] = _infer_column(column)
+    return _trim_to_used_range(Sheet(values))
 
-    # Ищем лист с корпусом
-    corpus_sheet = _find_sheet_by_keywords(xl, ["плит", "матер", "корпус", "детал", "дсп"])
-    if not corpus_sheet:
-        raise ValueError(f"Не найден лист с корпусными деталями. Доступные листы: {xl.sheet_names}")
 
-    df_corpus = xl.parse(corpus_sheet, header=None)
+def _load_sheet(book: Any, ext: str, sheet_name: str) -> Sheet:
+    """Загружает один лист; лист xlrd сразу выгружается из книги."""
+    if EXCEL_READER == "pandas":
+        df = pd.ExcelFile(book, engine="xlrd" if ext == ".xls" else "openpyxl").parse(sheet_name, header=None)
+        if ext == ".xls":
+            book.unload_sheet(sheet_name)
+        return _trim_to_used_range(Sheet(df.to_numpy(dtype=object)))
+    rows = _read_rows_xlrd(book, sheet_name) if ext == ".xls" else _read_rows_openpyxl(book, sheet_name)
+    return _rows_to_sheet(rows)
 
-    # Ищем лист с фурнитурой (опционально)
-    furniture_sheet = _find_sheet_by_keywords(xl, ["фурнит", "комплект", "метиз"])
-    df_furniture = None
-    if furniture_sheet:
-        df_furniture = xl.parse(furniture_sheet, header=None)
 
-    return df_corpus, df_furniture
+def _read_excel_to_sheets(source: Union[bytes, str], filename: str) -> Tuple[Sheet, Optional[Sheet]]:
+    """
+    Читает Excel и возвращает (лист корпуса, лист фурнитуры).
+    Сначала читаются только имена листов, затем загружаются лишь нужные листы.
+    """
+    ext = os.path.splitext(filename.lower())[1]
+    book = _open_workbook(source, ext)
+
+    try:
+        sheet_names = book.sheet_names() if ext == ".xls" else book.sheetnames
+
+        # Ищем лист с корпусом
+        corpus_sheet = _find_sheet_by_keywords(sheet_names, CORPUS_SHEET_KEYWORDS)
+        if not corpus_sheet:
+            raise ValueError(f"Не найден лист с корпусными деталями. Доступные листы: {sheet_names}")
+
+        # Ищем лист с фурнитурой (опционально)
+        furniture_sheet = _find_sheet_by_keywords(sheet_names, FURNITURE_SHEET_KEYWORDS)
+
+        corpus = _load_sheet(book, ext, corpus_sheet)
+        furniture = _load_sheet(book, ext, furniture_sheet) if furniture_sheet else None
+    finally:
+        if ext == ".xls":
+            book.release_resources()
+        else:
+            book.close()
+
+    return corpus, furniture
+
+
+@dataclass(frozen=True)
+class _CellUfuncs:
+    to_str: Any
+    to_lower: Any
+    is_text: Any
+    is_number: Any
+
+
+@lru_cache(maxsize=None)
+def _cell_ufuncs() -> _CellUfuncs:
+    """Поэлементные функции над object-массивами ячеек; создаются при первом разборе."""
+    return _CellUfuncs(
+        to_str=np.frompyfunc(str, 1, 1),
+        to_lower=np.frompyfunc(str.lower, 1, 1),
+        is_text=np.frompyfunc(lambda v: isinstance(v, str), 1, 1),
+        is_number=np.frompyfunc(lambda v: isinstance(v, (int, float)), 1, 1),
+    )
 
 
-def _find_cell_with_text(df: pd.DataFrame, pattern: str) -> Optional[Tuple[int, int]]:
+class SheetIndex:
+    """
+    Текстовый индекс листа, построенный один раз за проход по всем ячейкам:
+    строковые значения ячеек (как str(v)), их нижний регистр, склеенные строки
+    (" ".join(...), как раньше получали через df.iloc[r].astype(str)) и карта
+    ключевое слово → номера строк, которая заполняется по мере запросов.
+    """
+
+    def __init__(self, sheet: Sheet) -> None:
+        self.shape = sheet.shape
+        self.values = sheet.values
+        self.filled = _filled_mask(self.values)
+        ufuncs = _cell_ufuncs()
+        self.is_text = ufuncs.is_text(self.values).astype(bool)
+        self.cells = ufuncs.to_str(self.values)
+        self.cells_lower = ufuncs.to_lower(self.cells)
+        self.row_text: List[str] = [" ".join(row) for row in self.cells_lower.tolist()]
+        self._postings: Dict[str, List[int]] = {}
+
+    def rows_with(self, keyword: str) -> List[int]:
+        """Номера строк (по возрастанию), склеенный текст которых содержит keyword."""
+        rows = self._postings.get(keyword)
+        if rows is None:
+            rows = [r for r, text in enumerate(self.row_text) if keyword in text]
+            self._postings[keyword] = rows
+        return rows
+
+    def rows_with_any(self, keywords: List[str]) -> Set[int]:
+        found: Set[int] = set()
+        for kw in keywords:
+            found.update(self.rows_with(kw))
+        return found
+
+    def first_row_with(self, keywords: List[str], limit: Optional[int] = None) -> Optional[int]:
+        """Первая строка, содержащая любое из ключевых слов (только среди первых limit строк)."""
+        rows = [r for r in self.rows_with_any(keywords) if limit is None or r < limit]
+        return min(rows) if rows else None
+
+
+def _find_cell_with_text(
+    sheet: Sheet, pattern: str, index: Optional[SheetIndex] = None
+) -> Optional[Tuple[int, int]]:
     """Ищет ячейку по регулярному выражению"""
+    if index is None:
+        index = SheetIndex(sheet)
     pat = re.compile(pattern, re.IGNORECASE)
-    for r in range(df.shape[0]):
-        for c in range(df.shape[1]):
-            v = df.iat[r, c]
-            if isinstance(v, str) and pat.search(v):
-                return r, c
+    for r, c in zip(*np.nonzero(index.is_text)):
+        if pat.search(index.cells[r, c]):
+            return int(r), int(c)
     return None
 
 
@@ -185,155 +2031,155 @@ def _find_column_index(header_row: List[str], keywords: List[str]) -> Optional[i
     return None
 
 
-def _normalize_material_code(code_val: object) -> Optional[str]:
-    """Нормализует код материала в строку без .0."""
-    if code_val is None or pd.isna(code_val):
-        return None
-    if isinstance(code_val, (int, float)) and not isinstance(code_val, bool):
-        return str(int(float(code_val)))
-    code_str = str(code_val).strip()
-    return code_str or None
-
-
-def _extract_thickness_from_name(name: str) -> Optional[int]:
-    if not isinstance(name, str):
-        return None
-    m = re.search(r"(\d+)\s*(?:мм|mm)\b", name.lower())
-    if m:
-        return int(m.group(1))
-    fallback = re.search(r"\b(\d{1,3})\b", name)
-    if fallback:
-        candidate = int(fallback.group(1))
-        if 3 <= candidate <= 60:
-            return candidate
-    return None
-
-
-def _parse_material_dictionary_correct(df: pd.DataFrame) -> Dict[str, Tuple[str, Optional[int]]]:
-    """
-    Парсит справочник материалов согласно вашей логике:
-    - Колонка A: полное название материала
-    - Колонка F (индекс 5): ID материала
-
-    Returns:
-        Dict[ID_материала, (название, толщина_мм)]
-    """
-    material_dict: Dict[str, Tuple[str, Optional[int]]] = {}
-
-    # Ищем начало справочника - первую строку где колонка F содержит число
-    start_row = None
-    for idx in range(min(50, df.shape[0])):
-        if df.shape[1] > 5:
-            val_f = df.iat[idx, 5]
-            val_a = df.iat[idx, 0]
-            if pd.notna(val_f) and pd.notna(val_a):
-                try:
-                    float(val_f)
-                    if isinstance(val_a, str) and len(str(val_a).strip()) > 3:
-                        start_row = idx
-                        logger.info(f"Начало справочника материалов на строке {idx}")
-                        break
-                except Exception:
-                    pass
-
-    if start_row is None:
-        logger.warning("Не найден справочник материалов")
-        return material_dict
-
-    stop_words = ["трудоемкость", "прямые затраты", "итого", "тлщн", "наименование детали"]
-
-    for idx in range(start_row, min(start_row + 100, df.shape[0])):
-        name_val = df.iat[idx, 0] if df.shape[1] > 0 else None
-
-        if pd.isna(name_val):
-            continue
-
-        name_str = str(name_val).strip()
-        name_low = name_str.lower()
-
-        if any(stop in name_low for stop in stop_words):
-            logger.info(f"Конец справочника материалов на строке {idx}: {name_str}")
-            break
-
-        if name_low in ["пластик", "ткань", "фурнитура", "комплектующие"]:
-            continue
-
-        code_val = df.iat[idx, 5] if df.shape[1] > 5 else None
-        code_str = _normalize_material_code(code_val)
-
-        if not code_str:
-            continue
-
-        thickness_mm = _extract_thickness_from_name(name_str)
-
-        if not thickness_mm:
-            try:
-                thickness_mm = int(float(code_str))
-            except Exception:
-                pass
-
-        material_dict[code_str] = (name_str, thickness_mm)
-        logger.debug(f"Материал: ID={code_str}, название={name_str}, толщина={thickness_mm}мм")
-
-    logger.info(f"Справочник материалов: найдено {len(material_dict)} записей")
-    return material_dict
-
-
-def _extract_thickness_from_reference(
-    material_name: Optional[str],
-    reference_id: Optional[str],
-) -> Optional[int]:
-    thickness_mm = _extract_thickness_from_name(material_name or "")
-    if thickness_mm:
-        return thickness_mm
-    if reference_id:
-        match = re.search(r"\d{1,3}", str(reference_id))
-        if match:
-            return int(match.group(0))
-    return None
-
-
-def _apply_material_from_code(
-    row: pd.Series,
-    material_dict: Dict[str, Tuple[str, Optional[int]]],
-) -> Tuple[Optional[str], Optional[int]]:
-    """
-    Определяет материал и толщину детали по ID из столбца B.
-
-    ВАЖНО: Колонка B содержит ID материала из справочника, а НЕ толщину!
-
-    Args:
-        row: строка из таблицы деталей
-        material_dict: словарь {ID: (название, толщина)}
-
-    Returns:
-        (название_материала, толщина_мм)
-    """
-    if row is None or row.shape[0] < 2:
-        return None, None
-
-    material_id_val = row.iloc[1]
-    if pd.isna(material_id_val):
-        return None, None
-
-    material_id = _normalize_material_code(material_id_val)
-
-    if not material_id:
-        return None, None
-
-    material_info = material_dict.get(material_id)
-
-    if material_info:
-        material_name, thickness_mm = material_info
-        logger.debug(f"Найден материал по ID {material_id}: {material_name}, {thickness_mm}мм")
-        return material_name, thickness_mm
-
-    logger.warning(f"Материал с ID {material_id} не найден в справочнике")
-    return None, None
-
-
-def _infer_material(name: str, material_value: Optional[str] = None) -> Optional[str]:
-    """Определяет материал по явному столбцу или по названию детали."""
+def _normalize_material_code(code_val: object) -> Optional[str]:
+    """Нормализует код материала в строку без .0."""
+    if code_val is None or _is_na(code_val):
+        return None
+    if isinstance(code_val, (int, float)) and not isinstance(code_val, bool):
+        return str(int(float(code_val)))
+    code_str = str(code_val).strip()
+    return code_str or None
+
+
+def _extract_thickness_from_name(name: str) -> Optional[int]:
+    if not isinstance(name, str):
+        return None
+    m = re.search(r"(\d+)\s*(?:мм|mm)\b", name.lower())
+    if m:
+        return int(m.group(1))
+    fallback = re.search(r"\b(\d{1,3})\b", name)
+    if fallback:
+        candidate = int(fallback.group(1))
+        if 3 <= candidate <= 60:
+            return candidate
+    return None
+
+
+def _parse_material_dictionary_correct(sheet: Sheet) -> Dict[str, Tuple[str, Optional[int]]]:
+    """
+    Парсит справочник материалов согласно вашей логике:
+    - Колонка A: полное название материала
+    - Колонка F (индекс 5): ID материала
+
+    Returns:
+        Dict[ID_материала, (название, толщина_мм)]
+    """
+    material_dict: Dict[str, Tuple[str, Optional[int]]] = {}
+
+    # Ищем начало справочника - первую строку где колонка F содержит число
+    start_row = None
+    for idx in range(min(50, sheet.shape[0])):
+        if sheet.shape[1] > 5:
+            val_f = sheet.values[idx, 5]
+            val_a = sheet.values[idx, 0]
+            if not _is_na(val_f) and not _is_na(val_a):
+                try:
+                    float(val_f)
+                    if isinstance(val_a, str) and len(str(val_a).strip()) > 3:
+                        start_row = idx
+                        logger.info(f"Начало справочника материалов на строке {idx}")
+                        break
+                except Exception:
+                    pass
+
+    if start_row is None:
+        logger.warning("Не найден справочник материалов")
+        return material_dict
+
+    stop_words = ["трудоемкость", "прямые затраты", "итого", "тлщн", "наименование детали"]
+
+    for idx in range(start_row, min(start_row + 100, sheet.shape[0])):
+        name_val = sheet.values[idx, 0] if sheet.shape[1] > 0 else None
+
+        if _is_na(name_val):
+            continue
+
+        name_str = str(name_val).strip()
+        name_low = name_str.lower()
+
+        if any(stop in name_low for stop in stop_words):
+            logger.info(f"Конец справочника материалов на строке {idx}: {name_str}")
+            break
+
+        if name_low in ["пластик", "ткань", "фурнитура", "комплектующие"]:
+            continue
+
+        code_val = sheet.values[idx, 5] if sheet.shape[1] > 5 else None
+        code_str = _normalize_material_code(code_val)
+
+        if not code_str:
+            continue
+
+        thickness_mm = _extract_thickness_from_name(name_str)
+
+        if not thickness_mm:
+            try:
+                thickness_mm = int(float(code_str))
+            except Exception:
+                pass
+
+        material_dict[code_str] = (name_str, thickness_mm)
+        logger.debug("Материал: ID=%s, название=%s, толщина=%sмм", code_str, name_str, thickness_mm, extra=_PER_ROW)
+
+    logger.info(f"Справочник материалов: найдено {len(material_dict)} записей")
+    return material_dict
+
+
+def _extract_thickness_from_reference(
+    material_name: Optional[str],
+    reference_id: Optional[str],
+) -> Optional[int]:
+    thickness_mm = _extract_thickness_from_name(material_name or "")
+    if thickness_mm:
+        return thickness_mm
+    if reference_id:
+        match = re.search(r"\d{1,3}", str(reference_id))
+        if match:
+            return int(match.group(0))
+    return None
+
+
+def _apply_material_from_code(
+    row: np.ndarray,
+    material_dict: Dict[str, Tuple[str, Optional[int]]],
+) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Определяет материал и толщину детали по ID из столбца B.
+
+    ВАЖНО: Колонка B содержит ID материала из справочника, а НЕ толщину!
+
+    Args:
+        row: строка из таблицы деталей
+        material_dict: словарь {ID: (название, толщина)}
+
+    Returns:
+        (название_материала, толщина_мм)
+    """
+    if row is None or row.shape[0] < 2:
+        return None, None
+
+    material_id_val = row[1]
+    if _is_na(material_id_val):
+        return None, None
+
+    material_id = _normalize_material_code(material_id_val)
+
+    if not material_id:
+        return None, None
+
+    material_info = material_dict.get(material_id)
+
+    if material_info:
+        material_name, thickness_mm = material_info
+        logger.debug("Найден материал по ID %s: %s, %sмм", material_id, material_name, thickness_mm, extra=_PER_ROW)
+        return material_name, thickness_mm
+
+    logger.warning("Материал с ID %s не найден в справочнике", material_id, extra=_PER_ROW)
+    return None, None
+
+
+def _infer_material(name: str, material_value: Optional[str] = None) -> Optional[str]:
+    """Определяет материал по явному столбцу или по названию детали."""
     for source in (material_value, name):
         if not source:
             continue
@@ -344,22 +2190,22 @@ def _infer_material(name: str, material_value: Optional[str] = None) -> Optional
             return "мдф"
         if "лдсп" in text or "дсп" in text:
             return "лдсп"
-    return material_value.strip() if isinstance(material_value, str) and material_value.strip() else None
-
-
-def _material_density_from_name(material_name: Optional[str]) -> int:
-    material_low = (material_name or "").lower()
-    if "мдф" in material_low:
-        return 780
-    if "лдсп" in material_low or "дсп" in material_low:
-        return 680
-    if "хдф" in material_low or "двп" in material_low:
-        return 850
-    return MATERIAL_DENSITY
-
-
-def _determine_material(name: str, thickness_mm: Optional[int], row_context: Optional[str] = None) -> str:
-    """Выбирает материал по толщине, названию и строке исходной таблицы."""
+    return material_value.strip() if isinstance(material_value, str) and material_value.strip() else None
+
+
+def _material_density_from_name(material_name: Optional[str]) -> int:
+    material_low = (material_name or "").lower()
+    if "мдф" in material_low:
+        return 780
+    if "лдсп" in material_low or "дсп" in material_low:
+        return 680
+    if "хдф" in material_low or "двп" in material_low:
+        return 850
+    return MATERIAL_DENSITY
+
+
+def _determine_material(name: str, thickness_mm: Optional[int], row_context: Optional[str] = None) -> str:
+    """Выбирает материал по толщине, названию и строке исходной таблицы."""
 
     name_low = (name or "").lower()
     context_low = (row_context or "").lower() or name_low
@@ -381,149 +2227,226 @@ def _determine_material(name: str, thickness_mm: Optional[int], row_context: Opt
     return material
 
 
-def _parse_corpus_rows_by_header(
-    df: pd.DataFrame, material_dict: Dict[str, Tuple[str, Optional[int]]]
-) -> List[ParsedRow]:
-    """Парсит корпусные детали по явной строке заголовка."""
-    rows: List[ParsedRow] = []
-    start_row: Optional[int] = None
-    header_row = None
-
-    for r in range(df.shape[0]):
-        row_str = " ".join(df.iloc[r].astype(str).str.lower())
-        if (
-            ("тлщн" in row_str or "толщ" in row_str)
-            and "длина" in row_str
-            and ("кол-во" in row_str or "кол " in row_str or "колич" in row_str)
-        ):
-            start_row = r + 1
-            header_row = df.iloc[r]
-            logger.info(f"Найдена строка заголовков корпуса на позиции {r}")
-            break
-
-    if start_row is None or header_row is None:
-        logger.warning("Не найдена строка заголовков таблицы деталей")
-        return rows
-
-    header = header_row.astype(str).str.lower().tolist()
-    name_idx = next((i for i, h in enumerate(header) if "наимен" in h or "детал" in h or "плита" in h or h == ""), 0)
-    thick_idx = next((i for i, h in enumerate(header) if "тлщн" in h or "толщ" in h), None)
-    length_idx = next((i for i, h in enumerate(header) if "длина" in h), None)
-    width_idx = next((i for i, h in enumerate(header) if "ширина" in h), None)
-    qty_idx = next((i for i, h in enumerate(header) if "кол-во" in h or "кол" in h), None)
-
-    logger.info(
-        "Индексы колонок: name=%s, thick(ID)=%s, length=%s, width=%s, qty=%s",
-        name_idx,
-        thick_idx,
-        length_idx,
-        width_idx,
-        qty_idx,
-    )
-
-    for r in range(start_row, df.shape[0]):
-        row = df.iloc[r]
-
-        name = str(row.iloc[name_idx]).strip() if name_idx < len(row) else ""
-
-        if not name or name.lower() in ["nan", "итого", "пластик", "ткань", "фурнитура"] or pd.isna(name):
-            continue
-
-        if any(kw in name.lower() for kw in ["итого", "всего", "трудоемкость", "затраты"]):
-            logger.info(f"Достигнут конец таблицы деталей на строке {r}: {name}")
-            break
-
-        material_name, thickness_mm = _apply_material_from_code(row, material_dict)
-
-        length_mm = None
-        width_mm = None
-        qty = None
-
-        if length_idx is not None and pd.notna(row.iloc[length_idx]):
-            try:
-                length_mm = int(float(row.iloc[length_idx]))
-            except Exception:
-                pass
-
-        if width_idx is not None and pd.notna(row.iloc[width_idx]):
-            try:
-                width_mm = int(float(row.iloc[width_idx]))
-            except Exception:
-                pass
-
-        if qty_idx is not None and pd.notna(row.iloc[qty_idx]):
-            try:
-                qty = float(row.iloc[qty_idx])
-            except Exception:
-                pass
-
-        if not material_name:
-            material_name = _determine_material(name, thickness_mm, " ".join(str(x) for x in row.tolist()))
-
-        if thickness_mm and length_mm and width_mm and qty:
-            rows.append(
-                ParsedRow(
-                    name=name,
-                    thickness_mm=thickness_mm,
-                    length_mm=length_mm,
-                    width_mm=width_mm,
-                    qty=qty,
-                    material=material_name,
-                )
-            )
-            logger.debug(
-                "Деталь: %s, %s, %sмм, %s×%s, qty=%s",
-                name,
-                material_name,
-                thickness_mm,
-                length_mm,
-                width_mm,
-                qty,
-            )
-        else:
-            logger.warning(
-                "Пропущена деталь '%s': недостаточно данных (толщина=%s, размеры=%sx%s, qty=%s)",
-                name,
-                thickness_mm,
-                length_mm,
-                width_mm,
-                qty,
-            )
-
-    return rows
-
-
-def _parse_corpus_rows_heuristic(
-    df: pd.DataFrame, material_dict: Dict[str, Tuple[str, Optional[int]]]
-) -> List[ParsedRow]:
+def _parse_corpus_rows_by_header(
+    sheet: Sheet,
+    material_dict: Dict[str, Tuple[str, Optional[int]]],
+    index: Optional[SheetIndex] = None,
+) -> List[ParsedRow]:
+    """Парсит корпусные детали по явной строке заголовка."""
+    if index is None:
+        index = SheetIndex(sheet)
+    rows: List[ParsedRow] = []
+
+    header_candidates = (
+        index.rows_with_any(["тлщн", "толщ"])
+        & set(index.rows_with("длина"))
+        & index.rows_with_any(["кол-во", "кол ", "колич"])
+    )
+    if not header_candidates:
+        logger.warning("Не найдена строка заголовков таблицы деталей")
+        return rows
+
+    header_r = min(header_candidates)
+    start_row = header_r + 1
+    logger.info(f"Найдена строка заголовков корпуса на позиции {header_r}")
+
+    header = index.cells_lower[header_r].tolist()
+    name_idx = next((i for i, h in enumerate(header) if "наимен" in h or "детал" in h or "плита" in h or h == ""), 0)
+    thick_idx = next((i for i, h in enumerate(header) if "тлщн" in h or "толщ" in h), None)
+    length_idx = next((i for i, h in enumerate(header) if "длина" in h), None)
+    width_idx = next((i for i, h in enumerate(header) if "ширина" in h), None)
+    qty_idx = next((i for i, h in enumerate(header) if "кол-во" in h or "кол" in h), None)
+
+    logger.info(
+        "Индексы колонок: name=%s, thick(ID)=%s, length=%s, width=%s, qty=%s",
+        name_idx,
+        thick_idx,
+        length_idx,
+        width_idx,
+        qty_idx,
+    )
+
+    return _extract_corpus_rows_columnar(
+        index, start_row, name_idx, length_idx, width_idx, qty_idx, material_dict
+    )
+
+
+def _coerce_float_column(values: np.ndarray, filled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Поколоночный аналог float(v) для непустых ячеек.
+    Возвращает (значения, маска успешного преобразования); числа приводятся
+    одной операцией, строки и прочие значения — поштучно через float().
+    """
+    out = np.full(values.shape[0], np.nan)
+    numeric = filled & _cell_ufuncs().is_number(values).astype(bool)
+    out[numeric] = values[numeric].astype(float)
+    valid = numeric.copy()
+    for i in np.flatnonzero(filled & ~numeric):
+        try:
+            out[i] = float(values[i])
+            valid[i] = True
+        except Exception:
+            pass
+    return out, valid
+
+
+def _coerce_int_column(values: np.ndarray, filled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Поколоночный аналог int(float(v)): значения усечены до целого, но остаются float
+    (int() применяется при создании строки), NaN и бесконечности считаются непреобразуемыми.
+    """
+    floats, valid = _coerce_float_column(values, filled)
+    valid &= np.isfinite(floats)
+    return np.trunc(np.where(valid, floats, 0)), valid
+
+
+def _extract_corpus_rows_columnar(
+    index: SheetIndex,
+    start_row: int,
+    name_idx: int,
+    length_idx: Optional[int],
+    width_idx: Optional[int],
+    qty_idx: Optional[int],
+    material_dict: Dict[str, Tuple[str, Optional[int]]],
+) -> List[ParsedRow]:
+    """
+    Извлекает детали по известным колонкам заголовка целыми столбцами:
+    длина/ширина/количество приводятся векторно, ID материалов (колонка B)
+    сопоставляются со справочником одним map, а ParsedRow создаются только
+    для прошедших проверку строк. Результат совпадает с построчным разбором.
+    """
+    n_rows, n_cols = index.shape
+    if name_idx >= n_cols:
+        return []
+
+    # Границы таблицы: пропускаем пустые/служебные названия, останавливаемся на итогах
+    skip_names = ["nan", "итого", "пластик", "ткань", "фурнитура"]
+    stop_words = ["итого", "всего", "трудоемкость", "затраты"]
+    table_rows: List[int] = []
+    names: List[str] = []
+    for offset, raw_name in enumerate(index.cells[start_row:, name_idx].tolist()):
+        name = raw_name.strip()
+        name_low = name.lower()
+        if not name or name_low in skip_names:
+            continue
+        if any(kw in name_low for kw in stop_words):
+            logger.info(f"Достигнут конец таблицы деталей на строке {start_row + offset}: {name}")
+            break
+        table_rows.append(start_row + offset)
+        names.append(name)
+
+    if not table_rows:
+        return []
+
+    row_idx = np.asarray(table_rows)
+
+    def _int_column(col_idx: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        if col_idx is None:
+            return np.zeros(len(row_idx)), np.zeros(len(row_idx), dtype=bool)
+        return _coerce_int_column(index.values[row_idx, col_idx], index.filled[row_idx, col_idx])
+
+    lengths, length_valid = _int_column(length_idx)
+    widths, width_valid = _int_column(width_idx)
+    if qty_idx is not None:
+        qtys, qty_valid = _coerce_float_column(index.values[row_idx, qty_idx], index.filled[row_idx, qty_idx])
+    else:
+        qtys, qty_valid = np.full(len(row_idx), np.nan), np.zeros(len(row_idx), dtype=bool)
+
+    # ID материала всегда в колонке B
+    if n_cols >= 2:
+        material_ids = [_normalize_material_code(v) for v in index.values[row_idx, 1]]
+        material_info = [material_dict.get(m) for m in material_ids]
+    else:
+        material_ids = [None] * len(row_idx)
+        material_info = [None] * len(row_idx)
+
+    passed = (
+        length_valid & (lengths != 0)
+        & width_valid & (widths != 0)
+        & qty_valid & (qtys != 0)
+    )
+
+    rows: List[ParsedRow] = []
+    for i, r in enumerate(table_rows):
+        name = names[i]
+        info = material_info[i]
+        material_name, thickness_mm = info if isinstance(info, tuple) else (None, None)
+        if material_ids[i] and not isinstance(info, tuple):
+            logger.warning("Материал с ID %s не найден в справочнике", material_ids[i], extra=_PER_ROW)
+
+        length_mm = int(lengths[i]) if length_valid[i] else None
+        width_mm = int(widths[i]) if width_valid[i] else None
+        qty = float(qtys[i]) if qty_valid[i] else None
+
+        if thickness_mm and passed[i]:
+            if not material_name:
+                material_name = _determine_material(name, thickness_mm, " ".join(index.cells[r]))
+            rows.append(
+                ParsedRow(
+                    name=name,
+                    thickness_mm=thickness_mm,
+                    length_mm=length_mm,
+                    width_mm=width_mm,
+                    qty=qty,
+                    material=material_name,
+                )
+            )
+            logger.debug(
+                "Деталь: %s, %s, %sмм, %s×%s, qty=%s",
+                name,
+                material_name,
+                thickness_mm,
+                length_mm,
+                width_mm,
+                qty,
+                extra=_PER_ROW,
+            )
+        else:
+            logger.warning(
+                "Пропущена деталь '%s': недостаточно данных (толщина=%s, размеры=%sx%s, qty=%s)",
+                name,
+                thickness_mm,
+                length_mm,
+                width_mm,
+                qty,
+                extra=_PER_ROW,
+            )
+
+    return rows
+
+
+def _parse_corpus_rows_heuristic(
+    sheet: Sheet,
+    material_dict: Dict[str, Tuple[str, Optional[int]]],
+    index: Optional[SheetIndex] = None,
+) -> List[ParsedRow]:
     """
     Парсит корпусные детали из таблицы.
     Улучшенная версия: ищет строку с "Тлщн" или "Толщ" как начало таблицы
     """
+    if index is None:
+        index = SheetIndex(sheet)
+
     # ДИАГНОСТИКА: выводим первые 20 строк для понимания структуры
-    logger.info(f"DataFrame shape: {df.shape}")
-    for r in range(min(20, df.shape[0])):
-        row_preview = " | ".join(str(df.iloc[r, c])[:30] for c in range(min(8, df.shape[1])))
-        logger.debug(f"Row {r}: {row_preview}")
+    logger.info(f"Размер листа: {sheet.shape}")
+    for r in range(min(20, sheet.shape[0])):
+        row_preview = " | ".join(index.cells[r, c][:30] for c in range(min(8, sheet.shape[1])))
+        logger.debug("Row %s: %s", r, row_preview, extra=_PER_ROW)
     
-    # Ищем начало таблицы — строку с заголовками
-    start_row = None
-    for r in range(min(100, df.shape[0])):
-        row_str = " ".join(df.iloc[r].astype(str).tolist()).lower()
-        # Расширенный список ключевых слов
-        keywords = ["тлщн", "толщ", "thickness", "наимен", "детал", "плита", "дсп", "длин", "ширин"]
-        if any(kw in row_str for kw in keywords):
-            logger.info(f"Найдена строка заголовков на позиции {r}: {row_str[:100]}")
-            start_row = r
-            break
+    # Ищем начало таблицы — строку с заголовками (расширенный список ключевых слов)
+    keywords = ["тлщн", "толщ", "thickness", "наимен", "детал", "плита", "дсп", "длин", "ширин"]
+    start_row = index.first_row_with(keywords, limit=100)
+    if start_row is not None:
+        logger.info(f"Найдена строка заголовков на позиции {start_row}: {index.row_text[start_row][:100]}")
     
     if start_row is None:
         logger.warning("Не найдена строка заголовков по ключевым словам")
         # Пробуем найти первую строку с числовыми данными
-        for r in range(min(50, df.shape[0])):
-            row_data = df.iloc[r]
+        for r in range(min(50, sheet.shape[0])):
             # Ищем строку где есть хотя бы 2 числа (размеры)
-            num_count = sum(1 for v in row_data if pd.notna(v) and str(v).strip().isdigit())
+            num_count = sum(
+                1 for c in range(sheet.shape[1]) if index.filled[r, c] and index.cells[r, c].strip().isdigit()
+            )
             if num_count >= 2:
                 logger.info(f"Найдена потенциальная строка данных на позиции {r}, начинаем оттуда")
                 start_row = max(0, r - 1)  # заголовок обычно перед данными
@@ -533,7 +2456,7 @@ def _parse_corpus_rows_heuristic(
             logger.error("Не удалось найти начало таблицы")
             start_row = 0
 
-    header_row = df.iloc[start_row].fillna("").astype(str).tolist()
+    header_row = np.where(index.filled[start_row], index.cells[start_row], "").tolist()
     logger.info(f"Заголовки: {header_row[:10]}")
 
     # Определяем колонки
@@ -549,16 +2472,16 @@ def _parse_corpus_rows_heuristic(
     if name_idx is None:
         name_idx = 0
     if qty_idx is None:
-        qty_idx = min(5, df.shape[1] - 1)
+        qty_idx = min(5, sheet.shape[1] - 1)
 
     rows: List[ParsedRow] = []
     empty_streak = 0
 
-    for r in range(start_row + 1, df.shape[0]):
-        row_data = df.iloc[r]
-        name_v = row_data.iloc[name_idx] if name_idx < df.shape[1] else None
+    for r in range(start_row + 1, sheet.shape[0]):
+        row_data = sheet.values[r]
+        name_v = row_data[name_idx] if name_idx < sheet.shape[1] else None
         
-        if pd.isna(name_v) or (isinstance(name_v, str) and not name_v.strip()):
+        if _is_na(name_v) or (isinstance(name_v, str) and not name_v.strip()):
             empty_streak += 1
             if empty_streak >= 5:
                 break
@@ -570,55 +2493,53 @@ def _parse_corpus_rows_heuristic(
         if any(kw in name.lower() for kw in ["итого", "всего", "total", "сумма"]):
             continue
         
-        empty_streak = 0
-
-        # Толщина
-        material_name, thickness_mm = _apply_material_from_code(row_data, material_dict)
+        empty_streak = 0
+
+        # Толщина
+        material_name, thickness_mm = _apply_material_from_code(row_data, material_dict)
 
         # Размеры - несколько стратегий
         length_mm = None
         width_mm = None
 
         # Стратегия 1: отдельные колонки длина и ширина
-        if length_idx is not None and length_idx < df.shape[1]:
-            lv = row_data.iloc[length_idx]
-            if pd.notna(lv):
+        if length_idx is not None and length_idx < sheet.shape[1]:
+            lv = row_data[length_idx]
+            if not _is_na(lv):
                 try:
                     length_mm = int(float(lv))
                 except:
                     pass
 
-        if width_idx is not None and width_idx < df.shape[1]:
-            wv = row_data.iloc[width_idx]
-            if pd.notna(wv):
+        if width_idx is not None and width_idx < sheet.shape[1]:
+            wv = row_data[width_idx]
+            if not _is_na(wv):
                 try:
                     width_mm = int(float(wv))
                 except:
                     pass
 
         # Стратегия 2: колонка "Размер" с форматом "2800x600"
-        if (length_mm is None or width_mm is None) and size_idx is not None and size_idx < df.shape[1]:
-            sv = row_data.iloc[size_idx]
-            if pd.notna(sv) and isinstance(sv, str):
+        if (length_mm is None or width_mm is None) and size_idx is not None and size_idx < sheet.shape[1]:
+            sv = row_data[size_idx]
+            if not _is_na(sv) and isinstance(sv, str):
                 size = _extract_size_from_text(sv)
                 if size:
                     length_mm, width_mm = size
 
-        # Стратегия 3: сканируем всю строку на наличие размера
+        # Стратегия 3: сканируем текстовые ячейки строки на наличие размера
         if length_mm is None or width_mm is None:
-            for c in range(df.shape[1]):
-                v = row_data.iloc[c]
-                if isinstance(v, str):
-                    size = _extract_size_from_text(v)
-                    if size:
-                        length_mm, width_mm = size
-                        break
+            for c in np.flatnonzero(index.is_text[r]):
+                size = _extract_size_from_text(index.cells[r, c])
+                if size:
+                    length_mm, width_mm = size
+                    break
 
         # Количество
         qty = None
-        if qty_idx < df.shape[1]:
-            qv = row_data.iloc[qty_idx]
-            if pd.notna(qv):
+        if qty_idx < sheet.shape[1]:
+            qv = row_data[qty_idx]
+            if not _is_na(qv):
                 try:
                     qty = float(qv)
                 except:
@@ -626,13 +2547,13 @@ def _parse_corpus_rows_heuristic(
 
         # Материал
         material_value = None
-        if mat_idx is not None and mat_idx < df.shape[1]:
-            mv = row_data.iloc[mat_idx]
-            if pd.notna(mv):
+        if mat_idx is not None and mat_idx < sheet.shape[1]:
+            mv = row_data[mat_idx]
+            if not _is_na(mv):
                 material_value = str(mv).strip()
 
-        row_context = " ".join(str(x) for x in row_data.tolist())
-        material = material_name or _determine_material(name, thickness_mm, row_context if material_value is None else material_value)
+        row_context = " ".join(index.cells[r])
+        material = material_name or _determine_material(name, thickness_mm, row_context if material_value is None else material_value)
 
         # Добавляем только если есть хоть что-то осмысленное
         if thickness_mm or length_mm or width_mm or qty:
@@ -644,92 +2565,92 @@ def _parse_corpus_rows_heuristic(
                 qty=qty,
                 material=material
             ))
-            logger.debug(f"Добавлена деталь: {name}, {thickness_mm}мм, {length_mm}×{width_mm}, qty={qty}")
+            logger.debug(
+                "Добавлена деталь: %s, %sмм, %s×%s, qty=%s", name, thickness_mm, length_mm, width_mm, qty, extra=_PER_ROW
+            )
 
     logger.info(f"Всего распознано деталей: {len(rows)}")
     return rows
 
 
-def _parse_corpus_rows(df: pd.DataFrame) -> List[ParsedRow]:
-    """Основная функция парсинга с детальным логированием"""
-    logger.info("=" * 60)
-    logger.info("НАЧАЛО ПАРСИНГА КОРПУСНЫХ ДЕТАЛЕЙ")
-    logger.info("=" * 60)
-
-    material_dict = _parse_material_dictionary_correct(df)
-
-    if not material_dict:
-        logger.error("КРИТИЧЕСКАЯ ОШИБКА: Справочник материалов пуст!")
-        logger.error("Первые 30 строк файла:")
-        for i in range(min(30, df.shape[0])):
-            logger.error("Row %s: %s", i, df.iloc[i, :6].tolist())
-    else:
-        logger.info("Справочник материалов загружен: %s записей", len(material_dict))
-        for mat_id, (mat_name, thickness) in material_dict.items():
-            logger.info("  ID %s: %s (%sмм)", mat_id, mat_name, thickness)
-
-    rows = _parse_corpus_rows_by_header(df, material_dict)
-
-    if rows:
-        logger.info("✓ Парсинг по заголовку собрал %s деталей", len(rows))
-    else:
-        logger.warning("✗ Парсинг по заголовку не дал результатов, пробуем эвристику")
-        rows = _parse_corpus_rows_heuristic(df, material_dict)
-
-        if rows:
-            logger.info("✓ Эвристический парсинг собрал %s деталей", len(rows))
-        else:
-            logger.error("✗ НЕ УДАЛОСЬ РАСПОЗНАТЬ НИ ОДНОЙ ДЕТАЛИ!")
-
-    for r in rows:
-        if r.name and "фанера" in r.name.lower() and not r.material:
-            r.material = "фанера"
-
-    logger.info("=" * 60)
-    logger.info("ИТОГО РАСПОЗНАНО: %s деталей", len(rows))
-    logger.info("=" * 60)
-
-    return rows
-
-
-def _parse_furniture_rows(df: pd.DataFrame) -> List[FurnitureItem]:
+def _parse_corpus_rows(sheet: Sheet, index: Optional[SheetIndex] = None) -> List[ParsedRow]:
+    """Основная функция парсинга с детальным логированием"""
+    if index is None:
+        index = SheetIndex(sheet)
+    logger.info("Начало парсинга корпусных деталей")
+
+    with STAGE_STATS.stage("material_dict"):
+        material_dict = _parse_material_dictionary_correct(sheet)
+
+    if not material_dict:
+        logger.error("КРИТИЧЕСКАЯ ОШИБКА: Справочник материалов пуст!")
+        logger.error("Первые 30 строк файла:")
+        for i in range(min(30, sheet.shape[0])):
+            logger.error("Row %s: %s", i, sheet.values[i, :6].tolist(), extra=_PER_ROW)
+    else:
+        logger.info("Справочник материалов загружен: %s записей", len(material_dict))
+        for mat_id, (mat_name, thickness) in material_dict.items():
+            logger.debug("  ID %s: %s (%sмм)", mat_id, mat_name, thickness, extra=_PER_ROW)
+
+    with STAGE_STATS.stage("corpus_parse"):
+        rows = _parse_corpus_rows_by_header(sheet, material_dict, index)
+
+        if rows:
+            logger.info("✓ Парсинг по заголовку собрал %s деталей", len(rows))
+        else:
+            logger.warning("✗ Парсинг по заголовку не дал результатов, пробуем эвристику")
+            rows = _parse_corpus_rows_heuristic(sheet, material_dict, index)
+
+            if rows:
+                logger.info("✓ Эвристический парсинг собрал %s деталей", len(rows))
+            else:
+                logger.error("✗ НЕ УДАЛОСЬ РАСПОЗНАТЬ НИ ОДНОЙ ДЕТАЛИ!")
+
+    for r in rows:
+        if r.name and "фанера" in r.name.lower() and not r.material:
+            r.material = "фанера"
+
+    logger.info("Итого распознано: %s деталей", len(rows))
+
+    return rows
+
+
+def _parse_furniture_rows(sheet: Sheet, index: Optional[SheetIndex] = None) -> List[FurnitureItem]:
     """Парсит только реальную фурнитуру, исключает итоги и затраты"""
+    if index is None:
+        index = SheetIndex(sheet)
     items = []
-    start_row = None
-    for r in range(df.shape[0]):
-        row_str = ' '.join(df.iloc[r].astype(str).str.lower())
-        if 'код фурнитуры' in row_str or 'наименование фурнитуры' in row_str:
-            start_row = r + 1
-            header = df.iloc[r].astype(str).str.lower()
-            code_idx = header[header.str.contains('код')].index[0] if any(header.str.contains('код')) else None
-            name_idx = header[header.str.contains('наимен')].index[0] if any(header.str.contains('наимен')) else 3
-            qty_idx = header[header.str.contains('кол')].index[0] if any(header.str.contains('кол')) else None
-            unit_idx = header[header.str.contains('ед')].index[0] if any(header.str.contains('ед')) else None
-            break
-
-    if start_row is None:
+    header_r = index.first_row_with(['код фурнитуры', 'наименование фурнитуры'])
+    if header_r is None:
         return items
 
-    for r in range(start_row, df.shape[0]):
-        row = df.iloc[r]
-        name = str(row.iloc[name_idx]).strip() if name_idx < len(row) else ""
+    start_row = header_r + 1
+    header = index.cells_lower[header_r].tolist()
+    code_idx = next((i for i, h in enumerate(header) if 'код' in h), None)
+    name_idx = next((i for i, h in enumerate(header) if 'наимен' in h), 3)
+    qty_idx = next((i for i, h in enumerate(header) if 'кол' in h), None)
+    unit_idx = next((i for i, h in enumerate(header) if 'ед' in h), None)
+    n_cols = sheet.shape[1]
+
+    for r in range(start_row, sheet.shape[0]):
+        name = index.cells[r, name_idx].strip() if name_idx < n_cols else ""
         if (
             not name
             or name.lower() in ['итого', 'рублевая', 'валютная', 'затраты', 'составляющая']
-            or pd.isna(name)
+            or _is_na(name)
             or 'рублев' in name.lower()
             or 'валютн' in name.lower()
             or 'затрат' in name.lower()
         ):
             continue
 
-        code = str(row.iloc[code_idx]).strip() if code_idx is not None and code_idx < len(row) else None
-        unit = str(row.iloc[unit_idx]).strip() if unit_idx is not None and unit_idx < len(row) else "шт"
+        code = index.cells[r, code_idx].strip() if code_idx is not None and code_idx < n_cols else None
+        unit = index.cells[r, unit_idx].strip() if unit_idx is not None and unit_idx < n_cols else "шт"
 
         qty = None
-        if qty_idx is not None and qty_idx < len(row):
+        if qty_idx is not None and qty_idx < n_cols:
             try:
-                qty = float(row.iloc[qty_idx])
+                qty = float(index.values[r, qty_idx])
             except:
                 pass
 
@@ -739,11 +2660,13 @@ def _parse_furniture_rows(df: pd.DataFrame) -> List[FurnitureItem]:
     return items
 
 
-def _extract_dimensions_from_cell(df: pd.DataFrame) -> Optional[Tuple[int, int, int]]:
+def _extract_dimensions_from_cell(sheet: Sheet) -> Optional[Tuple[int, int, int]]:
     """Читает габариты из ячейки A43 (индекс 42) в формате Ш*Г*В."""
     try:
-        cell_value = df.iat[42, 0]
-        if pd.notna(cell_value) and isinstance(cell_value, str):
+        if sheet.shape[0] <= 42 or sheet.shape[1] == 0:
+            return None
+        cell_value = sheet.values[42, 0]
+        if not _is_na(cell_value) and isinstance(cell_value, str):
             m = re.search(r"(\d{3,4})\s*[*хx×]\s*(\d{3,4})\s*[*хx×]\s*(\d{3,4})", cell_value)
             if m:
                 width = int(m.group(1))
@@ -756,196 +2679,266 @@ def _extract_dimensions_from_cell(df: pd.DataFrame) -> Optional[Tuple[int, int,
     return None
 
 
-def _infer_geometry_smart(df: pd.DataFrame, rows: List[ParsedRow]) -> Tuple[int, int, int, int, int]:
+# Уверенность стратегий определения габаритов. Значения экспертные, а не
+# статистические: они лишь упорядочивают стратегии по надёжности и подобраны на
+# книгах из specifications_examples/. Габарит, записанный в ячейке A43 или в
+# названии, задан конструктором явно; задняя стенка даёт высоту и ширину секции
+# точно, а глубину — только вместе с крышкой/дном (иначе берётся 600 мм наугад).
+# Частотный анализ начинается с базы и растёт с долей самых частых размеров:
+# даже при полном совпадении (0.7) он остаётся ниже задней стенки с глубиной.
+GEOMETRY_CONFIDENCE_CELL = 0.95
+GEOMETRY_CONFIDENCE_NAME = 0.9
+GEOMETRY_CONFIDENCE_BACK_WALL = 0.8
+GEOMETRY_CONFIDENCE_BACK_WALL_NO_DEPTH = 0.65
+GEOMETRY_CONFIDENCE_HISTOGRAM_BASE = 0.2
+GEOMETRY_CONFIDENCE_HISTOGRAM_SHARE = 0.4  # × средняя доля мод высоты, глубины и ширины
+GEOMETRY_CONFIDENCE_HISTOGRAM_HEIGHT = 0.1  # высота нашлась среди типичных 2000–3000 мм
+GEOMETRY_CONFIDENCE_DEFAULT = 0.0
+
+
+@dataclass
+class GeometryGuess:
+    """Габариты изделия, стратегия, которой они найдены, и уверенность 0…1."""
+
+    width_total_mm: int
+    depth_mm: int
+    height_mm: int
+    sections_count: int
+    section_width_mm: int
+    strategy: str
+    confidence: float
+
+    def as_tuple(self) -> Tuple[int, int, int, int, int]:
+        return self.width_total_mm, self.depth_mm, self.height_mm, self.sections_count, self.section_width_mm
+
+
+class GeometrySignals:
     """
-    Умное определение габаритов
-    1. Ищем строку с габаритом вида "3000х600х2800"
-    2. Анализируем задние стенки
-    3. Анализируем крышки/днища для определения глубины
+    Всё, из чего выводятся габариты, собранное за один проход по строкам:
+    первый габарит в названии, первые задние стенки и крышки/днища, гистограммы
+    высот, глубин и ширин секций. Проход линейный, моды берутся из Counter, так
+    что время не зависит квадратично от числа деталей.
     """
-    
-    logger.info(f"Начинаем определение габаритов из {len(rows)} строк")
-
-    # Стратегия 0: фиксированная ячейка A43
-    dims = _extract_dimensions_from_cell(df)
-    if dims:
-        width_total, depth, height = dims
-        back_walls = [r for r in rows if r.name and "задн" in r.name.lower() and r.qty]
-        sections = int(back_walls[0].qty) if back_walls else 1
-        section_width = width_total // sections if sections else width_total
-        return width_total, depth, height, sections, section_width
-    
-    # Стратегия 1: ищем габарит в названии строки
-    for row in rows:
-        if row.name and isinstance(row.name, str):
+
+    def __init__(self) -> None:
+        self.name_dims: Optional[Tuple[int, int, int]] = None
+        self.back_wall_qty: Optional[ParsedRow] = None  # первая задняя стенка с количеством
+        self.back_wall: Optional[ParsedRow] = None  # первая задняя стенка с размерами и количеством
+        self.back_walls = 0
+        self.top_bottom_depth: Optional[int] = None  # глубина по первой крышке/дну 300–800 мм
+        self.top_bottom_qty: Optional[float] = None  # количество первой крышки/дна
+        self.heights: Counter = Counter()
+        self.depths: Counter = Counter()
+        self.widths: Counter = Counter()
+        self.tall_lengths: Counter = Counter()  # длины > 1500 мм — запасной вариант для высоты
+        self.rows = 0
+
+    def add(self, row: ParsedRow) -> None:
+        self.rows += 1
+        name = row.name.lower() if row.name else ""
+        length, width, qty = row.length_mm, row.width_mm, row.qty
+
+        if self.name_dims is None and name:
             m = ГАБАРИТ_RE.search(row.name)
             if m:
-                w, d, h = int(m.group(1)), int(m.group(2)), int(m.group(3))
-                logger.info(f"Найден габарит в названии: {w}x{d}x{h}")
-                # Пытаемся определить количество секций
-                sections = 1
-                section_width = w
-                back_walls = [r for r in rows if r.name and "задн" in r.name.lower() and r.qty]
-                if back_walls and back_walls[0].qty:
-                    sections = int(back_walls[0].qty)
-                    section_width = w // sections
-                return w, d, h, sections, section_width
-
-    # Стратегия 2: анализируем задние стенки
-    back_walls = [r for r in rows 
-                  if r.name and "задн" in r.name.lower() 
-                  and r.length_mm and r.width_mm and r.qty]
-    
-    logger.info(f"Найдено задних стенок: {len(back_walls)}")
-    
-    if back_walls:
-        bw = back_walls[0]
-        logger.info(f"Задняя стенка: {bw.name}, {bw.length_mm}x{bw.width_mm}, qty={bw.qty}")
-        # Задняя стенка обычно: высота × ширина_секции
-        height = bw.length_mm
-        section_width = bw.width_mm
-        sections = int(bw.qty)
-        width_total = section_width * sections
-        
-        # Глубину определяем из крышек/дна или боковин
-        depth = 600  # дефолт
-        top_bottom = [r for r in rows 
-                     if r.name and any(kw in r.name.lower() for kw in ["крышк", "дно", "top", "bottom"])
-                     and r.width_mm and 300 <= r.width_mm <= 800]
-        if top_bottom:
-            depth = top_bottom[0].width_mm
-            logger.info(f"Глубина из крышки/дна: {depth}")
-        
-        logger.info(f"Габарит из задней стенки: {width_total}x{depth}x{height}, секций: {sections}")
-        return width_total, depth, height, sections, section_width
+                self.name_dims = int(m.group(1)), int(m.group(2)), int(m.group(3))
+
+        role = row.role
+        if role & PartRole.BACK and qty:
+            self.back_walls += 1
+            if self.back_wall_qty is None:
+                self.back_wall_qty = row
+            if self.back_wall is None and length and width:
+                self.back_wall = row
+
+        if role & PartRole.TOP_BOTTOM:
+            if self.top_bottom_qty is None and qty:
+                self.top_bottom_qty = qty
+            if self.top_bottom_depth is None and width and 300 <= width <= 800:
+                self.top_bottom_depth = width
+        elif self.top_bottom_depth is None and ("top" in name or "bottom" in name) and width and 300 <= width <= 800:
+            self.top_bottom_depth = width
+
+        if length and length > 1500:
+            self.tall_lengths[length] += 1
+        if not length or not width:
+            return
+        if 2000 <= length <= 3000:
+            self.heights[length] += 1
+        if 300 <= width <= 700:
+            self.depths[width] += 1
+        if 600 <= width <= 1200:
+            self.widths[width] += 1
+
+    def _sections_from_back_wall(self, width_total: int) -> Tuple[int, int]:
+        if self.back_wall_qty is None:
+            return 1, width_total
+        sections = int(self.back_wall_qty.qty)
+        return sections, width_total // sections if sections else width_total
+
+    @staticmethod
+    def _mode(counter: Counter, default: int) -> Tuple[int, float]:
+        """Самое частое значение (при равенстве — встреченное первым) и его доля."""
+        if not counter:
+            return default, 0.0
+        value, count = counter.most_common(1)[0]
+        return value, count / sum(counter.values())
+
+    def choose(self, cell_dims: Optional[Tuple[int, int, int]]) -> GeometryGuess:
+        """
+        Стратегии по убыванию надёжности: ячейка A43, габарит в названии,
+        задняя стенка, частотный анализ размеров, значения по умолчанию.
+        Уверенность частотного анализа растёт с долей самых частых значений.
+        """
+        if cell_dims:
+            width_total, depth, height = cell_dims
+            sections, section_width = self._sections_from_back_wall(width_total)
+            return GeometryGuess(width_total, depth, height, sections, section_width, "cell_a43", GEOMETRY_CONFIDENCE_CELL)
+
+        if self.name_dims:
+            w, d, h = self.name_dims
+            logger.info(f"Найден габарит в названии: {w}x{d}x{h}")
+            sections, section_width = self._sections_from_back_wall(w)
+            return GeometryGuess(w, d, h, sections, section_width, "name", GEOMETRY_CONFIDENCE_NAME)
+
+        logger.info(f"Найдено задних стенок: {self.back_walls}")
+        if self.back_wall is not None:
+            bw = self.back_wall
+            logger.info(f"Задняя стенка: {bw.name}, {bw.length_mm}x{bw.width_mm}, qty={bw.qty}")
+            # Задняя стенка обычно: высота × ширина_секции
+            sections = int(bw.qty)
+            depth = self.top_bottom_depth or 600
+            if self.top_bottom_depth:
+                logger.info(f"Глубина из крышки/дна: {depth}")
+            logger.info(f"Габарит из задней стенки: {bw.width_mm * sections}x{depth}x{bw.length_mm}, секций: {sections}")
+            return GeometryGuess(
+                bw.width_mm * sections, depth, bw.length_mm, sections, bw.width_mm,
+                "back_wall",
+                GEOMETRY_CONFIDENCE_BACK_WALL if self.top_bottom_depth else GEOMETRY_CONFIDENCE_BACK_WALL_NO_DEPTH,
+            )
 
-    # Стратегия 3: общий анализ размеров
-    logger.info("Задние стенки не найдены, анализируем все детали")
-    
-    heights = []
-    widths = []
-    depths = []
-    
-    for r in rows:
-        if not r.length_mm or not r.width_mm:
-            continue
-        
-        logger.debug(f"Анализ детали: {r.name}, {r.length_mm}x{r.width_mm}")
-        
-        # Высоты (обычно 2000-3000)
-        if 2000 <= r.length_mm <= 3000:
-            heights.append(r.length_mm)
-        
-        # Глубины (обычно 300-700)
-        if 300 <= r.width_mm <= 700:
-            depths.append(r.width_mm)
-        
-        # Ширины секций (обычно 600-1200)
-        if 600 <= r.width_mm <= 1200:
-            widths.append(r.width_mm)
-    
-    logger.info(f"Найдено высот: {len(heights)}, глубин: {len(depths)}, ширин: {len(widths)}")
-    
-    if not heights:
-        # НОВАЯ СТРАТЕГИЯ: пробуем любые размеры > 1500 как высоту
-        for r in rows:
-            if r.length_mm and r.length_mm > 1500:
-                heights.append(r.length_mm)
-        
+        logger.info("Задние стенки не найдены, анализируем все детали")
+        logger.info(
+            f"Найдено высот: {sum(self.heights.values())}, глубин: {sum(self.depths.values())}, "
+            f"ширин: {sum(self.widths.values())}"
+        )
+        heights = self.heights or self.tall_lengths
         if not heights:
             logger.error("Не удалось найти высоту шкафа ни одним способом")
-            # Возвращаем дефолтные значения вместо ошибки
             logger.warning("Использую дефолтные габариты: 3000x600x2800")
-            return 3000, 600, 2800, 3, 1000
-    
-    height = max(set(heights), key=heights.count) if heights else 2800
-    depth = max(set(depths), key=depths.count) if depths else 600
-    section_width = max(set(widths), key=widths.count) if widths else 1000
-    
-    # Пытаемся угадать количество секций
-    sections = 1
-    top_bottom = [r for r in rows if r.name and any(kw in r.name.lower() for kw in ["крышк", "дно"]) and r.qty]
-    if top_bottom and top_bottom[0].qty:
-        sections = max(1, int(top_bottom[0].qty / 2))
-    
-    width_total = section_width * sections
-    
-    logger.info(f"Габарит из общего анализа: {width_total}x{depth}x{height}, секций: {sections}")
-    return width_total, depth, height, sections, section_width
+            return GeometryGuess(3000, 600, 2800, 3, 1000, "default", GEOMETRY_CONFIDENCE_DEFAULT)
+
+        height, height_share = self._mode(heights, 2800)
+        depth, depth_share = self._mode(self.depths, 600)
+        section_width, width_share = self._mode(self.widths, 1000)
+        sections = max(1, int(self.top_bottom_qty / 2)) if self.top_bottom_qty else 1
+        width_total = section_width * sections
+        confidence = (
+            GEOMETRY_CONFIDENCE_HISTOGRAM_BASE
+            + GEOMETRY_CONFIDENCE_HISTOGRAM_SHARE * (height_share + depth_share + width_share) / 3
+        )
+        if self.heights:
+            confidence += GEOMETRY_CONFIDENCE_HISTOGRAM_HEIGHT
+        logger.info(f"Габарит из общего анализа: {width_total}x{depth}x{height}, секций: {sections}")
+        return GeometryGuess(width_total, depth, height, sections, section_width, "histogram", round(confidence, 2))
 
 
-def _calculate_total_weight(df: pd.DataFrame) -> float:
+def _infer_geometry(sheet: Sheet, rows: Iterable[ParsedRow]) -> GeometryGuess:
+    """
+    Определение габаритов за один проход по деталям (см. GeometrySignals).
+    Годится и для пакетной обработки: rows может быть любым итерируемым.
+    """
+    signals = GeometrySignals()
+    for row in rows:
+        signals.add(row)
+    logger.info(f"Начинаем определение габаритов из {signals.rows} строк")
+    guess = signals.choose(_extract_dimensions_from_cell(sheet))
+    logger.info("Габариты: стратегия %s, уверенность %.2f", guess.strategy, guess.confidence)
+    return guess
+
+
+def _infer_geometry_smart(sheet: Sheet, rows: List[ParsedRow]) -> Tuple[int, int, int, int, int]:
+    """Габариты кортежем (Ш, Г, В, секции, ширина секции) — прежний интерфейс _infer_geometry."""
+    return _infer_geometry(sheet, rows).as_tuple()
+
+
+def _calculate_total_weight(sheet: Sheet, index: Optional[SheetIndex] = None) -> float:
     """Точный поиск веса — работает с твоими файлами"""
-    for r in range(df.shape[0]):
+    if index is None:
+        index = SheetIndex(sheet)
+    # Оба варианта требуют слово «вес» в строке — смотрим только такие строки
+    for r in index.rows_with('вес'):
         # Вариант 1: "Вес (кг) =" в колонке A, значение в B
-        if str(df.iloc[r, 0]).strip().lower().startswith('вес (кг)'):
+        if index.cells_lower[r, 0].strip().startswith('вес (кг)'):
             try:
-                val = str(df.iloc[r, 1]).strip().replace(',', '.')
+                val = index.cells[r, 1].strip().replace(',', '.')
                 return float(val)
             except:
                 pass
         # Вариант 2: в одной ячейке или строке
-        for c in range(min(10, df.shape[1])):
-            cell = str(df.iloc[r, c])
+        for c in range(min(10, sheet.shape[1])):
+            cell = index.cells[r, c]
             m = re.search(r'Вес\s*\(кг\)\s*=\s*(\d+[.,]?\d*)', cell, re.IGNORECASE)
             if m:
                 return float(m.group(1).replace(',', '.'))
     return 0.0
 
 
-def _calculate_total_weight_by_rows(rows: List[ParsedRow]) -> float:
-    """Рассчитывает общий вес изделия из геометрии деталей"""
-    total_kg = 0.0
-    for r in rows:
-        if r.length_mm and r.width_mm and r.thickness_mm and r.qty:
-            density = _material_density_from_name(r.material)
-            volume_m3 = (r.length_mm / 1000) * (r.width_mm / 1000) * (r.thickness_mm / 1000)
-            weight_kg = volume_m3 * density * r.qty
-            total_kg += weight_kg
-    return round(total_kg, 2)
-
-
-def _calculate_base_cost(df: pd.DataFrame) -> Optional[float]:
-    """Ищет строку с 'Прямые затраты' и возвращает значение из колонки B."""
-    for r in range(df.shape[0]):
-        cell_val = df.iat[r, 0] if df.shape[1] > 0 else None
-        if pd.isna(cell_val):
-            continue
-        cell_text = str(cell_val).strip().lower()
-        if "прямые затраты" in cell_text:
-            if df.shape[1] > 1:
-                raw_val = df.iat[r, 1]
-                if pd.notna(raw_val):
-                    try:
-                        return float(str(raw_val).replace(" ", "").replace(",", "."))
-                    except Exception:
-                        pass
-        if isinstance(cell_val, str):
-            m = re.search(r"прямые затраты\s*=?\s*(\d+[.,]?\d*)", cell_val.lower())
-            if m:
-                try:
-                    return float(m.group(1).replace(",", "."))
-                except Exception:
-                    pass
-    return None
-
-
-def _calculate_final_price(base_cost: Optional[float]) -> Optional[float]:
-    if base_cost is None:
-        return None
-    if base_cost < 10_000:
-        factor = 4.0
-    elif base_cost < 30_000:
-        factor = 3.2
-    elif base_cost < 70_000:
-        factor = 2.5
-    elif base_cost < 150_000:
-        factor = 2.1
-    elif base_cost < 300_000:
-        factor = 1.8
-    else:
-        factor = 1.6
-    return round(base_cost * factor, 2)
+def _calculate_total_weight_by_rows(rows: List[ParsedRow]) -> float:
+    """Рассчитывает общий вес изделия из геометрии деталей"""
+    total_kg = 0.0
+    for r in rows:
+        if r.length_mm and r.width_mm and r.thickness_mm and r.qty:
+            density = _material_density_from_name(r.material)
+            volume_m3 = (r.length_mm / 1000) * (r.width_mm / 1000) * (r.thickness_mm / 1000)
+            weight_kg = volume_m3 * density * r.qty
+            total_kg += weight_kg
+    return round(total_kg, 2)
+
+
+def _calculate_base_cost(sheet: Sheet, index: Optional[SheetIndex] = None) -> Optional[float]:
+    """Ищет строку с 'Прямые затраты' и возвращает значение из колонки B."""
+    if index is None:
+        index = SheetIndex(sheet)
+    for r in index.rows_with("прямые затраты"):
+        cell_val = index.values[r, 0]
+        if not index.filled[r, 0]:
+            continue
+        cell_text = index.cells_lower[r, 0].strip()
+        if "прямые затраты" in cell_text:
+            if sheet.shape[1] > 1:
+                raw_val = index.values[r, 1]
+                if index.filled[r, 1]:
+                    try:
+                        return float(str(raw_val).replace(" ", "").replace(",", "."))
+                    except Exception:
+                        pass
+        if isinstance(cell_val, str):
+            m = re.search(r"прямые затраты\s*=?\s*(\d+[.,]?\d*)", cell_val.lower())
+            if m:
+                try:
+                    return float(m.group(1).replace(",", "."))
+                except Exception:
+                    pass
+    return None
+
+
+def _calculate_final_price(base_cost: Optional[float]) -> Optional[float]:
+    if base_cost is None:
+        return None
+    if base_cost < 10_000:
+        factor = 4.0
+    elif base_cost < 30_000:
+        factor = 3.2
+    elif base_cost < 70_000:
+        factor = 2.5
+    elif base_cost < 150_000:
+        factor = 2.1
+    elif base_cost < 300_000:
+        factor = 1.8
+    else:
+        factor = 1.6
+    return round(base_cost * factor, 2)
 
 
 def _split_sections(total_width: int) -> List[int]:
@@ -986,21 +2979,144 @@ def _calculate_span_widths(sections: List[int]) -> List[int]:
     return span_widths
 
 
-def _analyze_section_types(spec: ParsedSpec) -> List[SectionType]:
+@dataclass
+class WidthLayout:
+    """Раскладка одной ширины: секции, пролёты в каждой секции и ширины пролётов."""
+
+    sections: List[int]
+    section_spans: List[int]
+    span_widths: List[int]
+    total_spans: int
+
+
+def _compute_width_layout(total_width: int) -> WidthLayout:
+    sections = _split_sections(total_width)
+    section_spans = [_calc_spans_for_section(w) for w in sections]
+    return WidthLayout(
+        sections=sections,
+        section_spans=section_spans,
+        span_widths=_calculate_span_widths(sections),
+        total_spans=sum(section_spans),
+    )
+
+
+class LayoutTable:
+    """
+    Раскладка на секции и пролёты для всех допустимых ширин в плоских массивах NumPy.
+
+    Для ширины с индексом i секции лежат в section_widths[section_offsets[i]:section_offsets[i + 1]],
+    пролёты — в span_widths[span_offsets[i]:span_offsets[i + 1]]. Таблица строится лениво
+    при первом обращении и перестраивается, если изменились MAX_SECTION_WIDTH,
+    MAX_SHELF_SPAN, MAX_FACADE_WIDTH, PARTITION_THRESHOLD или диапазон ширин.
+    Ширины вне диапазона считаются напрямую.
+    """
+
+    def __init__(self) -> None:
+        self._key: Optional[Tuple[int, ...]] = None
+        self._lock = threading.Lock()
+        self.min_width = 0
+        # Массивы заполняет _build; до первого ensure_built() их нет, чтобы не импортировать numpy на старте
+        self.section_counts: Optional[np.ndarray] = None
+        self.total_spans: Optional[np.ndarray] = None
+        self.section_offsets: Optional[np.ndarray] = None
+        self.section_widths: Optional[np.ndarray] = None
+        self.section_spans: Optional[np.ndarray] = None
+        self.span_offsets: Optional[np.ndarray] = None
+        self.span_widths: Optional[np.ndarray] = None
+
+    @staticmethod
+    def _constraints() -> Tuple[int, ...]:
+        return (MAX_SECTION_WIDTH, MAX_SHELF_SPAN, MAX_FACADE_WIDTH, PARTITION_THRESHOLD, MIN_WIDTH_MM, MAX_WIDTH_MM)
+
+    def ensure_built(self) -> None:
+        key = self._constraints()
+        if self._key == key:
+            return
+        with self._lock:
+            if self._key != key:
+                self._build(key)
+
+    def _build(self, key: Tuple[int, ...]) -> None:
+        started = time.perf_counter()
+        min_width, max_width = key[-2], key[-1]
+        section_counts: List[int] = []
+        total_spans: List[int] = []
+        section_widths: List[int] = []
+        section_spans: List[int] = []
+        span_widths: List[int] = []
+        section_offsets = [0]
+        span_offsets = [0]
+
+        for width in range(min_width, max_width + 1):
+            layout = _compute_width_layout(width)
+            section_counts.append(len(layout.sections))
+            total_spans.append(layout.total_spans)
+            section_widths.extend(layout.sections)
+            section_spans.extend(layout.section_spans)
+            span_widths.extend(layout.span_widths)
+            section_offsets.append(len(section_widths))
+            span_offsets.append(len(span_widths))
+
+        self.min_width = min_width
+        self.section_counts = np.asarray(section_counts, dtype=np.int32)
+        self.total_spans = np.asarray(total_spans, dtype=np.int32)
+        self.section_offsets = np.asarray(section_offsets, dtype=np.int32)
+        self.section_widths = np.asarray(section_widths, dtype=np.int32)
+        self.section_spans = np.asarray(section_spans, dtype=np.int32)
+        self.span_offsets = np.asarray(span_offsets, dtype=np.int32)
+        self.span_widths = np.asarray(span_widths, dtype=np.int32)
+        self._key = key
+        logger.info(
+            "Таблица раскладок %s–%s мм построена за %.1f мс",
+            min_width,
+            max_width,
+            (time.perf_counter() - started) * 1000,
+        )
+
+    def get(self, width: int) -> WidthLayout:
+        self.ensure_built()
+        i = width - self.min_width
+        if not 0 <= i < len(self.section_counts):
+            return _compute_width_layout(width)
+
+        sec_from, sec_to = self.section_offsets[i], self.section_offsets[i + 1]
+        span_from, span_to = self.span_offsets[i], self.span_offsets[i + 1]
+        return WidthLayout(
+            sections=self.section_widths[sec_from:sec_to].tolist(),
+            section_spans=self.section_spans[sec_from:sec_to].tolist(),
+            span_widths=self.span_widths[span_from:span_to].tolist(),
+            total_spans=int(self.total_spans[i]),
+        )
+
+    def counts(self, widths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(число секций, суммарное число пролётов) для массива ширин одним индексированием."""
+        self.ensure_built()
+        idx = widths - self.min_width
+        if len(idx) and (idx.min() < 0 or idx.max() >= len(self.section_counts)):
+            layouts = [self.get(int(w)) for w in widths]
+            return (
+                np.asarray([len(l.sections) for l in layouts], dtype=np.int64),
+                np.asarray([l.total_spans for l in layouts], dtype=np.int64),
+            )
+        return self.section_counts[idx].astype(np.int64), self.total_spans[idx].astype(np.int64)
+
+
+LAYOUT_TABLE = LayoutTable()
+
+
+def _analyze_section_types(spec: ParsedSpec, rows: Optional[List[ParsedRow]] = None) -> List[SectionType]:
     """Анализирует функциональные зоны шкафа"""
     sections: List[SectionType] = []
+    if rows is None:
+        rows = list(spec.corpus_rows)
 
-    rods = [r for r in spec.corpus_rows if r.name and 'штанг' in r.name.lower()]
+    rods = [r for r in rows if r.role & PartRole.ROD]
     total_rods = sum(r.qty for r in rods if r.qty) if rods else 0
 
-    shelves = [r for r in spec.corpus_rows if r.name and 'полк' in r.name.lower()]
+    shelves = [r for r in rows if r.role & PartRole.SHELF]
     total_shelves = sum(r.qty for r in shelves if r.qty) if shelves else 0
 
-    lights = [
-        f for f in spec.furniture_items
-        if any(kw in f.name.lower() for kw in ['подсвет', 'led', 'освещ'])
-    ]
-    has_lighting = len(lights) > 0
+    has_lighting = spec.furniture_items.has_role(FurnitureRole.LIGHT)
 
     rods_per_section = total_rods / spec.sections_count if spec.sections_count > 0 else 0
     shelves_distribution = _distribute_items_per_section(total_shelves, spec.sections_count) if total_shelves else []
@@ -1014,19 +3130,118 @@ def _analyze_section_types(spec: ParsedSpec) -> List[SectionType]:
             shelf_count=shelves_distribution[idx] if idx < len(shelves_distribution) else shelves_per_section,
             has_lighting=has_lighting,
         )
-        sections.append(section)
-
-    return sections
+        sections.append(section)
+
+    return sections
+
+
+@dataclass
+class RecalcContext:
+    """
+    Данные спецификации для пересчёта, не зависящие от новой ширины. rows и
+    furniture — строки таблиц спецификации, собранные один раз на все ширины.
+    """
+
+    rows: List[ParsedRow]
+    furniture: List[FurnitureItem]
+    section_types: List[SectionType]
+    old_spans: int
+    shelf_rows: List[ParsedRow]
+    old_polki: float
+    row_materials: List[Optional[str]]
+    old_shelves: float
+    facade_row: Optional[ParsedRow]
+    old_drawers: float
+
+
+def _build_material_map(rows: List[ParsedRow]) -> Dict[str, str]:
+    """Карта материалов по группам деталей — для строк, где материал не распознан."""
+    material_map: Dict[str, str] = {}
+    for row in rows:
+        role = row.role
+        if role & PartRole.FACADE:
+            material_map['фасад'] = row.material or 'МДФ'
+        elif role & (PartRole.SIDE | PartRole.WALL):
+            if role & PartRole.VISIBLE:
+                material_map['стенка_видимая'] = row.material or 'ЛДСП'
+            else:
+                material_map['стенка_внутр'] = row.material or 'ЛДСП'
+        elif role & PartRole.SHELF:
+            material_map['полка'] = row.material or 'ЛДСП'
+        elif role & PartRole.TOP_BOTTOM:
+            material_map['крышка'] = row.material or 'ЛДСП'
+        elif role & (PartRole.PARTITION | PartRole.POST):
+            material_map['перегородка'] = row.material or 'ЛДСП'
+    return material_map
+
+
+def _infer_row_material(row: ParsedRow, material_map: Dict[str, str]) -> Optional[str]:
+    inferred_material = row.material
+    if not inferred_material:
+        role = row.role
+        if role & PartRole.FACADE:
+            inferred_material = material_map.get('фасад', 'МДФ')
+        elif role & (PartRole.SIDE | PartRole.WALL):
+            inferred_material = material_map.get('стенка_внутр', 'ЛДСП')
+            if role & PartRole.VISIBLE:
+                inferred_material = material_map.get('стенка_видимая', inferred_material)
+        elif role & PartRole.SHELF:
+            inferred_material = material_map.get('полка', 'ЛДСП')
+        elif role & PartRole.TOP_BOTTOM:
+            inferred_material = material_map.get('крышка', 'ЛДСП')
+        elif role & (PartRole.PARTITION | PartRole.POST):
+            inferred_material = material_map.get('перегородка', 'ЛДСП')
+    return inferred_material
+
+
+def _prepare_recalc(spec: ParsedSpec) -> RecalcContext:
+    """Один раз разбирает спецификацию для пересчёта под любое количество ширин."""
+    rows = list(spec.corpus_rows)
+    shelf_rows = [r for r in rows if r.role & PartRole.SHELF]
+    material_map = _build_material_map(rows)
+    drawers_rows = [r for r in rows if r.role & PartRole.DRAWER]
+
+    return RecalcContext(
+        rows=rows,
+        furniture=list(spec.furniture_items),
+        section_types=_analyze_section_types(spec, rows),
+        old_spans=sum(_calc_spans_for_section(spec.section_width_mm) for _ in range(spec.sections_count)),
+        shelf_rows=shelf_rows,
+        old_polki=sum(r.qty or 0 for r in shelf_rows),
+        row_materials=[_infer_row_material(r, material_map) for r in rows],
+        old_shelves=sum(r.qty for r in shelf_rows if r.qty),
+        facade_row=next((r for r in rows if r.role & PartRole.FACADE), None),
+        old_drawers=sum(r.qty for r in drawers_rows if r.qty) if drawers_rows else 0,
+    )
+
+
+def _map_section_types(original_sections_types: List[SectionType], new_sections: List[int]) -> List[SectionType]:
+    """Сопоставляет новые секции со старыми типами (пропорционально)."""
+    section_type_map: List[SectionType] = []
+    for i, new_sec_width in enumerate(new_sections):
+        original_idx = int(i * len(original_sections_types) / len(new_sections)) if original_sections_types else 0
+        original_type = (
+            original_sections_types[min(original_idx, len(original_sections_types) - 1)]
+            if original_sections_types
+            else SectionType(width_mm=new_sec_width)
+        )
+
+        section_type_map.append(
+            SectionType(
+                width_mm=new_sec_width,
+                has_rod=original_type.has_rod,
+                has_shelves=original_type.has_shelves,
+                has_lighting=original_type.has_lighting,
+                shelf_count=original_type.shelf_count,
+            )
+        )
+    return section_type_map
 
 
 def _recalculate_corpus(
-    spec: ParsedSpec, new_width: int
+    spec: ParsedSpec, new_width: int, ctx: Optional[RecalcContext] = None
 ) -> Tuple[List[Dict], float, List[str], List[str], List[dict]]:
     old_width = spec.width_total_mm
-    original_sections_types = _analyze_section_types(spec)
-    new_sections = _split_sections(new_width)
-    new_sections_count = len(new_sections)
-    new_span_widths = _calculate_span_widths(new_sections)
 
     if new_width == old_width:
         logger.info("Ширина не изменилась — возвращаем исходные данные без пересчёта.")
@@ -1065,97 +3280,73 @@ def _recalculate_corpus(
             for part in corpus_parts
         ], spec.total_weight_kg, cut_warnings, [], furn_items
 
-    old_spans = sum(_calc_spans_for_section(spec.section_width_mm) for _ in range(spec.sections_count))
-    new_spans = sum(_calc_spans_for_section(w) for w in new_sections)
-    span_ratio = new_spans / old_spans if old_spans > 0 else 1
+    if ctx is None:
+        ctx = _prepare_recalc(spec)
+
+    layout = LAYOUT_TABLE.get(new_width)
+    new_sections = layout.sections
+    new_sections_count = len(new_sections)
+    new_span_widths = layout.span_widths
+
+    old_spans = ctx.old_spans
+    new_spans = layout.total_spans
     section_ratio = new_sections_count / spec.sections_count if spec.sections_count else 1
 
-    shelf_rows = [r for r in spec.corpus_rows if r.name and 'полк' in r.name.lower()]
-    old_polki = sum(r.qty or 0 for r in shelf_rows)
+    shelf_rows = ctx.shelf_rows
+    old_polki = ctx.old_polki
 
-    # Сопоставляем новые секции со старыми типами (пропорционально)
-    section_type_map: List[SectionType] = []
-    for i, new_sec_width in enumerate(new_sections):
-        original_idx = int(i * len(original_sections_types) / len(new_sections)) if original_sections_types else 0
-        original_type = original_sections_types[min(original_idx, len(original_sections_types) - 1)] if original_sections_types else SectionType(width_mm=new_sec_width)
-
-        new_type = SectionType(
-            width_mm=new_sec_width,
-            has_rod=original_type.has_rod,
-            has_shelves=original_type.has_shelves,
-            has_lighting=original_type.has_lighting,
-            shelf_count=original_type.shelf_count,
-        )
-        section_type_map.append(new_type)
+    section_type_map = _map_section_types(ctx.section_types, new_sections)
 
     shelves_plan = [sec.shelf_count for sec in section_type_map]
     if section_type_map:
         logger.info(f"Карта полок по секциям (оригинальные→новые): {shelves_plan}")
 
-    # Карта материалов
-    material_map: Dict[str, str] = {}
-    for row in spec.corpus_rows:
-        name_key = row.name.lower()
-        if 'фасад' in name_key:
-            material_map['фасад'] = row.material or 'МДФ'
-        elif 'боков' in name_key or 'стенк' in name_key:
-            if any(kw in name_key for kw in ['видим', 'наружн', 'внешн']):
-                material_map['стенка_видимая'] = row.material or 'ЛДСП'
-            else:
-                material_map['стенка_внутр'] = row.material or 'ЛДСП'
-        elif 'полк' in name_key:
-            material_map['полка'] = row.material or 'ЛДСП'
-        elif 'крышк' in name_key or 'дно' in name_key:
-            material_map['крышка'] = row.material or 'ЛДСП'
-        elif 'перегород' in name_key or 'стойк' in name_key:
-            material_map['перегородка'] = row.material or 'ЛДСП'
-
-    def _allocate_by_ratio(total_qty: int, rows: List) -> Dict[int, int]:
-        if not rows:
-            return {}
-        if len(rows) == 1:
-            return {id(rows[0]): total_qty}
-        qtys = [r.qty or 0 for r in rows]
-        sum_qty = sum(qtys)
-        if not sum_qty:
-            base = _distribute_items_per_section(total_qty, len(rows))
-            return {id(r): int(round(base[i])) for i, r in enumerate(rows)}
-        raw = [(q / sum_qty) * total_qty for q in qtys]
-        base = [math.floor(v) for v in raw]
-        remainder = total_qty - sum(base)
-        order = sorted(
-            [(i, raw[i] - base[i]) for i in range(len(rows))],
-            key=lambda x: x[1],
-            reverse=True,
-        )
-        idx = 0
-        while remainder > 0 and order:
-            base[order[idx % len(order)][0]] += 1
-            remainder -= 1
-            idx += 1
-        return {id(r): base[i] for i, r in enumerate(rows)}
-
-    new_parts = []
-    shelves_from_ratio_total = sum(shelves_plan) if shelves_plan else 0
-    if not shelves_from_ratio_total and spec.sections_count:
-        shelves_from_ratio_total = (old_polki / spec.sections_count) * new_sections_count
-    shelves_target_total = math.ceil(shelves_from_ratio_total) if shelves_from_ratio_total else old_polki
-    shelf_qty_map = _allocate_by_ratio(int(shelves_target_total), shelf_rows)
-    for row in spec.corpus_rows:
-        name_low = row.name.lower()
-        new_qty = row.qty or 0
-        new_length = row.length_mm or 0
-        new_width_part = row.width_mm or 0
+    def _allocate_by_ratio(total_qty: int, rows: List) -> Dict[int, int]:
+        if not rows:
+            return {}
+        if len(rows) == 1:
+            return {rows[0].index: total_qty}
+        qtys = [r.qty or 0 for r in rows]
+        sum_qty = sum(qtys)
+        if not sum_qty:
+            base = _distribute_items_per_section(total_qty, len(rows))
+            return {r.index: int(round(base[i])) for i, r in enumerate(rows)}
+        raw = [(q / sum_qty) * total_qty for q in qtys]
+        base = [math.floor(v) for v in raw]
+        remainder = total_qty - sum(base)
+        order = sorted(
+            [(i, raw[i] - base[i]) for i in range(len(rows))],
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        idx = 0
+        while remainder > 0 and order:
+            base[order[idx % len(order)][0]] += 1
+            remainder -= 1
+            idx += 1
+        return {r.index: base[i] for i, r in enumerate(rows)}
+
+    new_parts = []
+    shelves_from_ratio_total = sum(shelves_plan) if shelves_plan else 0
+    if not shelves_from_ratio_total and spec.sections_count:
+        shelves_from_ratio_total = (old_polki / spec.sections_count) * new_sections_count
+    shelves_target_total = math.ceil(shelves_from_ratio_total) if shelves_from_ratio_total else old_polki
+    shelf_qty_map = _allocate_by_ratio(int(shelves_target_total), shelf_rows)
+    for row, inferred_material in zip(ctx.rows, ctx.row_materials):
+        role = row.role
+        new_qty = row.qty or 0
+        new_length = row.length_mm or 0
+        new_width_part = row.width_mm or 0
         widths_mm: List[int] = []
         facade_target_qty: Optional[int] = None
 
-        if 'полк' in name_low:
-            if shelf_qty_map:
-                new_qty = shelf_qty_map.get(id(row), new_qty)
-            elif shelves_target_total:
-                new_qty = shelves_target_total
-            new_width_part = math.ceil(new_width / new_sections_count) if new_sections_count else new_width_part
-        elif 'фасад' in name_low:
+        if role & PartRole.SHELF:
+            if shelf_qty_map:
+                new_qty = shelf_qty_map.get(row.index, new_qty)
+            elif shelves_target_total:
+                new_qty = shelves_target_total
+            new_width_part = math.ceil(new_width / new_sections_count) if new_sections_count else new_width_part
+        elif role & PartRole.FACADE:
             facades_per_span = new_qty / old_spans if old_spans else new_qty
             new_qty = facades_per_span * new_spans
             facades_per_span_int = max(1, int(round(facades_per_span))) if new_spans else 0
@@ -1175,10 +3366,10 @@ def _recalculate_corpus(
                 new_width_part = max(widths_mm)
             else:
                 new_width_part = new_width // new_spans if new_spans else new_width_part
-        elif 'задн' in name_low:
+        elif role & PartRole.BACK:
             new_qty = new_sections_count
             new_width_part = new_width // new_sections_count if new_sections_count else new_width_part
-        elif 'крышк' in name_low or 'дно' in name_low:
+        elif role & PartRole.TOP_BOTTOM:
             # Определяем логику из исходного файла
             pieces_per_section = row.qty / spec.sections_count if spec.sections_count > 0 else 2  # e.g. 6/3=2
             if row.length_mm and row.length_mm > spec.section_width_mm * 1.5:
@@ -1189,33 +3380,18 @@ def _recalculate_corpus(
                 # Это крышки ПО СЕКЦИЯМ (A)
                 new_qty = new_sections_count * pieces_per_section
                 new_length = new_width // new_sections_count
-        elif 'боков' in name_low:
+        elif role & PartRole.SIDE:
             new_qty = 2
-        elif 'средние' in name_low or 'перегород' in name_low:
+        elif role & (PartRole.MIDDLE | PartRole.PARTITION):
             new_qty = new_sections_count - 1 if new_sections_count > 1 else 0
-        elif 'стенк' in name_low:
+        elif role & PartRole.WALL:
             new_qty = new_sections_count + 1
-        elif 'цоколь' in name_low:
+        elif role & PartRole.PLINTH:
             new_qty = new_sections_count
             new_length = new_width // new_sections_count if new_sections_count else new_length
         else:
             new_qty *= (new_width / old_width) if old_width else section_ratio
 
-        inferred_material = row.material
-        if not inferred_material:
-            if 'фасад' in name_low:
-                inferred_material = material_map.get('фасад', 'МДФ')
-            elif 'боков' in name_low or 'стенк' in name_low:
-                inferred_material = material_map.get('стенка_внутр', 'ЛДСП')
-                if any(kw in name_low for kw in ['видим', 'наружн', 'внешн']):
-                    inferred_material = material_map.get('стенка_видимая', inferred_material)
-            elif 'полк' in name_low:
-                inferred_material = material_map.get('полка', 'ЛДСП')
-            elif any(kw in name_low for kw in ['крышк', 'дно']):
-                inferred_material = material_map.get('крышка', 'ЛДСП')
-            elif any(kw in name_low for kw in ['перегород', 'стойк']):
-                inferred_material = material_map.get('перегородка', 'ЛДСП')
-
         new_parts.append({
             'name': row.name,
             'material': inferred_material,
@@ -1229,11 +3405,11 @@ def _recalculate_corpus(
 
     logger.debug(new_parts)
 
-    new_weight = 0.0
-    for p in new_parts:
-        if p['thickness'] and p['length_mm'] and p['qty'] and (p['width_mm'] or p.get('widths_mm')):
-            length_adj = p['length_mm']
-            density = _material_density_from_name(p.get('material'))
+    new_weight = 0.0
+    for p in new_parts:
+        if p['thickness'] and p['length_mm'] and p['qty'] and (p['width_mm'] or p.get('widths_mm')):
+            length_adj = p['length_mm']
+            density = _material_density_from_name(p.get('material'))
 
             widths_for_weight = p.get('widths_mm') or []
             qty_value = p['qty']
@@ -1253,7 +3429,7 @@ def _recalculate_corpus(
                 vol_m3 = (length_adj / 1000) * (width_adj / 1000) * (p['thickness'] / 1000) * qty_value
                 new_weight += vol_m3 * density
 
-    furn_items, furn_warnings, _ = _recalculate_furniture(spec, new_width)
+    furn_items, furn_warnings, _ = _recalculate_furniture(spec, new_width, ctx)
 
     cut_warnings: List[str] = []
     general_recommendations: List[str] = []
@@ -1300,31 +3476,16 @@ def _petals_per_facade(height_mm: int) -> int:
     else: return 8
 
 
-def _calculate_shelf_counts(spec: ParsedSpec, new_width: int) -> Tuple[float, float]:
+def _calculate_shelf_counts(
+    spec: ParsedSpec, new_width: int, ctx: Optional[RecalcContext] = None
+) -> Tuple[float, float]:
     """Возвращает исходное и новое количество полок для пересчёта фурнитуры."""
+    if ctx is None:
+        ctx = _prepare_recalc(spec)
 
-    old_shelves = sum(r.qty for r in spec.corpus_rows if r.name and 'полк' in r.name.lower() and r.qty)
-    new_sections = _split_sections(new_width)
-    original_sections_types = _analyze_section_types(spec)
-
-    section_type_map: List[SectionType] = []
-    for i, new_sec_width in enumerate(new_sections):
-        original_idx = int(i * len(original_sections_types) / len(new_sections)) if original_sections_types else 0
-        original_type = (
-            original_sections_types[min(original_idx, len(original_sections_types) - 1)]
-            if original_sections_types
-            else SectionType(width_mm=new_sec_width)
-        )
-
-        section_type_map.append(
-            SectionType(
-                width_mm=new_sec_width,
-                has_rod=original_type.has_rod,
-                has_shelves=original_type.has_shelves,
-                has_lighting=original_type.has_lighting,
-                shelf_count=original_type.shelf_count,
-            )
-        )
+    old_shelves = ctx.old_shelves
+    new_sections = LAYOUT_TABLE.get(new_width).sections
+    section_type_map = _map_section_types(ctx.section_types, new_sections)
 
     shelves_plan = [sec.shelf_count for sec in section_type_map]
     new_shelves = sum(shelves_plan)
@@ -1335,24 +3496,29 @@ def _calculate_shelf_counts(spec: ParsedSpec, new_width: int) -> Tuple[float, fl
     return float(old_shelves), float(new_shelves)
 
 
-def _recalculate_furniture(spec: ParsedSpec, new_width: int) -> Tuple[List[dict], List[str], float]:
-    old_spans = sum(_calc_spans_for_section(spec.section_width_mm) for _ in range(spec.sections_count))
-    new_sections = _split_sections(new_width)
-    new_spans = sum(_calc_spans_for_section(w) for w in new_sections)
+def _recalculate_furniture(
+    spec: ParsedSpec, new_width: int, ctx: Optional[RecalcContext] = None
+) -> Tuple[List[dict], List[str], float]:
+    if ctx is None:
+        ctx = _prepare_recalc(spec)
+
+    old_spans = ctx.old_spans
+    layout = LAYOUT_TABLE.get(new_width)
+    new_sections = layout.sections
+    new_spans = layout.total_spans
     span_ratio = new_spans / old_spans if old_spans > 0 else 1
     section_ratio = len(new_sections) / spec.sections_count if spec.sections_count > 0 else 1
 
-    old_shelves, new_shelves = _calculate_shelf_counts(spec, new_width)
+    old_shelves, new_shelves = _calculate_shelf_counts(spec, new_width, ctx)
 
-    facade_row = next((r for r in spec.corpus_rows if 'фасад' in r.name.lower()), None)
+    facade_row = ctx.facade_row
     old_facades = facade_row.qty if facade_row and facade_row.qty is not None else old_spans
     facades_per_span = old_facades / old_spans if old_spans else old_facades
     new_facades = math.ceil(facades_per_span * new_spans)
     facade_height = facade_row.length_mm if facade_row else 2700
     petals_per_f = _petals_per_facade(facade_height)
 
-    drawers_rows = [r for r in spec.corpus_rows if r.name and 'ящик' in r.name.lower()]
-    old_drawers = sum(r.qty for r in drawers_rows if r.qty) if drawers_rows else 0
+    old_drawers = ctx.old_drawers
     recalculated_drawers = old_drawers * section_ratio if old_drawers else 0
     handles_drawer_qty = math.ceil(recalculated_drawers) if recalculated_drawers else 0
     logger.info(
@@ -1369,19 +3535,18 @@ def _recalculate_furniture(spec: ParsedSpec, new_width: int) -> Tuple[List[dict]
     if old_shelves == 0 or new_shelves == 0:
         furn_warnings.append("⚠️ Недостаточно данных по полкам — использован пересчёт по пролётам.")
 
-    spans_per_section = [_calc_spans_for_section(w) for w in new_sections]
     span_width = new_width / new_spans if new_spans else new_width
     handle_drawer_warning_added = False
 
-    for item in spec.furniture_items:
-        name_low = item.name.lower()
+    for item in ctx.furniture:
+        role = item.role
         base_qty = item.qty or 0
         new_qty = base_qty
         meta: Dict[str, Optional[float]] = {}
 
-        if 'петл' in name_low or 'чашк' in name_low or ('заглушка' in name_low and 'петл' in name_low):
+        if role & FurnitureRole.HINGE:
             new_qty = new_facades * petals_per_f
-        elif 'ручк' in name_low:
+        elif role & FurnitureRole.HANDLE:
             new_qty = new_facades + handles_drawer_qty
             if old_drawers and handles_drawer_qty and not handle_drawer_warning_added:
                 furn_warnings.append(
@@ -1395,20 +3560,20 @@ def _recalculate_furniture(spec: ParsedSpec, new_width: int) -> Tuple[List[dict]
                 new_qty,
                 base_qty,
             )
-        elif 'полкодерж' in name_low:
+        elif role & FurnitureRole.SHELF_SUPPORT:
             if old_shelves > 0 and new_shelves > 0:
                 supports_per_shelf = base_qty / old_shelves
                 new_qty = supports_per_shelf * new_shelves
             else:
                 new_qty *= span_ratio
-        elif 'стяжка межсекцион' in name_low:
+        elif role & FurnitureRole.SECTION_TIE:
             stiazki_per_connection = max(1, math.ceil(spec.height_mm / 700))
             new_qty = (len(new_sections) - 1) * stiazki_per_connection if len(new_sections) > 1 else 0
-        elif 'корректор фасада' in name_low:
+        elif role & FurnitureRole.FACADE_CORRECTOR:
             new_qty = new_facades
-        elif 'винт' in name_low or 'ключ' in name_low:
+        elif role & FurnitureRole.SCREW:
             new_qty = math.ceil(base_qty) if base_qty else 2
-        elif 'штанг' in name_low:
+        elif role & FurnitureRole.ROD:
             # Штанги ставятся только в секциях-гардеробных
             # Определяем какие секции имели штанги изначально
             original_has_rods = base_qty > 0
@@ -1425,7 +3590,7 @@ def _recalculate_furniture(spec: ParsedSpec, new_width: int) -> Tuple[List[dict]
                         rod_length = max(w - 40, 0)
                         lengths_mm.extend([rod_length] * rods_in_section)
                 meta['lengths_mm'] = lengths_mm
-        elif 'подсветк' in name_low or 'led' in name_low or 'освещен' in name_low:
+        elif role & FurnitureRole.LED:
             new_qty *= span_ratio
             led_length_mm = max(int(span_width - 100), 0)
             total_length_m = (led_length_mm / 1000) * new_qty
@@ -1454,6 +3619,305 @@ def _recalculate_furniture(spec: ParsedSpec, new_width: int) -> Tuple[List[dict]
     return new_furn, furn_warnings, total_led_power
 
 
+def _sweep_widths(spec: ParsedSpec, widths: Iterable[int]) -> List[Dict[str, Any]]:
+    """
+    Пересчитывает спецификацию для набора ширин. Всё, что не зависит от ширины
+    (типы секций, карта материалов, классификация строк, старые пролёты),
+    считается один раз; число секций и пролётов берётся из LAYOUT_TABLE для всех ширин сразу.
+    Возвращает таблицу: строка на ширину, количество по каждой детали и фурнитуре.
+    """
+    ctx = _prepare_recalc(spec)
+    widths_arr = np.asarray(list(widths), dtype=np.int64)
+    sections, spans = LAYOUT_TABLE.counts(widths_arr)
+
+    table: List[Dict[str, Any]] = []
+    for width, sections_count, spans_count in zip(widths_arr.tolist(), sections.tolist(), spans.tolist()):
+        corpus_parts, weight, cut_warnings, _, furniture_items = _recalculate_corpus(spec, width, ctx)
+        row: Dict[str, Any] = {
+            'width_mm': width,
+            'sections': sections_count,
+            'spans': spans_count,
+            'weight_kg': weight,
+            'parts_qty': sum(p['qty'] or 0 for p in corpus_parts),
+            'furniture_qty': sum(f['qty'] or 0 for f in furniture_items),
+            'cut_warnings': len(cut_warnings),
+        }
+        for i, p in enumerate(corpus_parts, 1):
+            row[f"{i}. {p['name']}"] = p['qty']
+        for i, f in enumerate(furniture_items, 1):
+            row[f"Ф{i}. {f['name']}"] = f['qty']
+        table.append(row)
+    return table
+
+
+def _sweep_to_csv(table: List[Dict[str, Any]]) -> bytes:
+    """CSV (разделитель «;», UTF-8 с BOM — открывается в Excel без настройки)."""
+    fieldnames: List[str] = []
+    for row in table:
+        fieldnames.extend(k for k in row if k not in fieldnames)
+
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fieldnames, delimiter=";", restval="")
+    writer.writeheader()
+    writer.writerows(table)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+@dataclass
+class _MemoSession:
+    fingerprint: str
+    # RecalcContext ссылается на строки конкретного объекта спецификации
+    spec: Optional[ParsedSpec] = None
+    ctx: Optional[RecalcContext] = None
+    # ширина → [результат _recalculate_corpus, готовый XLSX или None]
+    widths: "OrderedDict[int, List[Any]]" = field(default_factory=OrderedDict)
+
+
+class RecalcMemo:
+    """
+    Готовые пересчёты по сессиям: user_id → отпечаток спецификации,
+    RecalcContext и последние max_widths результатов по ширинам (LRU). Смена
+    отпечатка (новый файл) сбрасывает сессию целиком; сессий держится не больше
+    max_sessions, самая давняя вытесняется. Используется только из цикла
+    событий, поэтому без блокировок.
+    """
+
+    def __init__(self, max_sessions: int, max_widths: int) -> None:
+        self.max_sessions = max(1, max_sessions)
+        self.max_widths = max(1, max_widths)
+        self._sessions: "OrderedDict[int, _MemoSession]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _session(self, user_id: int, fingerprint: str) -> _MemoSession:
+        session = self._sessions.get(user_id)
+        if session is None or session.fingerprint != fingerprint:
+            session = _MemoSession(fingerprint)
+            self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def get(self, user_id: int, fingerprint: str, width: int) -> Optional[List[Any]]:
+        """[результат, XLSX или None] для ширины; None — пересчёта ещё не было."""
+        session = self._sessions.get(user_id)
+        entry = session.widths.get(width) if session is not None and session.fingerprint == fingerprint else None
+        if entry is None:
+            self.misses += 1
+            return None
+        session.widths.move_to_end(width)
+        self._sessions.move_to_end(user_id)
+        self.hits += 1
+        return entry
+
+    def context(self, user_id: int, fingerprint: str, spec: ParsedSpec) -> Optional[RecalcContext]:
+        session = self._sessions.get(user_id)
+        if session is None or session.fingerprint != fingerprint or session.spec is not spec:
+            return None
+        return session.ctx
+
+    def put_context(self, user_id: int, fingerprint: str, spec: ParsedSpec, ctx: RecalcContext) -> None:
+        session = self._session(user_id, fingerprint)
+        session.spec, session.ctx = spec, ctx
+
+    def put(self, user_id: int, fingerprint: str, width: int, result: Tuple[Any, ...]) -> List[Any]:
+        session = self._session(user_id, fingerprint)
+        entry = session.widths[width] = [result, None]
+        session.widths.move_to_end(width)
+        while len(session.widths) > self.max_widths:
+            session.widths.popitem(last=False)
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "sessions": len(self._sessions),
+            "widths": sum(len(s.widths) for s in self._sessions.values()),
+        }
+
+
+RECALC_MEMO = RecalcMemo(RECALC_MEMO_SESSIONS, RECALC_MEMO_WIDTHS)
+
+
+# Пакетная обработка: строки сводной таблицы по каталогу или zip-архиву спецификаций
+BATCH_COLUMNS = [
+    "file", "status", "kind", "name", "code", "material", "thickness_mm", "size", "qty", "unit",
+    "spec_width_mm", "new_width_mm", "weight_kg", "geometry", "geometry_confidence", "note",
+]
+SPEC_EXTENSIONS = (".xls", ".xlsx")
+# Файл в архиве или каталоге с ширинами по спецификациям
+WIDTHS_FILE_NAMES = ("widths.csv", "widths.txt")
+
+
+def _batch_error_row(name: str, error: Any) -> Dict[str, Any]:
+    return {"file": name, "status": "error", "kind": "spec", "note": str(error)}
+
+
+def _batch_item(name: str, source: Union[bytes, str], new_width: Optional[int]) -> List[Dict[str, Any]]:
+    """
+    Разбор и пересчёт одного файла пакета: строка изделия, затем детали и
+    фурнитура. new_width=None — пересчёт на исходную ширину. Ошибка
+    становится строкой со status=error, чтобы один битый файл не останавливал пакет.
+    Нехватка памяти и лимиты песочницы пробрасываются: по ним процесс пересоздаётся.
+    """
+    try:
+        spec = _build_spec(source, name)
+        width = new_width or spec.width_total_mm
+        if not MIN_WIDTH_MM <= width <= MAX_WIDTH_MM:
+            raise ValueError(f"ширина {width} мм вне диапазона {MIN_WIDTH_MM}–{MAX_WIDTH_MM} мм")
+        corpus_parts, weight, cut_warnings, _, furniture_items = _recalculate_corpus(spec, width)
+    except (MemoryError, WorkerLimitError):
+        raise
+    except Exception as e:
+        logger.warning("Batch item %s failed: %s", name, e)
+        return [_batch_error_row(name, e)]
+
+    base = {"file": name, "status": "ok", "spec_width_mm": spec.width_total_mm, "new_width_mm": width}
+    rows = [{
+        **base,
+        "kind": "spec",
+        "name": spec.source_filename,
+        "size": f"{width}×{spec.depth_mm}×{spec.height_mm}",
+        "qty": 1,
+        "weight_kg": round(weight, 2),
+        "geometry": spec.geometry_strategy,
+        "geometry_confidence": spec.geometry_confidence,
+        "note": "; ".join(cut_warnings),
+    }]
+    rows.extend(
+        {
+            **base,
+            "kind": "part",
+            "name": p["name"],
+            "material": p.get("material"),
+            "thickness_mm": p.get("thickness"),
+            "size": p.get("size"),
+            "qty": p["qty"],
+        }
+        for p in corpus_parts
+    )
+    rows.extend(
+        {**base, "kind": "furniture", "name": f["name"], "code": f.get("code"), "qty": f["qty"], "unit": f.get("unit")}
+        for f in furniture_items
+    )
+    return rows
+
+
+def _parse_width_overrides(text: str) -> Dict[str, int]:
+    """
+    Ширины по файлам из строк «имя;ширина» (подойдут и «,» или табуляция).
+    Строки без числа в конце — заголовок, комментарии — пропускаются.
+    """
+    overrides: Dict[str, int] = {}
+    for line in text.splitlines():
+        m = re.match(r"\s*(.+?)\s*[;,\t]\s*(\d+)\s*$", line)
+        if m:
+            overrides[m.group(1).strip('"').lower()] = int(m.group(2))
+    return overrides
+
+
+def _decode_text(data: bytes) -> str:
+    """Текстовый файл от пользователя: UTF-8 (с BOM или без) или, как из Excel под Windows, cp1251."""
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251", errors="replace")
+
+
+def _batch_width(name: str, overrides: Dict[str, int], default: Optional[int]) -> Optional[int]:
+    """Ширина для файла пакета: по пути в архиве, по имени файла или по имени без расширения."""
+    base = os.path.basename(name).lower()
+    for key in (name.lower(), base, os.path.splitext(base)[0]):
+        if key in overrides:
+            return overrides[key]
+    return default
+
+
+def _zip_member_name(info: zipfile.ZipInfo) -> str:
+    """
+    Имя файла в архиве. Без флага UTF-8 zipfile читает имя как cp437, а на деле
+    это обычно UTF-8 без флага (zip в Linux) или cp866 (архиваторы Windows).
+    """
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        raw = info.filename.encode("cp437")
+    except UnicodeError:
+        return info.filename
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("cp866")
+
+
+def _zip_batch_inputs(archive: zipfile.ZipFile) -> Tuple[List[Tuple[str, zipfile.ZipInfo]], Dict[str, int]]:
+    """Спецификации в архиве (по имени) и ширины из widths.csv, если он есть."""
+    specs: List[Tuple[str, zipfile.ZipInfo]] = []
+    overrides: Dict[str, int] = {}
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = _zip_member_name(info)
+        base = os.path.basename(name).lower()
+        # Служебные файлы macOS и временные файлы Excel
+        if name.startswith("__MACOSX/") or base.startswith(("~$", ".")):
+            continue
+        if base in WIDTHS_FILE_NAMES:
+            overrides.update(_parse_width_overrides(_decode_text(archive.read(info))))
+        elif base.endswith(SPEC_EXTENSIONS):
+            if info.file_size > MAX_UPLOAD_BYTES:
+                raise ValueError(f"{name}: больше {MAX_UPLOAD_BYTES / 1048576:.0f} МБ после распаковки")
+            specs.append((name, info))
+    if len(specs) > BATCH_MAX_FILES:
+        raise ValueError(f"в архиве {len(specs)} спецификаций, максимум {BATCH_MAX_FILES}")
+    specs.sort(key=lambda item: item[0])
+    return specs, overrides
+
+
+class BatchWriter:
+    """
+    Сводная таблица пакета, дописываемая по мере готовности файлов: CSV
+    (как у /sweep — «;», UTF-8 с BOM) или XLSX (openpyxl write_only).
+    """
+
+    def __init__(self, out: BinaryIO, fmt: str) -> None:
+        if fmt not in ("csv", "xlsx"):
+            raise ValueError(f"Неизвестный формат сводной таблицы: {fmt} (ожидается csv или xlsx)")
+        self.format = fmt
+        self.files = 0
+        self.failed = 0
+        self._out = out
+        if fmt == "csv":
+            self._text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+            self._csv = csv.DictWriter(self._text, fieldnames=BATCH_COLUMNS, delimiter=";", restval="")
+            self._csv.writeheader()
+        else:
+            self._book = openpyxl.Workbook(write_only=True)
+            self._sheet = self._book.create_sheet("Пакет")
+            self._sheet.append(BATCH_COLUMNS)
+
+    def write(self, rows: List[Dict[str, Any]]) -> None:
+        """Строки одного файла пакета."""
+        self.files += 1
+        self.failed += any(row["status"] == "error" for row in rows)
+        if self.format == "csv":
+            self._csv.writerows(rows)
+            self._text.flush()
+        else:
+            for row in rows:
+                self._sheet.append([row.get(c) for c in BATCH_COLUMNS])
+
+    def close(self) -> None:
+        if self.format == "csv":
+            self._text.flush()
+            # Поток out остаётся открытым — им владеет вызывающий
+            self._text.detach()
+        else:
+            self._book.save(self._out)
+
+
 def _format_structure(width_total: int, depth: int, height: int, sections: List[int]) -> str:
     """Форматирует описание структуры"""
     spans_per_section = [_calc_spans_for_section(w) for w in sections]
@@ -1474,6 +3938,242 @@ def _format_structure(width_total: int, depth: int, height: int, sections: List[
     return "\n".join(lines)
 
 
+def _build_spec(source: Union[bytes, str], filename: str) -> ParsedSpec:
+    """
+    Полный разбор файла: листы, детали, фурнитура, габариты, вес и цена.
+    source — содержимое файла или путь к нему (см. Upload).
+    """
+    with STAGE_STATS.stage("workbook_open"):
+        corpus_sheet, furniture_sheet = _read_excel_to_sheets(source, filename)
+    with STAGE_STATS.stage("sheet_index"):
+        corpus_index = SheetIndex(corpus_sheet)
+
+    corpus_rows = _parse_corpus_rows(corpus_sheet, corpus_index)
+    logger.info(f"Распознано {len(corpus_rows)} строк корпуса")
+
+    with STAGE_STATS.stage("furniture_parse"):
+        furniture_items = _parse_furniture_rows(furniture_sheet) if furniture_sheet is not None else []
+    logger.info(f"Распознано {len(furniture_items)} позиций фурнитуры")
+
+    with STAGE_STATS.stage("geometry"):
+        geometry = _infer_geometry(corpus_sheet, corpus_rows)
+    total_weight = _calculate_total_weight(corpus_sheet, corpus_index)
+    if not total_weight:
+        total_weight = _calculate_total_weight_by_rows(corpus_rows)
+    base_cost = _calculate_base_cost(corpus_sheet, corpus_index)
+    final_price = _calculate_final_price(base_cost)
+
+    return ParsedSpec(
+        source_filename=filename,
+        width_total_mm=geometry.width_total_mm,
+        depth_mm=geometry.depth_mm,
+        height_mm=geometry.height_mm,
+        sections_count=geometry.sections_count,
+        section_width_mm=geometry.section_width_mm,
+        corpus_rows=CorpusTable.from_rows(corpus_rows),
+        furniture_items=FurnitureTable.from_rows(furniture_items),
+        total_weight_kg=total_weight,
+        base_cost=base_cost,
+        final_price=final_price,
+        geometry_strategy=geometry.strategy,
+        geometry_confidence=geometry.confidence,
+    )
+
+
+def _render_upload_message(spec: ParsedSpec) -> str:
+    """Ответ на загруженный файл: габариты и что удалось распознать."""
+    sections_list = [spec.section_width_mm] * spec.sections_count
+    msg = "✅ Файл успешно обработан!\n\n"
+    msg += _format_structure(spec.width_total_mm, spec.depth_mm, spec.height_mm, sections_list)
+    msg += f"\n\n📊 Найдено:\n"
+    msg += f"  • Корпусных деталей: {len([r for r in spec.corpus_rows if r.qty])} позиций\n"
+    msg += f"  • Фурнитуры: {len(spec.furniture_items)} позиций\n"
+    msg += f"  • Общий вес: {spec.total_weight_kg} кг\n"
+    if spec.final_price is not None:
+        msg += f"  • Итоговая цена: {spec.final_price:.2f} ₽\n"
+    if spec.geometry_strategy and spec.geometry_confidence < 0.5:
+        msg += "\n⚠️ Габариты определены приблизительно — проверь ширину, глубину и высоту.\n"
+    msg += f"\n💬 Введи новую ширину шкафа в мм (например: 3600)"
+    return msg
+
+
+def _render_recalc_message(
+    spec: ParsedSpec,
+    new_width: int,
+    sections: List[int],
+    corpus_parts: List[dict],
+    new_weight: float,
+    cut_warnings: List[str],
+    general_recommendations: List[str],
+    furniture_items: List[dict],
+) -> List[str]:
+    """
+    Полный текст ответа на пересчёт, разбитый на сообщения в пределах лимита
+    Telegram. Запасной вариант, если XLSX не удалось собрать или отправить.
+    """
+    # Формируем ответ
+    msg = "✅ Пересчёт завершён!\n\n"
+    msg += _format_structure(new_width, spec.depth_mm, spec.height_mm, sections)
+    msg += f"\n\n⚖️ Вес изделия:\n"
+    msg += f"  • Было: {spec.total_weight_kg} кг\n"
+    msg += f"  • Стало: {new_weight} кг\n"
+    msg += f"  • Разница: {new_weight - spec.total_weight_kg:+.2f} кг\n"
+    if spec.final_price is not None:
+        msg += f"\n💰 Итоговая цена: {spec.final_price:.2f} ₽\n"
+
+    msg += f"\n\n🔨 КОРПУСНЫЕ ДЕТАЛИ ({len(corpus_parts)} поз.):\n"
+    for i, p in enumerate(corpus_parts, 1):
+        thick_str = f"т.{p['thickness']}мм" if p.get('thickness') else ""
+        mat_str = f"{p['material']}" if p.get('material') else "ЛДСП"
+        attrs = ", ".join([x for x in [thick_str, mat_str] if x])
+        msg += f"{i}. {p['name']}\n"
+        msg += f"   📐 {p['size']} ({attrs}) × {p['qty']} шт\n"
+
+    if furniture_items:
+        msg += f"\n🔩 ФУРНИТУРА ({len(furniture_items)} поз.):\n"
+        for i, f in enumerate(furniture_items, 1):
+            code_str = f" [{f['code']}]" if f.get('code') else ""
+            qty_str = f"{f['qty']:.1f}" if f.get('qty') else "—"
+            unit_str = f.get('unit', 'шт')
+            meta_parts = []
+            if 'power_w' in f:
+                meta_parts.append(f"мощн. {round(f['power_w'], 2)} Вт")
+            if 'length_mm' in f:
+                meta_parts.append(f"дл. {f['length_mm']} мм")
+            if 'lengths_mm' in f:
+                lengths = ", ".join(str(l) for l in f['lengths_mm'])
+                meta_parts.append(f"длины: {lengths} мм")
+            meta_str = f" ({'; '.join(meta_parts)})" if meta_parts else ""
+            msg += f"{i}. {f['name']}{code_str}\n"
+            msg += f"   🔧 {qty_str} {unit_str}{meta_str}\n"
+
+    if cut_warnings:
+        msg += "\n\n⚠️ Предупреждения по раскрою:\n"
+        for w in cut_warnings:
+            msg += f"  • {w}\n"
+
+    if general_recommendations:
+        msg += "\n\nℹ️ Рекомендации:\n"
+        for rec in general_recommendations:
+            msg += f"  • {rec}\n"
+
+    # Разбиваем на несколько сообщений если слишком длинное
+    if len(msg) <= 4096:
+        return [msg]
+
+    # Telegram limit
+    parts = []
+    current_part = ""
+    for line in msg.split('\n'):
+        if len(current_part) + len(line) + 1 > 4000:
+            parts.append(current_part)
+            current_part = line + '\n'
+        else:
+            current_part += line + '\n'
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+
+def _render_recalc_summary(
+    spec: ParsedSpec,
+    new_width: int,
+    sections: List[int],
+    corpus_parts: List[dict],
+    new_weight: float,
+    cut_warnings: List[str],
+    furniture_items: List[dict],
+) -> str:
+    """Короткий ответ на пересчёт — подпись к XLSX, где лежат все детали и фурнитура."""
+    msg = "✅ Пересчёт завершён!\n\n"
+    msg += _format_structure(new_width, spec.depth_mm, spec.height_mm, sections)
+    msg += f"\n\n⚖️ Вес: {round(spec.total_weight_kg, 2)} → {new_weight} кг ({new_weight - spec.total_weight_kg:+.2f} кг)\n"
+    if spec.final_price is not None:
+        msg += f"💰 Итоговая цена: {spec.final_price:.2f} ₽\n"
+    msg += f"\n📎 В файле: {len(corpus_parts)} корпусных деталей, {len(furniture_items)} позиций фурнитуры"
+    if cut_warnings:
+        msg += f", ⚠️ предупреждений по раскрою: {len(cut_warnings)}"
+    return msg
+
+
+def _render_recalc_xlsx(
+    spec: ParsedSpec,
+    new_width: int,
+    sections: List[int],
+    corpus_parts: List[dict],
+    new_weight: float,
+    cut_warnings: List[str],
+    general_recommendations: List[str],
+    furniture_items: List[dict],
+) -> bytes:
+    """
+    Пересчитанная спецификация книгой XLSX с листами как во входном файле:
+    «Плитный материал» (габарит, вес, таблица деталей) и «Фурнитура», плюс
+    «Предупреждения», если они есть. Книга пишется в режиме write_only.
+    """
+    book = openpyxl.Workbook(write_only=True)
+    bold = openpyxl.styles.Font(bold=True)
+
+    def header(sheet: Any, titles: List[str]) -> List[Any]:
+        cells = []
+        for title in titles:
+            cell = openpyxl.cell.WriteOnlyCell(sheet, value=title)
+            cell.font = bold
+            cells.append(cell)
+        return cells
+
+    corpus = book.create_sheet("Плитный материал")
+    for col, width in zip("ABCDEF", (40, 10, 12, 16, 10, 40)):
+        corpus.column_dimensions[col].width = width
+    corpus.append(header(corpus, [spec.source_filename]))
+    corpus.append(["Габарит (Ш*Г*В)", f"{new_width}*{spec.depth_mm}*{spec.height_mm}"])
+    corpus.append(["Секции, мм", " | ".join(str(w) for w in sections)])
+    corpus.append(["Вес (кг) =", new_weight])
+    corpus.append(["Исходный вес (кг) =", round(spec.total_weight_kg, 2)])
+    if spec.final_price is not None:
+        corpus.append(["Итоговая цена, ₽", round(spec.final_price, 2)])
+    corpus.append([])
+    corpus.append(header(corpus, ["Плита ДСП", "Тлщн", "Длина, мм", "Ширина, мм", "Кол-во", "Материал"]))
+    for p in corpus_parts:
+        widths = p.get("widths_mm")
+        corpus.append([
+            p["name"],
+            p.get("thickness"),
+            p.get("length_mm"),
+            " / ".join(str(w) for w in widths) if widths else p.get("width_mm"),
+            p["qty"],
+            p.get("material") or "ЛДСП",
+        ])
+    corpus.append(["Кол-во дет.", sum(p["qty"] or 0 for p in corpus_parts)])
+
+    furniture = book.create_sheet("Фурнитура")
+    for col, width in zip("ABCDE", (24, 10, 50, 10, 40)):
+        furniture.column_dimensions[col].width = width
+    furniture.append(header(furniture, ["код фурнитуры", "кол-во", "наименование фурнитуры", "ед. изм", "примечание"]))
+    for f in furniture_items:
+        notes = []
+        if "power_w" in f:
+            notes.append(f"мощн. {round(f['power_w'], 2)} Вт")
+        if "length_mm" in f:
+            notes.append(f"дл. {f['length_mm']} мм")
+        if "lengths_mm" in f:
+            notes.append("длины: " + ", ".join(str(l) for l in f["lengths_mm"]) + " мм")
+        furniture.append([f.get("code"), f.get("qty"), f["name"], f.get("unit", "шт"), "; ".join(notes) or None])
+
+    if cut_warnings or general_recommendations:
+        notes_sheet = book.create_sheet("Предупреждения")
+        notes_sheet.column_dimensions["B"].width = 100
+        notes_sheet.append(header(notes_sheet, ["Тип", "Текст"]))
+        for w in cut_warnings:
+            notes_sheet.append(["раскрой", w])
+        for rec in general_recommendations:
+            notes_sheet.append(["рекомендация", rec])
+
+    buf = io.BytesIO()
+    book.save(buf)
+    return buf.getvalue()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     username = getattr(user, "username", None) or getattr(user, "full_name", None) or "—"
@@ -1484,7 +4184,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "1) 📤 Загрузи Excel (.xls или .xlsx). Я читаю лист с корпусными деталями и — если есть — лист с фурнитурой.\n"
         "2) 🔍 Автоматически определю габариты (Ш×Г×В), ширину секции и их количество по задним стенкам, крышкам и другим деталям.\n"
         "3) ⚖️ Посчитаю вес по геометрии (объём × плотность материала) и отмечу материалы.\n"
-        "4) ✏️ Введи новую ширину в мм (например, 3600) — я пересчитаю детали, пролёты и фурнитуру.\n\n"
+        "4) ✏️ Введи новую ширину в мм (например, 3600) — я пересчитаю детали, пролёты и фурнитуру и пришлю результат файлом .xlsx.\n\n"
         "Хочешь понять формулы и логику? Напиши /help — там подробно расписано, как я считаю ширину, вес и фурнитуру.\n\n"
         "Если что-то непонятно, просто напиши мне число новой ширины после загрузки файла — разберёмся вместе."
     )
@@ -1505,6 +4205,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "5) Крышка/дно: если в исходнике цельные детали на весь шкаф — просто растягиваем до новой ширины; если каждая секция имела свою крышку/дно, умножаем их количество на число секций и длину делаем равной ширине секции.\n"
         "6) Задние стенки, цоколь, перегородки и стойки масштабируются по количеству секций: стенки = секции, перегородки = секции−1, стойки = секции+1.\n"
         "7) Фурнитура: петли — по числу фасадов, ручки — фасады + ящики, полкодержатели — по пересчитанным полкам, штанги — по секциям с гардеробными зонами, подсветка — по пролётам (длина ≈ ширина пролёта − 100 мм).\n\n"
+        "📈 Таблица по диапазону ширин: /sweep 1200 6000 50 — пришлю CSV с весом и количеством деталей и фурнитуры для каждой ширины.\n\n"
+        "📦 Много файлов сразу: пришли zip-архив с .xls/.xlsx — верну одну сводную таблицу. Число в подписи к архиву — "
+        "новая ширина для всех файлов, файл widths.csv в архиве (строки «имя файла;ширина») — ширины по отдельности.\n\n"
         "⚖️ Как считаем вес (точно, не приблизительно):\n"
         "• Для каждой детали считаем объём: (длина/1000) × (ширина/1000) × (толщина/1000) × количество.\n"
         "• Плотность: ЛДСП — 750 кг/м³, МДФ — 800 кг/м³, фанера — 600 кг/м³ (определяем по названию или толщине).\n"
@@ -1517,6 +4220,258 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(text)
 
 
+async def sweep_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    args = context.args or []
+    logger.info("Command /sweep by user_id=%s args=%s", user_id, args)
+
+    spec = await asyncio.to_thread(USER_STATE.get, user_id)
+    if spec is None:
+        await update.message.reply_text("⚠️ Сначала пришли Excel-файл с калькуляцией.\nИспользуй /start для инструкций.")
+        return
+
+    usage = "ℹ️ Формат: /sweep <от> <до> <шаг>, например: /sweep 1200 6000 50"
+    try:
+        start_w, end_w, step = (int(a) for a in args)
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+
+    if step <= 0 or start_w > end_w or start_w < MIN_WIDTH_MM or end_w > MAX_WIDTH_MM:
+        await update.message.reply_text(
+            f"⚠️ Ширины должны быть от {MIN_WIDTH_MM} до {MAX_WIDTH_MM} мм, шаг — больше нуля.\n" + usage
+        )
+        return
+
+    widths = range(start_w, end_w + 1, step)
+    if len(widths) > SWEEP_MAX_WIDTHS:
+        await update.message.reply_text(f"⚠️ Слишком много ширин ({len(widths)}), максимум {SWEEP_MAX_WIDTHS}. Увеличь шаг.")
+        return
+
+    await update.message.reply_text(f"📈 Считаю {len(widths)} вариантов ширины...")
+
+    try:
+        table = await RECALC_POOL.run_measured("sweep", _sweep_widths, spec, widths)
+        with STAGE_STATS.stage("render"):
+            document = _sweep_to_csv(table)
+        with STAGE_STATS.stage("send"):
+            await update.message.reply_document(
+                document=document,
+                filename=f"sweep_{start_w}_{end_w}_{step}.csv",
+                caption=f"📈 {spec.source_filename}: ширины {start_w}–{end_w} мм с шагом {step} мм",
+            )
+    except WorkerBusyError as e:
+        logger.warning("Sweep for user_id=%s rejected: %s", user_id, e)
+        await update.message.reply_text("⏳ Сервер сейчас загружен. Повтори команду через минуту.")
+    except asyncio.TimeoutError:
+        logger.error("Sweep for user_id=%s timed out after %ss", user_id, RECALC_POOL.timeout_s)
+        await update.message.reply_text("⌛ Расчёт занял слишком много времени. Попробуй увеличить шаг.")
+    except Exception as e:
+        logger.exception("Failed to sweep widths")
+        await update.message.reply_text(f"❌ Ошибка расчёта:\n{str(e)}")
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_USER_IDS:
+        logger.warning("Command /stats denied for user_id=%s", user_id)
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+
+    msg = "📊 Этапы обработки, p50/p95/p99 (последние {} замеров):\n".format(STAGE_STATS.window)
+    msg += STAGE_STATS.render_text()
+    msg += f"\n\n⚙️ Очереди: разбор {PARSE_POOL.pending}/{PARSE_POOL.max_pending}, пересчёт {RECALC_POOL.pending}/{RECALC_POOL.max_pending}"
+    msg += "\n🛣 Полосы (ждут/работают/лимит): " + ", ".join(
+        f"{name} {st['waiting']}/{st['running']}/{st['limit']}" for name, st in UPDATE_LANES.stats().items()
+    )
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        msg += (
+            f"\n🚫 Устаревших запросов отменено: {processor.superseded}, "
+            f"задач снято с пулов: разбор {PARSE_POOL.cancelled}, пересчёт {RECALC_POOL.cancelled}"
+        )
+    msg += f"\n🗂 Кэш спецификаций: {SPEC_CACHE.stats()}"
+    msg += f"\n🔗 Одинаковые загрузки: {UPLOAD_FLIGHTS.stats()}"
+    msg += f"\n👤 Сессий в памяти: {len(USER_STATE)}"
+    msg += f"\n🧮 Память пересчётов: {RECALC_MEMO.stats()}"
+    await update.message.reply_text(msg)
+
+
+class HttpRequest:
+    """Запрос, прочитанный _read_http_request: метод, путь без query, заголовки в нижнем регистре, тело."""
+
+    __slots__ = ("method", "path", "headers", "body")
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> None:
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+
+class HttpError(Exception):
+    def __init__(self, status: str) -> None:
+        super().__init__(status)
+        self.status = status
+
+
+async def _read_http_request(
+    reader: asyncio.StreamReader, timeout_s: float, max_body: int = 0
+) -> Optional[HttpRequest]:
+    """Один HTTP/1.1-запрос из потока; None — клиент закрыл соединение. Тело — только с Content-Length."""
+    request_line = await asyncio.wait_for(reader.readline(), timeout_s)
+    if not request_line.strip():
+        return None
+    headers: Dict[str, str] = {}
+    while True:
+        line = (await asyncio.wait_for(reader.readline(), timeout_s)).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        raise HttpError("400 Bad Request")
+
+    length = int(headers.get("content-length") or 0)
+    if length > max_body:
+        raise HttpError("413 Payload Too Large")
+    body = await asyncio.wait_for(reader.readexactly(length), timeout_s) if length else b""
+    return HttpRequest(parts[0], parts[1].split("?")[0], headers, body)
+
+
+def _write_http_response(
+    writer: asyncio.StreamWriter, status: str, body: bytes, content_type: str, keep_alive: bool = False
+) -> None:
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+    )
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Минимальный HTTP-ответ для Prometheus: GET /metrics, остальное — 404."""
+    try:
+        request = await _read_http_request(reader, 5)
+        if request is not None and request.method == "GET" and request.path == "/metrics":
+            text = STAGE_STATS.render_prometheus() + UPLOAD_FLIGHTS.render_prometheus() + UPDATE_LANES.render_prometheus()
+            status, body = "200 OK", text.encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        _write_http_response(writer, status, body, "text/plain; version=0.0.4; charset=utf-8")
+        await writer.drain()
+    except HttpError as e:
+        _write_http_response(writer, e.status, b"", "text/plain")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _start_metrics_server(app: Application) -> None:
+    if METRICS_PORT <= 0:
+        return
+    server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+    app.bot_data["metrics_server"] = server
+    logger.info("Prometheus metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+
+def _warm_up() -> None:
+    """Импорт тяжёлых зависимостей и построение таблицы раскладок до первого файла."""
+    for module in _LAZY_MODULES:
+        # pandas нужен только для EXCEL_READER=pandas
+        if module._name != "pandas" or EXCEL_READER == "pandas":
+            module._load()
+    _cell_ufuncs()
+    LAYOUT_TABLE.ensure_built()
+
+
+async def _warm_up_in_background() -> None:
+    await asyncio.sleep(WARM_UP_DELAY_S)
+    try:
+        with STAGE_STATS.stage("warm_up"):
+            await asyncio.to_thread(_warm_up)
+            # Процессы пула разбора создаются лениво — поднимаем их заранее
+            await asyncio.gather(*(PARSE_POOL.run(_warm_up) for _ in range(PARSE_POOL.workers)))
+        logger.info("Warm-up finished in %.2fs", STAGE_STATS.snapshot()["warm_up"]["p50"])
+    except Exception:
+        logger.exception("Warm-up failed")
+
+
+async def _post_init(app: Application) -> None:
+    await _start_metrics_server(app)
+    startup_s = time.perf_counter() - _STARTED_AT
+    # Для старта вместо прироста памяти — пиковый RSS процесса к моменту готовности
+    STAGE_STATS.record("startup", startup_s, _max_rss_bytes())
+    logger.info("Bot ready in %.2fs (module import %.2fs)", startup_s, MODULE_IMPORT_S)
+    if WARM_UP:
+        app.bot_data["warm_up_task"] = asyncio.create_task(_warm_up_in_background())
+
+
+async def _parse_upload(upload: Upload, doc: Document, digest: str) -> ParsedSpec:
+    spec = await PARSE_POOL.run_measured(None, _build_spec, upload.source(), doc.file_name)
+    SPEC_CACHE.remember(digest, spec, doc.file_unique_id)
+    await asyncio.to_thread(SPEC_CACHE.write_disk, digest, spec, doc.file_unique_id)
+    return spec
+
+
+def _start_parse_upload(upload: Upload, doc: Document, digest: str) -> asyncio.Task:
+    """
+    Задача разбора для UPLOAD_FLIGHTS. Она держит загрузку сама: к разбору
+    присоединяются загрузки того же содержимого от других людей, и если первый
+    загрузивший уйдёт, его временный файл не должен исчезнуть из-под разбора.
+    Загрузка отпускается по завершении задачи — даже отменённой до первого шага.
+    """
+    task = asyncio.ensure_future(_parse_upload(upload.retain(), doc, digest))
+    task.add_done_callback(lambda _: upload.close())
+    return task
+
+
+async def _fetch_spec(doc: Document) -> ParsedSpec:
+    """
+    Скачивание и разбор файла, которого нет в кэше по file_unique_id. Разбор
+    склеивается по хэшу содержимого: один и тот же файл, загруженный разными
+    людьми одновременно, разбирается один раз. Задача разбора держит загрузку
+    сама (_start_parse_upload), поэтому временный файл живёт, пока разбор не
+    закончится, даже если загрузивший его ушёл.
+    """
+    with Upload(doc.file_size, os.path.splitext(doc.file_name.lower())[1]) as upload:
+        with STAGE_STATS.stage("download"):
+            tg_file = await doc.get_file()
+            await tg_file.download_to_memory(upload.file)
+        # file_size в Document необязателен — проверяем и по факту
+        if upload.size > MAX_UPLOAD_BYTES:
+            raise ValueError(f"файл больше {MAX_UPLOAD_BYTES / 1048576:.0f} МБ")
+        digest = upload.digest()
+
+        spec = SPEC_CACHE.get(file_unique_id=doc.file_unique_id, digest=digest)
+        if spec is None:
+            spec = await UPLOAD_FLIGHTS.run(("sha256", digest), partial(_start_parse_upload, upload, doc, digest))
+        else:
+            logger.info("Спецификация найдена в кэше по хэшу %s (%s)", digest[:12], SPEC_CACHE.stats())
+    return spec
+
+
+async def _save_user_spec(user_id: int, spec: ParsedSpec) -> None:
+    """
+    Запись сессии в потоке. Отменённый обработчик (его обновление перекрыто
+    новым) всё равно дожидается конца записи: иначе она могла бы закончиться
+    уже после записи следующего обновления того же пользователя и затереть её.
+    """
+    write = asyncio.ensure_future(asyncio.to_thread(USER_STATE.set, user_id, spec))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        await asyncio.wait((write,))
+        raise
+
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     doc: Document = update.message.document
     user_id = update.effective_user.id
@@ -1528,66 +4483,179 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         doc.file_name,
     )
 
-    if not doc.file_name.lower().endswith((".xls", ".xlsx")):
-        await update.message.reply_text("⚠️ Нужен Excel-файл (.xls или .xlsx)")
+    is_zip = doc.file_name.lower().endswith(".zip")
+    if not is_zip and not doc.file_name.lower().endswith(SPEC_EXTENSIONS):
+        await update.message.reply_text("⚠️ Нужен Excel-файл (.xls или .xlsx) или zip-архив с ними")
+        return
+
+    if doc.file_size and doc.file_size > MAX_UPLOAD_BYTES:
+        logger.warning("Document from user_id=%s rejected: %s bytes", user_id, doc.file_size)
+        await update.message.reply_text(
+            f"⚠️ Файл слишком большой: {doc.file_size / 1048576:.1f} МБ, можно до {MAX_UPLOAD_BYTES / 1048576:.0f} МБ."
+        )
+        return
+
+    if is_zip:
+        await handle_batch_upload(update, doc)
         return
 
     await update.message.reply_text("⏳ Обрабатываю файл...")
 
     try:
-        tg_file = await doc.get_file()
-        file_bytes = await tg_file.download_as_bytearray()
-        file_bytes = bytes(file_bytes)
+        spec = SPEC_CACHE.get(file_unique_id=doc.file_unique_id)
+        if spec is None:
+            if PARSE_POOL.is_full:
+                raise WorkerBusyError("очередь разбора заполнена")
+            # Пересланный файл приходит с тем же file_unique_id — не скачиваем его второй раз
+            spec = await UPLOAD_FLIGHTS.run(("file", doc.file_unique_id), partial(_fetch_spec, doc))
+        else:
+            logger.info("Спецификация найдена в кэше по file_unique_id=%s (%s)", doc.file_unique_id, SPEC_CACHE.stats())
 
-        df_corpus, df_furniture = _read_excel_to_sheets(file_bytes, doc.file_name)
-        
-        corpus_rows = _parse_corpus_rows(df_corpus)
-        logger.info(f"Распознано {len(corpus_rows)} строк корпуса")
-        
-        furniture_items = _parse_furniture_rows(df_furniture) if df_furniture is not None else []
-        logger.info(f"Распознано {len(furniture_items)} позиций фурнитуры")
-        
-        width_total, depth, height, sections, section_width = _infer_geometry_smart(df_corpus, corpus_rows)
-        total_weight = _calculate_total_weight(df_corpus)
-        if not total_weight:
-            total_weight = _calculate_total_weight_by_rows(corpus_rows)
-        base_cost = _calculate_base_cost(df_corpus)
-        final_price = _calculate_final_price(base_cost)
-        
-        spec = ParsedSpec(
-            source_filename=doc.file_name,
-            width_total_mm=width_total,
-            depth_mm=depth,
-            height_mm=height,
-            sections_count=sections,
-            section_width_mm=section_width,
-            corpus_rows=corpus_rows,
-            furniture_items=furniture_items,
-            total_weight_kg=total_weight,
-            base_cost=base_cost,
-            final_price=final_price,
-        )
-        
-        USER_STATE[user_id] = spec
-
-        sections_list = [section_width] * sections
-        msg = "✅ Файл успешно обработан!\n\n"
-        msg += _format_structure(width_total, depth, height, sections_list)
-        msg += f"\n\n📊 Найдено:\n"
-        msg += f"  • Корпусных деталей: {len([r for r in corpus_rows if r.qty])} позиций\n"
-        msg += f"  • Фурнитуры: {len(furniture_items)} позиций\n"
-        msg += f"  • Общий вес: {total_weight} кг\n"
-        if final_price is not None:
-            msg += f"  • Итоговая цена: {final_price:.2f} ₽\n"
-        msg += f"\n💬 Введи новую ширину шкафа в мм (например: 3600)"
-        
-        await update.message.reply_text(msg)
+        if spec.source_filename != doc.file_name:
+            spec = replace(spec, source_filename=doc.file_name)
+
+        await _save_user_spec(user_id, spec)
+
+        with STAGE_STATS.stage("render"):
+            msg = _render_upload_message(spec)
+
+        with STAGE_STATS.stage("send"):
+            await update.message.reply_text(msg)
         
+    except WorkerBusyError as e:
+        logger.warning("Document from user_id=%s rejected: %s", user_id, e)
+        await update.message.reply_text("⏳ Сейчас обрабатывается много файлов. Пришли файл ещё раз через минуту.")
+    except WorkerLimitError as e:
+        logger.warning("Document from user_id=%s hit the sandbox limit: %s", user_id, e.reason)
+        await update.message.reply_text(
+            "⚠️ Файл слишком большой или сложный для обработки. "
+            "Проверь, нет ли в книге лишних листов или тысяч пустых отформатированных строк, и пришли файл ещё раз."
+        )
+    except asyncio.TimeoutError:
+        logger.error("Document from user_id=%s timed out after %ss", user_id, PARSE_POOL.timeout_s)
+        await update.message.reply_text("⌛ Файл обрабатывается слишком долго. Попробуй файл поменьше или обратись к разработчику.")
     except Exception as e:
         logger.exception("Failed to process document")
         await update.message.reply_text(f"❌ Ошибка обработки файла:\n{str(e)}\n\nПопробуй другой файл или обратись к разработчику.")
 
 
+async def handle_batch_upload(update: Update, doc: Document) -> None:
+    """
+    Zip-архив спецификаций: каждый файл разбирается и пересчитывается в пуле
+    разбора, в ответ — одна сводная XLSX-таблица. Число в подписи к архиву —
+    новая ширина для всех файлов, widths.csv в архиве — ширины по файлам.
+    """
+    user_id = update.effective_user.id
+    m = re.search(r"\d+", (update.message.caption or "").replace(" ", ""))
+    default_width = int(m.group(0)) if m else None
+    if default_width is not None and not MIN_WIDTH_MM <= default_width <= MAX_WIDTH_MM:
+        await update.message.reply_text(f"⚠️ Ширина должна быть от {MIN_WIDTH_MM} до {MAX_WIDTH_MM} мм.")
+        return
+
+    try:
+        with Upload(doc.file_size, ".zip") as upload:
+            with STAGE_STATS.stage("download"):
+                tg_file = await doc.get_file()
+                await tg_file.download_to_memory(upload.file)
+            if upload.size > MAX_UPLOAD_BYTES:
+                raise ValueError(f"архив больше {MAX_UPLOAD_BYTES / 1048576:.0f} МБ")
+            source = upload.source()
+
+            with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as archive:
+                # Распаковка идёт в потоке: ZipFile читает члены архива под своей блокировкой
+                specs, overrides = await asyncio.to_thread(_zip_batch_inputs, archive)
+                if not specs:
+                    await update.message.reply_text("⚠️ В архиве нет файлов .xls или .xlsx")
+                    return
+                await update.message.reply_text(f"⏳ Обрабатываю архив: {len(specs)} файлов...")
+
+                out = io.BytesIO()
+                writer = BatchWriter(out, "xlsx")
+                # Не больше задач, чем воркеров, — остальные файлы ждут здесь, а не в очереди пула
+                slots = asyncio.Semaphore(PARSE_POOL.workers)
+
+                async def run_item(name: str, info: zipfile.ZipInfo) -> List[Dict[str, Any]]:
+                    async with slots:
+                        width = _batch_width(name, overrides, default_width)
+                        data = await asyncio.to_thread(archive.read, info)
+                        try:
+                            return await PARSE_POOL.run_measured(None, _batch_item, name, data, width)
+                        except WorkerBusyError as e:
+                            return [_batch_error_row(name, e)]
+                        except WorkerLimitError as e:
+                            return [_batch_error_row(name, f"файл слишком большой или сложный ({e.reason})")]
+                        except asyncio.TimeoutError:
+                            return [_batch_error_row(name, f"разбор дольше {PARSE_POOL.timeout_s:.0f} с")]
+
+                for done in asyncio.as_completed([run_item(name, info) for name, info in specs]):
+                    writer.write(await done)
+                writer.close()
+
+        logger.info("Batch from user_id=%s: %s files, %s failed", user_id, writer.files, writer.failed)
+        caption = f"📦 Обработано файлов: {writer.files - writer.failed} из {writer.files}"
+        if writer.failed:
+            caption += f", с ошибками: {writer.failed} (status=error в таблице)"
+        with STAGE_STATS.stage("send"):
+            await update.message.reply_document(
+                document=out.getvalue(),
+                filename=f"{os.path.splitext(doc.file_name)[0]}_пакет.xlsx",
+                caption=caption,
+            )
+    except zipfile.BadZipFile:
+        await update.message.reply_text("❌ Не удалось открыть zip-архив. Проверь файл и пришли ещё раз.")
+    except Exception as e:
+        logger.exception("Failed to process batch")
+        await update.message.reply_text(f"❌ Ошибка обработки архива:\n{str(e)}")
+
+
+async def _reply_recalc_xlsx(
+    update: Update,
+    spec: ParsedSpec,
+    new_width: int,
+    sections: List[int],
+    corpus_parts: List[dict],
+    new_weight: float,
+    cut_warnings: List[str],
+    general_recommendations: List[str],
+    furniture_items: List[dict],
+    document: Optional[bytes] = None,
+) -> Optional[bytes]:
+    """
+    Отправляет пересчёт одним XLSX с короткой подписью. document — уже собранная
+    ранее книга. Возвращает отправленную книгу; None — файл не собрался или
+    Telegram его отклонил.
+    """
+    if document is None:
+        try:
+            document = await RECALC_POOL.run_measured(
+                "render", _render_recalc_xlsx,
+                spec, new_width, sections, corpus_parts, new_weight, cut_warnings, general_recommendations, furniture_items,
+            )
+        except Exception as e:
+            logger.warning("Could not build XLSX reply for user_id=%s: %r", update.effective_user.id, e)
+            return None
+
+    with STAGE_STATS.stage("render"):
+        summary: Optional[str] = _render_recalc_summary(
+            spec, new_width, sections, corpus_parts, new_weight, cut_warnings, furniture_items
+        )
+    with STAGE_STATS.stage("send"):
+        # Подпись к документу — не длиннее 1024 символов
+        if len(summary) > 1024:
+            await update.message.reply_text(summary)
+            summary = None
+        try:
+            await update.message.reply_document(
+                document=document,
+                filename=f"{os.path.splitext(spec.source_filename)[0]}_{new_width}.xlsx",
+                caption=summary,
+            )
+        except BadRequest as e:
+            logger.warning("XLSX reply for user_id=%s rejected: %s", update.effective_user.id, e)
+            return None
+    return document
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     text = (update.message.text or "").strip()
@@ -1600,9 +4668,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         preview,
     )
 
-    if user_id not in USER_STATE:
+    entry = await asyncio.to_thread(USER_STATE.get_entry, user_id)
+    if entry is None:
         await update.message.reply_text("⚠️ Сначала пришли Excel-файл с калькуляцией.\nИспользуй /start для инструкций.")
         return
+    spec, fingerprint = entry
 
     # Парсим число
     m = re.search(r"\d+", text.replace(" ", ""))
@@ -1611,104 +4681,380 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     new_width = int(m.group(0))
-    if new_width < 300 or new_width > 10000:
-        await update.message.reply_text("⚠️ Ширина должна быть от 300 до 10000 мм.")
+    if new_width < MIN_WIDTH_MM or new_width > MAX_WIDTH_MM:
+        await update.message.reply_text(f"⚠️ Ширина должна быть от {MIN_WIDTH_MM} до {MAX_WIDTH_MM} мм.")
         return
 
-    spec = USER_STATE[user_id]
-    
-    await update.message.reply_text("🔄 Пересчитываю спецификацию...")
+    memo = RECALC_MEMO.get(user_id, fingerprint, new_width)
+    if memo is None:
+        await update.message.reply_text("🔄 Пересчитываю спецификацию...")
+    else:
+        logger.info("Пересчёт на %s мм для user_id=%s взят из памяти (%s)", new_width, user_id, RECALC_MEMO.stats())
 
     try:
-        sections = _split_sections(new_width)
-        corpus_parts, new_weight, cut_warnings, general_recommendations, furniture_items = _recalculate_corpus(spec, new_width)
-
-        # Формируем ответ
-        msg = "✅ Пересчёт завершён!\n\n"
-        msg += _format_structure(new_width, spec.depth_mm, spec.height_mm, sections)
-        msg += f"\n\n⚖️ Вес изделия:\n"
-        msg += f"  • Было: {spec.total_weight_kg} кг\n"
-        msg += f"  • Стало: {new_weight} кг\n"
-        msg += f"  • Разница: {new_weight - spec.total_weight_kg:+.2f} кг\n"
-        if spec.final_price is not None:
-            msg += f"\n💰 Итоговая цена: {spec.final_price:.2f} ₽\n"
-        
-        msg += f"\n\n🔨 КОРПУСНЫЕ ДЕТАЛИ ({len(corpus_parts)} поз.):\n"
-        for i, p in enumerate(corpus_parts, 1):
-            thick_str = f"т.{p['thickness']}мм" if p.get('thickness') else ""
-            mat_str = f"{p['material']}" if p.get('material') else "ЛДСП"
-            attrs = ", ".join([x for x in [thick_str, mat_str] if x])
-            msg += f"{i}. {p['name']}\n"
-            msg += f"   📐 {p['size']} ({attrs}) × {p['qty']} шт\n"
-
-        if furniture_items:
-            msg += f"\n🔩 ФУРНИТУРА ({len(furniture_items)} поз.):\n"
-            for i, f in enumerate(furniture_items, 1):
-                code_str = f" [{f['code']}]" if f.get('code') else ""
-                qty_str = f"{f['qty']:.1f}" if f.get('qty') else "—"
-                unit_str = f.get('unit', 'шт')
-                meta_parts = []
-                if 'power_w' in f:
-                    meta_parts.append(f"мощн. {round(f['power_w'], 2)} Вт")
-                if 'length_mm' in f:
-                    meta_parts.append(f"дл. {f['length_mm']} мм")
-                if 'lengths_mm' in f:
-                    lengths = ", ".join(str(l) for l in f['lengths_mm'])
-                    meta_parts.append(f"длины: {lengths} мм")
-                meta_str = f" ({'; '.join(meta_parts)})" if meta_parts else ""
-                msg += f"{i}. {f['name']}{code_str}\n"
-                msg += f"   🔧 {qty_str} {unit_str}{meta_str}\n"
-
-        if cut_warnings:
-            msg += "\n\n⚠️ Предупреждения по раскрою:\n"
-            for w in cut_warnings:
-                msg += f"  • {w}\n"
-
-        if general_recommendations:
-            msg += "\n\nℹ️ Рекомендации:\n"
-            for rec in general_recommendations:
-                msg += f"  • {rec}\n"
-        
-        # Разбиваем на несколько сообщений если слишком длинное
-        if len(msg) > 4096:
-            # Telegram limit
-            parts = []
-            current_part = ""
-            for line in msg.split('\n'):
-                if len(current_part) + len(line) + 1 > 4000:
-                    parts.append(current_part)
-                    current_part = line + '\n'
-                else:
-                    current_part += line + '\n'
-            if current_part:
-                parts.append(current_part)
-            
-            for part in parts:
-                await update.message.reply_text(part)
-        else:
-            await update.message.reply_text(msg)
-        
+        sections = LAYOUT_TABLE.get(new_width).sections
+        if memo is None:
+            # Разбор спецификации для пересчёта не зависит от ширины — делаем его один раз на сессию
+            ctx = RECALC_MEMO.context(user_id, fingerprint, spec)
+            if ctx is None:
+                ctx = await asyncio.to_thread(_prepare_recalc, spec)
+                RECALC_MEMO.put_context(user_id, fingerprint, spec, ctx)
+            recalculated = await RECALC_POOL.run_measured("recalc", _recalculate_corpus, spec, new_width, ctx)
+            memo = RECALC_MEMO.put(user_id, fingerprint, new_width, recalculated)
+
+        result = (spec, new_width, sections, *memo[0])
+        memo[1] = await _reply_recalc_xlsx(update, *result, memo[1])
+        if memo[1] is None:
+            # Запасной путь: полный текст несколькими сообщениями
+            with STAGE_STATS.stage("render"):
+                parts = _render_recalc_message(*result)
+            with STAGE_STATS.stage("send"):
+                for part in parts:
+                    await update.message.reply_text(part)
+
         # Предложение пересчитать ещё раз
         await update.message.reply_text(
             "💡 Хочешь пересчитать под другую ширину? Просто введи новое значение в мм.\n"
             "Или пришли новый Excel-файл для другого изделия."
         )
         
+    except WorkerBusyError as e:
+        logger.warning("Recalculation for user_id=%s rejected: %s", user_id, e)
+        await update.message.reply_text("⏳ Сервер сейчас загружен. Повтори ширину через минуту.")
+    except asyncio.TimeoutError:
+        logger.error("Recalculation for user_id=%s timed out after %ss", user_id, RECALC_POOL.timeout_s)
+        await update.message.reply_text("⌛ Пересчёт занял слишком много времени. Попробуй ещё раз.")
     except Exception as e:
         logger.exception("Failed to recalculate")
         await update.message.reply_text(f"❌ Ошибка пересчёта:\n{str(e)}")
 
 
+class UpdateLane:
+    """
+    Полоса обработки обновлений: не больше limit обработчиков сразу, остальные
+    ждут своей очереди (asyncio.Semaphore отпускает их по порядку). Время
+    ожидания слота пишется в STAGE_STATS этапом queue_<имя полосы>.
+    """
+
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = max(1, limit)
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def acquire(self) -> None:
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        STAGE_STATS.record(f"queue_{self.name}", time.perf_counter() - queued, 0)
+        self.running += 1
+
+    def release(self) -> None:
+        self.running -= 1
+        self.processed += 1
+        self._slots.release()
+
+
+class UpdateLanes:
+    """
+    Распределение обновлений по полосам: команды, пересчёты ширин и тяжёлые
+    задачи (файлы, архивы, /sweep) не занимают слоты друг друга, поэтому
+    очередь из больших книг не задерживает /start и пересчёт у других
+    пользователей.
+    """
+
+    HEAVY_COMMANDS = ("/sweep",)
+
+    def __init__(self, command: int, recalc: int, heavy: int) -> None:
+        self.lanes = {
+            "command": UpdateLane("command", command),
+            "recalc": UpdateLane("recalc", recalc),
+            "heavy": UpdateLane("heavy", heavy),
+        }
+
+    def for_update(self, update: object) -> UpdateLane:
+        message = update.message if isinstance(update, Update) else None
+        if message is None:
+            return self.lanes["command"]
+        if message.document is not None:
+            return self.lanes["heavy"]
+        text = message.text or ""
+        if not text.startswith("/"):
+            return self.lanes["recalc"]
+        command = text.split(maxsplit=1)[0].split("@", 1)[0].lower()
+        return self.lanes["heavy" if command in self.HEAVY_COMMANDS else "command"]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {"waiting": lane.waiting, "running": lane.running, "limit": lane.limit, "processed": lane.processed}
+            for name, lane in self.lanes.items()
+        }
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, kind, help_text, attr in (
+            ("queue_depth", "gauge", "Updates waiting for a slot in the lane.", "waiting"),
+            ("running", "gauge", "Updates being handled in the lane.", "running"),
+            ("limit", "gauge", "Concurrent handlers allowed in the lane.", "limit"),
+            ("processed_total", "counter", "Updates handled in the lane.", "processed"),
+        ):
+            lines.append(f"# HELP wardrobe_lane_{name} {help_text}")
+            lines.append(f"# TYPE wardrobe_lane_{name} {kind}")
+            for lane in self.lanes.values():
+                lines.append(f'wardrobe_lane_{name}{{lane="{lane.name}"}} {getattr(lane, attr)}')
+        return "\n".join(lines) + "\n"
+
+
+UPDATE_LANES = UpdateLanes(LANE_COMMAND_CONCURRENCY, LANE_RECALC_CONCURRENCY, LANE_HEAVY_CONCURRENCY)
+
+
+def _update_weight(update: object) -> int:
+    """
+    Насколько обновление перекрывает предыдущие от того же пользователя:
+    1 — ширина (текст), 2 — новый файл спецификации, 0 — не перекрывает
+    и само не отменяется (команды, архивы и всё остальное).
+    """
+    message = update.message if isinstance(update, Update) else None
+    if message is None:
+        return 0
+    if message.document is not None:
+        return 2 if (message.document.file_name or "").lower().endswith(SPEC_EXTENSIONS) else 0
+    if message.text and not message.text.startswith("/"):
+        return 1
+    return 0
+
+
+class _QueuedUpdate:
+    __slots__ = ("weight", "task", "superseded")
+
+    def __init__(self, weight: int) -> None:
+        self.weight = weight
+        self.task: Optional[asyncio.Task] = None
+        self.superseded = False
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка для каждого
+    пользователя: обновления одного user_id ждут друг друга на его замке.
+    Замок (asyncio.Lock) отпускает ожидающих в порядке очереди, а задачи на
+    обновления создаются в порядке поступления, так что ответы одному
+    пользователю не перемешиваются. Замки без ожидающих сразу удаляются.
+
+    Сколько обработчиков работает одновременно, решают полосы (UpdateLanes):
+    слот полосы берётся уже под замком пользователя, так что ждущие своей
+    очереди обновления одного пользователя слоты не занимают.
+    max_concurrent_updates — лишь предел принятых обновлений вместе с ждущими.
+
+    С supersede новое обновление отменяет более старые того же пользователя
+    с весом не больше своего (_update_weight): новая ширина — прежние
+    пересчёты, новый файл — и пересчёты, и разбор прежнего файла. Ещё не
+    начатые пропускаются, выполняющиеся отменяются вместе с ожиданием пула,
+    так что ответ, который никто не прочтёт, не считается. Файл не отменяется
+    шириной, пришедшей после него, — ширина относится уже к нему.
+    """
+
+    def __init__(self, max_concurrent_updates: int, lanes: UpdateLanes, supersede: bool = True) -> None:
+        super().__init__(max_concurrent_updates)
+        self.lanes = lanes
+        self.supersede = supersede
+        self.superseded = 0
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._queues: Dict[int, List[_QueuedUpdate]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        lane = self.lanes.for_update(update)
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await self._run_in_lane(lane, coroutine)
+            return
+
+        entry = _QueuedUpdate(_update_weight(update) if self.supersede else 0)
+        queued = self._queues.setdefault(user.id, [])
+        if entry.weight:
+            for older in queued:
+                if 0 < older.weight <= entry.weight and not older.superseded:
+                    older.superseded = True
+                    self.superseded += 1
+                    if older.task is not None:
+                        older.task.cancel()
+        queued.append(entry)
+
+        lock = self._locks.setdefault(user.id, asyncio.Lock())
+        try:
+            async with lock:
+                if entry.superseded:
+                    coroutine.close()
+                    logger.info("Update %s from user_id=%s skipped: superseded", update.update_id, user.id)
+                    return
+                # Отдельная задача — чтобы отменить обработку (и ожидание слота полосы),
+                # не отменяя обёртку приложения
+                entry.task = asyncio.ensure_future(self._run_in_lane(lane, coroutine))
+                try:
+                    await asyncio.wait((entry.task,))
+                except asyncio.CancelledError:
+                    entry.task.cancel()
+                    raise
+                if entry.task.cancelled():
+                    # Задача могла быть отменена до первого шага — тогда обработчик ещё не запущен
+                    coroutine.close()
+                    logger.info("Update %s from user_id=%s cancelled: superseded", update.update_id, user.id)
+                else:
+                    entry.task.result()
+        finally:
+            queued.remove(entry)
+            if not queued:
+                del self._queues[user.id]
+                del self._locks[user.id]
+
+    @staticmethod
+    async def _run_in_lane(lane: UpdateLane, coroutine: Awaitable[Any]) -> None:
+        try:
+            await lane.acquire()
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        try:
+            await coroutine
+        finally:
+            lane.release()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def _serve_webhook(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    Вебхук: POST WEBHOOK_PATH с JSON-обновлением кладётся в очередь приложения,
+    ответ 200 уходит сразу, не дожидаясь обработки. GET /healthz — для
+    балансировщика. Соединение держится открытым, пока клиент шлёт запросы.
+    """
+    try:
+        while True:
+            request = await _read_http_request(reader, 30, max_body=1024 * 1024)
+            if request is None:
+                break
+            if request.method == "POST" and request.path == WEBHOOK_PATH:
+                token = request.headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+                if not hmac.compare_digest(token, WEBHOOK_SECRET.encode("utf-8")):
+                    logger.warning("Webhook request with a wrong secret token")
+                    status = "403 Forbidden"
+                else:
+                    try:
+                        update = Update.de_json(json.loads(request.body), app.bot)
+                    except (ValueError, TypeError, KeyError, AttributeError) as e:
+                        logger.warning("Webhook request with a malformed update: %s", e)
+                        status = "400 Bad Request"
+                    else:
+                        await app.update_queue.put(update)
+                        status = "200 OK"
+            elif request.method == "GET" and request.path == "/healthz":
+                status = "200 OK"
+            else:
+                status = "404 Not Found"
+            _write_http_response(writer, status, b"", "text/plain", request.keep_alive)
+            await writer.drain()
+            if not request.keep_alive:
+                break
+    except HttpError as e:
+        _write_http_response(writer, e.status, b"", "text/plain")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _run_webhook(app: Application) -> None:
+    """
+    Жизненный цикл приложения в режиме вебхука — то же, что делает
+    run_polling, но обновления приходят во встроенный HTTP-сервер.
+    Останавливается по SIGINT/SIGTERM. Вебхук при остановке не снимается:
+    другие реплики продолжают принимать обновления.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    await app.initialize()
+    server = None
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        server = await asyncio.start_server(partial(_serve_webhook, app), WEBHOOK_LISTEN, WEBHOOK_PORT)
+        if WEBHOOK_SET_ON_START:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                secret_token=WEBHOOK_SECRET,
+            )
+        await app.start()
+        logger.info("Webhook on %s:%s%s for %s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL)
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+async def _shutdown_pools(app: Application) -> None:
+    warm_up_task = app.bot_data.pop("warm_up_task", None)
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    PARSE_POOL.shutdown()
+    RECALC_POOL.shutdown()
+    USER_STATE.close()
+
+
 def main() -> None:
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_MAX_PENDING, UPDATE_LANES, UPDATE_SUPERSEDE))
+        .post_init(_post_init)
+        .post_shutdown(_shutdown_pools)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("sweep", sweep_command))
+    app.add_handler(CommandHandler("stats", stats_command))
     # Команда /debug убрана, чтобы не включать отладку в продакшене
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
-    logger.info("Bot started")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        logger.info("Bot started in webhook mode")
+        asyncio.run(_run_webhook(app))
+    else:
+        logger.info("Bot started")
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+MODULE_IMPORT_S = time.perf_counter() - _STARTED_AT
 
 
 if __name__ == "__main__":
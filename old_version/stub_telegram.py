@@ -0,0 +1,221 @@
+"""
+Заглушка Bot API для локальной проверки бота — без Telegram и без сети.
+
+Отвечает на вызовы бота (getMe, setWebhook, getUpdates, sendMessage,
+sendDocument, getFile и т. п.), отдаёт загружаемые файлы и печатает каждый
+вызов. Заданные сообщения пользователей уходят боту одним из двух способов:
+POST на вебхук (--webhook) или через getUpdates, если бот работает в режиме
+long polling.
+
+    python stub_telegram.py --port 8081 --text /start --document "../specifications_examples/2.13 Шкаф 3000х600х2800.xls" --text 3600
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:stub \\
+    WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET=s python main.py
+
+С --webhook http://127.0.0.1:8443/telegram --secret s обновления отправляются
+на вебхук сразу после setWebhook. Несколько --user дают одинаковые сообщения
+от разных пользователей — так видно, что обработка идёт параллельно, а ответы
+каждому пользователю приходят по порядку. Заглушка завершается, когда бот
+молчит --idle секунд после последнего обновления.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+
+
+class StubTelegram:
+    def __init__(self, messages: List[Tuple[str, str]], users: List[int], webhook: Optional[str], secret: str) -> None:
+        self.messages = messages
+        self.users = users
+        self.webhook = webhook
+        self.secret = secret
+        self.files: Dict[str, Path] = {}
+        self.updates: List[Dict[str, Any]] = []
+        self.calls: List[Tuple[float, str, Dict[str, Any]]] = []
+        self.started = time.perf_counter()
+        self.last_activity = time.perf_counter()
+        self.delivered = False
+        self._message_id = 0
+
+    def _next_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def _message(self, chat_id: int, **extra: Any) -> Dict[str, Any]:
+        return {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def build_updates(self) -> None:
+        for user_id in self.users:
+            user = {"id": user_id, "is_bot": False, "first_name": "Stub", "username": f"stub_{user_id}"}
+            for kind, value in self.messages:
+                if kind == "document":
+                    path = Path(value)
+                    file_id = f"file{len(self.files) + 1}"
+                    self.files[file_id] = path
+                    extra = {
+                        "document": {
+                            "file_id": file_id,
+                            "file_unique_id": f"u{file_id}",
+                            "file_name": path.name,
+                            "file_size": path.stat().st_size,
+                        }
+                    }
+                else:
+                    extra = {"text": value}
+                    if value.startswith("/"):
+                        extra["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value.split()[0])}]
+                message = self._message(user_id, **extra)
+                message["from"] = user
+                self.updates.append({"update_id": len(self.updates) + 1, "message": message})
+
+    def api(self, method: str, params: Dict[str, Any]) -> Any:
+        """Результат метода Bot API; всё, что не нужно боту, отвечает True."""
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            pending = [u for u in self.updates if u["update_id"] >= offset]
+            if pending:
+                self.delivered = True
+            return pending
+        if method == "getFile":
+            path = self.files[params["file_id"]]
+            return {
+                "file_id": params["file_id"],
+                "file_unique_id": f"u{params['file_id']}",
+                "file_size": path.stat().st_size,
+                "file_path": f"documents/{params['file_id']}",
+            }
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendDocument":
+            return self._message(chat_id, caption=params.get("caption", ""))
+        return True
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers: Dict[str, str] = {}
+                while (line := (await reader.readline()).decode("latin-1").strip()):
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+                path = request_line.decode("latin-1").split()[1]
+
+                content_type = "application/json"
+                if path.startswith("/file/bot"):
+                    file_id = path.rsplit("/", 1)[-1]
+                    payload = self.files[file_id].read_bytes()
+                    content_type = "application/octet-stream"
+                else:
+                    method = path.rsplit("/", 1)[-1]
+                    params = _parse_params(headers.get("content-type", ""), body)
+                    result = self.api(method, params)
+                    if method not in ("getUpdates", "getMe"):
+                        self.last_activity = time.perf_counter()
+                        self.calls.append((self.last_activity - self.started, method, params))
+                        print(f"{self.last_activity - self.started:7.2f}s {method} {_describe(params)}", flush=True)
+                    if method == "setWebhook" and self.webhook:
+                        asyncio.get_running_loop().create_task(self.post_updates())
+                    payload = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+
+                writer.write(
+                    f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # CancelledError — заглушка завершается, а бот держит соединение открытым
+            pass
+        finally:
+            writer.close()
+
+    async def post_updates(self) -> None:
+        await asyncio.sleep(0.5)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        async with httpx.AsyncClient() as client:
+            for update in self.updates:
+                response = await client.post(self.webhook, json=update, headers=headers)
+                print(f"        → вебхук update_id={update['update_id']}: HTTP {response.status_code}", flush=True)
+        self.delivered = True
+        self.last_activity = time.perf_counter()
+
+
+def _parse_params(content_type: str, body: bytes) -> Dict[str, Any]:
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+    if content_type.startswith("multipart/form-data"):
+        # Текстовые поля multipart нужны только для печати: chat_id и подпись
+        params: Dict[str, Any] = {}
+        boundary = content_type.split("boundary=", 1)[-1].strip('"').encode("latin-1")
+        for part in body.split(b"--" + boundary):
+            head, _, value = part.partition(b"\r\n\r\n")
+            if b"filename=" in head or b'name="' not in head:
+                continue
+            name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode("utf-8")
+            params[name] = value.rstrip(b"\r\n").decode("utf-8", "replace")
+        return params
+    return {}
+
+
+def _describe(params: Dict[str, Any]) -> str:
+    text = params.get("text") or params.get("caption") or params.get("url") or ""
+    return f"chat_id={params.get('chat_id', '-')} {text[:80]!r}".replace("\\n", " ")
+
+
+async def _run(args: argparse.Namespace) -> int:
+    messages = [(kind, value) for kind, value in args.messages]
+    stub = StubTelegram(messages, args.user or [100], args.webhook, args.secret)
+    stub.build_updates()
+    server = await asyncio.start_server(stub.serve, args.host, args.port)
+    print(f"Заглушка Bot API на http://{args.host}:{args.port}, обновлений: {len(stub.updates)}", flush=True)
+    async with server:
+        while not stub.delivered or time.perf_counter() - stub.last_activity < args.idle:
+            if time.perf_counter() - stub.started > args.timeout:
+                print("Бот не забрал обновления за отведённое время", file=sys.stderr)
+                return 1
+            await asyncio.sleep(0.2)
+
+    replies = [c for c in stub.calls if c[1] in ("sendMessage", "sendDocument")]
+    print(f"Ответов бота: {len(replies)}")
+    return 0
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Заглушка Bot API для локальной проверки бота")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--text", dest="messages", action="append", type=lambda v: ("text", v), default=[],
+                        help="текстовое сообщение пользователя; можно несколько, порядок сохраняется")
+    parser.add_argument("--document", dest="messages", action="append", type=lambda v: ("document", v),
+                        help="файл, который пользователь присылает боту")
+    parser.add_argument("--user", type=int, action="append", help="user_id отправителя; можно несколько")
+    parser.add_argument("--webhook", help="адрес вебхука бота; без него обновления отдаются через getUpdates")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--idle", type=float, default=3.0, help="сколько секунд тишины считать концом ответов")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    return asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,41 @@
+"""
+Общая настройка тестов: main.py при импорте читает окружение и открывает
+файлы сессий, лога и кэша спецификаций — всё это уводится во временный каталог.
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+_TMP = Path(tempfile.mkdtemp(prefix="wardrobe-tests-"))
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOG_FORMAT", "text")
+os.environ.setdefault("LOG_FILE", str(_TMP / "bot.log"))
+os.environ.setdefault("SESSION_DB", str(_TMP / "sessions.sqlite3"))
+os.environ.setdefault("SPEC_CACHE_DIR", str(_TMP / "spec_cache"))
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+EXAMPLES_DIR = Path(__file__).resolve().parent.parent.parent / "specifications_examples"
+
+_update_ids = iter(range(1, 1_000_000))
+
+
+def make_update(user_id: int, text: str = None, document: str = None):
+    """Update с сообщением пользователя: текстом или документом с именем файла document."""
+    from telegram import Update
+
+    update_id = next(_update_ids)
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+    }
+    if document is not None:
+        message["document"] = {"file_id": document, "file_unique_id": document, "file_name": document}
+    else:
+        message["text"] = text
+    return Update.de_json({"update_id": update_id, "message": message}, None)
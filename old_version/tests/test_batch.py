@@ -0,0 +1,44 @@
+"""Пакетная обработка: ошибки файлов и лимиты песочницы."""
+
+import pytest
+
+import main
+from main import SandboxExecutor, WorkerLimitError
+
+
+def test_bad_file_becomes_error_row():
+    rows = main._batch_item("битый.xls", b"not an excel file", None)
+    assert len(rows) == 1
+    assert rows[0]["status"] == "error"
+    assert rows[0]["file"] == "битый.xls"
+
+
+@pytest.mark.parametrize("error", [MemoryError(), WorkerLimitError("cpu")], ids=["memory", "cpu"])
+def test_limits_are_not_swallowed(monkeypatch, error):
+    def build_spec(source, name):
+        raise error
+
+    monkeypatch.setattr(main, "_build_spec", build_spec)
+    with pytest.raises(type(error)):
+        main._batch_item("большой.xls", b"", None)
+
+
+def _exhaust_memory(name):
+    return main._batch_item(name, b"", None)
+
+
+def _raise_memory_error(source, name):
+    raise MemoryError()
+
+
+def test_sandbox_recycles_worker_after_memory_error(monkeypatch):
+    # Песочница форкается после подмены, так что процесс видит её же
+    monkeypatch.setattr(main, "_build_spec", _raise_memory_error)
+    executor = SandboxExecutor("test", 1, 30, 0, 0, 100, 0)
+    try:
+        with pytest.raises(WorkerLimitError) as exc:
+            executor.submit(_exhaust_memory, "большой.xls").result(30)
+        assert exc.value.reason == "memory"
+    finally:
+        executor.shutdown()
+    assert executor.recycled == 1
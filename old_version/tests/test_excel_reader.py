@@ -0,0 +1,131 @@
+"""
+Прямое чтение листов (EXCEL_READER=direct) должно давать те же ячейки, что
+pd.read_excel(header=None) — прежний путь, который остаётся за EXCEL_READER=pandas.
+"""
+
+import datetime
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pytest
+
+import main
+from conftest import EXAMPLES_DIR
+
+EXAMPLES = sorted(EXAMPLES_DIR.glob("*.xls*"))
+
+# Колонки-ловушки для приведения типов: запятая как десятичный разделитель,
+# разделители тысяч, бесконечности, смешанные типы, логические значения
+EDGE_COLUMNS = {
+    "comma": ["1,5", "2,25"],
+    "inf": ["inf", "-inf"],
+    "infinity": ["Infinity", "3"],
+    "thousands_space": ["1 000", "2 500"],
+    "thousands_comma": ["1,000", "2,000"],
+    "mixed": [1, "x"],
+    "mixed_numstr": ["7", 8],
+    "bools": [True, False],
+    "bool_strings": ["True", "false"],
+    "bool_and_int": [True, 2],
+    "ints": [1, 2],
+    "int_float": [1, 2.5],
+    "integral_float": [3.0, 4],
+    "na_string": ["NA", 3],
+    "null_string": ["null", "x"],
+    "numeric_strings": ["1.5", "2"],
+    "scientific": ["1e3", "2E-1"],
+    "padded": [" 1 ", "2"],
+    "signed": ["-3", "+4"],
+    "gap": [1, None],
+    "huge_int": [2 ** 70, 1],
+    "dates": [datetime.datetime(2024, 1, 2), datetime.datetime(2024, 3, 4, 12, 30)],
+}
+
+
+def _open(path: Path):
+    ext = os.path.splitext(path.name.lower())[1]
+    return main._open_workbook(str(path), ext), ext
+
+
+def _close(book, ext: str) -> None:
+    if ext == ".xls":
+        book.release_resources()
+    else:
+        book.close()
+
+
+def _sheet_names(path: Path):
+    book, ext = _open(path)
+    try:
+        return book.sheet_names() if ext == ".xls" else book.sheetnames
+    finally:
+        _close(book, ext)
+
+
+def _load(path: Path, sheet_name: str, reader: str, monkeypatch) -> main.Sheet:
+    monkeypatch.setattr(main, "EXCEL_READER", reader)
+    book, ext = _open(path)
+    try:
+        return main._load_sheet(book, ext, sheet_name)
+    finally:
+        _close(book, ext)
+
+
+def _same_cell(direct, expected) -> bool:
+    if isinstance(direct, float) and isinstance(expected, float) and math.isnan(direct) and math.isnan(expected):
+        return True
+    # pandas отдаёт даты как Timestamp — подкласс datetime с тем же значением
+    if isinstance(direct, datetime.datetime):
+        return isinstance(expected, datetime.datetime) and direct == expected
+    return type(direct) is type(expected) and direct == expected
+
+
+def _assert_same_sheet(direct: main.Sheet, expected: main.Sheet) -> None:
+    assert direct.shape == expected.shape
+    mismatches = [
+        (r, c, direct.values[r, c], expected.values[r, c])
+        for (r, c), value in np.ndenumerate(direct.values)
+        if not _same_cell(value, expected.values[r, c])
+    ]
+    assert not mismatches, mismatches[:10]
+
+
+@pytest.mark.parametrize("path", EXAMPLES, ids=lambda p: p.name)
+def test_examples_match_pandas(path, monkeypatch):
+    for name in _sheet_names(path):
+        direct = _load(path, name, "direct", monkeypatch)
+        expected = _load(path, name, "pandas", monkeypatch)
+        _assert_same_sheet(direct, expected)
+
+
+@pytest.mark.parametrize("with_header", [False, True], ids=["values", "header"])
+def test_edge_cells_match_pandas(tmp_path, monkeypatch, with_header):
+    book = openpyxl.Workbook()
+    ws = book.active
+    ws.title = "Детали"
+    first = 2 if with_header else 1
+    for c, (title, values) in enumerate(EDGE_COLUMNS.items(), 1):
+        if with_header:
+            ws.cell(1, c, title)
+        for r, value in enumerate(values, first):
+            ws.cell(r, c, value)
+    path = tmp_path / "edge.xlsx"
+    book.save(path)
+
+    direct = _load(path, "Детали", "direct", monkeypatch)
+    expected = _load(path, "Детали", "pandas", monkeypatch)
+    _assert_same_sheet(direct, expected)
+
+
+def test_pandas_reader_parses_examples(monkeypatch):
+    """Запасной путь через pandas должен давать ту же спецификацию."""
+    path = EXAMPLES[0]
+    data = path.read_bytes()
+    monkeypatch.setattr(main, "EXCEL_READER", "direct")
+    direct = main._build_spec(data, path.name)
+    monkeypatch.setattr(main, "EXCEL_READER", "pandas")
+    fallback = main._build_spec(data, path.name)
+    assert main._pack_spec(direct) == main._pack_spec(fallback)
@@ -0,0 +1,46 @@
+"""Определение габаритов по ролям деталей (GeometrySignals)."""
+
+import main
+from main import GeometrySignals, ParsedRow, PartRole
+
+
+def _choose(rows):
+    signals = GeometrySignals()
+    for row in rows:
+        signals.add(row)
+    return signals.choose(None)
+
+
+def test_back_wall_with_top_gives_depth():
+    guess = _choose([
+        ParsedRow("Стенка задняя", 4, 2700, 580, 3),
+        ParsedRow("Крышка", 16, 1740, 560, 1),
+        ParsedRow("Полка", 16, 560, 540, 9),
+    ])
+    assert guess.strategy == "back_wall"
+    assert guess.as_tuple() == (1740, 560, 2700, 3, 580)
+    assert guess.confidence == main.GEOMETRY_CONFIDENCE_BACK_WALL
+
+
+def test_back_wall_without_top_uses_default_depth():
+    guess = _choose([ParsedRow("Стенка задняя", 4, 2700, 580, 2)])
+    assert guess.as_tuple() == (1160, 600, 2700, 2, 580)
+    assert guess.confidence == main.GEOMETRY_CONFIDENCE_BACK_WALL_NO_DEPTH
+
+
+def test_roles_come_from_row_not_name():
+    # Роль, сохранённая в строке (например, из кэша), важнее подстрок названия
+    guess = _choose([
+        ParsedRow("Панель", 4, 2600, 500, 2, role=PartRole.BACK | PartRole.WALL),
+        ParsedRow("Задник декоративный", 16, 2600, 450, 1, role=PartRole.VISIBLE),
+        ParsedRow("Щит", 16, 1000, 480, 2, role=PartRole.TOP_BOTTOM | PartRole.SHELF),
+    ])
+    assert guess.strategy == "back_wall"
+    assert guess.as_tuple() == (1000, 480, 2600, 2, 500)
+
+
+def test_histogram_confidence_is_bounded_by_back_wall():
+    rows = [ParsedRow("Боковина", 16, 2800, 600, 2), ParsedRow("Полка", 16, 1000, 600, 4)]
+    guess = _choose(rows)
+    assert guess.strategy == "histogram"
+    assert guess.confidence < main.GEOMETRY_CONFIDENCE_BACK_WALL
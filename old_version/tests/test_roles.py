@@ -0,0 +1,34 @@
+"""Роли деталей и фурнитуры по названию."""
+
+import pytest
+
+import main
+from main import FurnitureItem, FurnitureRole, FurnitureTable, ParsedSpec
+
+
+def _spec_with_furniture(names):
+    return ParsedSpec(
+        source_filename="test.xls",
+        width_total_mm=2000,
+        depth_mm=600,
+        height_mm=2800,
+        sections_count=2,
+        section_width_mm=1000,
+        furniture_items=FurnitureTable.from_rows(FurnitureItem(name, qty=1) for name in names),
+    )
+
+
+@pytest.mark.parametrize("name", ["Лента LED 4,8 Вт", "Подсветка мебельная", "Освещение шкафа", "Светильник с подсветом"])
+def test_lighting_keywords(name):
+    assert main.FURNITURE_ROLE_MATCHER.classify(name) & FurnitureRole.LIGHT
+
+
+def test_led_only_spec_has_lighting():
+    spec = _spec_with_furniture(["Лента LED 4,8 Вт", "Петля накладная", "Ручка-скоба 128"])
+    sections = main._analyze_section_types(spec, [])
+    assert sections and all(s.has_lighting for s in sections)
+
+
+def test_spec_without_lights_has_no_lighting():
+    spec = _spec_with_furniture(["Петля накладная", "Ручка-скоба 128"])
+    assert not any(s.has_lighting for s in main._analyze_section_types(spec, []))
@@ -0,0 +1,66 @@
+"""Сессии пользователей: запись не блокирует цикл событий и не обгоняет следующую."""
+
+import asyncio
+import threading
+
+import main
+from main import ParsedSpec, SessionStore
+
+
+def _spec(name: str) -> ParsedSpec:
+    return ParsedSpec(name, 2000, 600, 2800, 2, 1000)
+
+
+class _SlowStore(SessionStore):
+    """Запись ждёт разрешения — как при занятой базе."""
+
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self.allow = threading.Event()
+        self.writing = threading.Event()
+
+    def set(self, user_id, spec) -> None:
+        self.writing.set()
+        self.allow.wait(5)
+        super().set(user_id, spec)
+
+
+def test_slow_write_does_not_block_loop(tmp_path, monkeypatch):
+    store = _SlowStore(tmp_path / "sessions.sqlite3", 8, 3600)
+    monkeypatch.setattr(main, "USER_STATE", store)
+
+    async def scenario():
+        write = asyncio.create_task(main._save_user_spec(1, _spec("a.xls")))
+        await asyncio.to_thread(store.writing.wait, 5)
+        # Цикл событий свободен, пока запись ждёт базу
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0)
+            ticks += 1
+        store.allow.set()
+        await write
+        return ticks
+
+    assert asyncio.run(scenario()) == 10
+    assert store.get(1).source_filename == "a.xls"
+
+
+def test_cancelled_save_finishes_before_returning(tmp_path, monkeypatch):
+    store = _SlowStore(tmp_path / "sessions.sqlite3", 8, 3600)
+    monkeypatch.setattr(main, "USER_STATE", store)
+
+    async def scenario():
+        write = asyncio.create_task(main._save_user_spec(1, _spec("a.xls")))
+        await asyncio.to_thread(store.writing.wait, 5)
+        write.cancel()
+        await asyncio.sleep(0.05)
+        assert not write.done()
+        store.allow.set()
+        await asyncio.gather(write, return_exceptions=True)
+        # Следующее обновление пишет уже после отменённого
+        await main._save_user_spec(1, _spec("b.xls"))
+        return write
+
+    write = asyncio.run(scenario())
+    assert write.cancelled()
+    assert store.get(1).source_filename == "b.xls"
@@ -0,0 +1,112 @@
+"""SingleFlight: склейка одинаковых задач и отмена, когда ждущих не осталось."""
+
+import asyncio
+
+import pytest
+
+from main import SingleFlight
+
+
+class _Work:
+    """Управляемая работа: считает запуски и завершается по команде."""
+
+    def __init__(self) -> None:
+        self.started = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+        self.error = None
+
+    async def __call__(self):
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return "результат"
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_waiters_share_result():
+    async def scenario():
+        flights, work = SingleFlight(), _Work()
+        waiters = [asyncio.create_task(flights.run(("file", "a"), work)) for _ in range(3)]
+        await _settle()
+        work.release.set()
+        return flights, work, await asyncio.gather(*waiters)
+
+    flights, work, results = asyncio.run(scenario())
+    assert results == ["результат"] * 3
+    assert work.started == 1
+    assert flights.executed == {"file": 1} and flights.coalesced == {"file": 2}
+    assert flights.in_flight == 0
+
+
+def test_waiters_share_exception():
+    async def scenario():
+        flights, work = SingleFlight(), _Work()
+        work.error = ValueError("битый файл")
+        waiters = [asyncio.create_task(flights.run(("file", "a"), work)) for _ in range(2)]
+        await _settle()
+        work.release.set()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) and str(r) == "битый файл" for r in results)
+
+
+@pytest.mark.parametrize("fail", [False, True], ids=["result", "exception"])
+def test_cancelled_waiter_does_not_abort_others(fail):
+    async def scenario():
+        flights, work = SingleFlight(), _Work()
+        if fail:
+            work.error = ValueError("битый файл")
+        first = asyncio.create_task(flights.run(("file", "a"), work))
+        second = asyncio.create_task(flights.run(("file", "a"), work))
+        await _settle()
+        first.cancel()
+        await _settle()
+        work.release.set()
+        result = await asyncio.gather(second, return_exceptions=True)
+        return flights, work, first, result[0]
+
+    flights, work, first, result = asyncio.run(scenario())
+    assert first.cancelled()
+    assert not work.cancelled
+    if fail:
+        assert isinstance(result, ValueError)
+    else:
+        assert result == "результат"
+    assert flights.abandoned == {}
+
+
+def test_last_waiter_cancelling_aborts_work():
+    async def scenario():
+        flights, work, fresh = SingleFlight(), _Work(), _Work()
+        waiters = [asyncio.create_task(flights.run(("file", "a"), work)) for _ in range(2)]
+        await _settle()
+        waiters[0].cancel()
+        await _settle()
+        assert not work.cancelled and flights.in_flight == 1
+        waiters[1].cancel()
+        await _settle()
+        # Новый запрос с тем же ключом не присоединяется к брошенной работе
+        late = asyncio.create_task(flights.run(("file", "a"), fresh))
+        await _settle()
+        fresh.release.set()
+        return flights, work, fresh, waiters, await late
+
+    flights, work, fresh, waiters, late = asyncio.run(scenario())
+    assert all(w.cancelled() for w in waiters)
+    assert work.cancelled
+    assert flights.abandoned == {"file": 1}
+    assert fresh.started == 1 and late == "результат"
+    assert flights.executed == {"file": 2}
+    assert flights.in_flight == 0
+
@@ -0,0 +1,64 @@
+"""SpecCache: псевдонимы file_unique_id не переживают свои записи ни в памяти, ни на диске."""
+
+import os
+
+from main import ParsedSpec, SpecCache
+
+
+def _spec(name: str) -> ParsedSpec:
+    return ParsedSpec(name, 2000, 600, 2800, 2, 1000)
+
+
+def _age(path, seconds_ago: float) -> None:
+    stamp = os.stat(path).st_mtime - seconds_ago
+    os.utime(path, (stamp, stamp))
+
+
+def test_evicted_spec_drops_its_aliases():
+    cache = SpecCache(2, None, 0)
+    for n in range(3):
+        cache.put(f"digest{n}", _spec(f"{n}.xls"), f"file{n}")
+    cache.get(file_unique_id="file1-copy", digest="digest1")
+
+    assert cache.get(file_unique_id="file0") is None
+    assert cache.get(file_unique_id="file1").source_filename == "1.xls"
+    assert cache.get(file_unique_id="file1-copy").source_filename == "1.xls"
+    assert sorted(cache._aliases) == ["file1", "file1-copy", "file2"]
+    assert set(cache._aliases_by_digest) == {"digest1", "digest2"}
+
+
+def test_alias_moved_to_another_spec():
+    cache = SpecCache(2, None, 0)
+    cache.put("old", _spec("old.xls"), "file")
+    cache.put("new", _spec("new.xls"), "file")
+    cache.put("third", _spec("third.xls"))
+    # Вытеснение "old" не трогает псевдоним, который уже указывает на "new"
+    assert cache.get(file_unique_id="file").source_filename == "new.xls"
+
+
+def test_disk_prune_removes_aliases_of_pruned_specs(tmp_path):
+    cache = SpecCache(8, tmp_path, 2)
+    for n in range(3):
+        cache.write_disk(f"digest{n}", _spec(f"{n}.xls"), f"file{n}")
+        for path in tmp_path.glob("*.json"):
+            _age(path, 10)
+
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["digest1", "digest2"]
+    assert sorted(p.name for p in (tmp_path / "by_file_id").iterdir()) == ["file1", "file2"]
+    # Новый процесс находит оставшиеся записи по псевдонимам
+    fresh = SpecCache(8, tmp_path, 2)
+    assert fresh.get(file_unique_id="file0") is None
+    assert fresh.get(file_unique_id="file2").source_filename == "2.xls"
+
+
+def test_disk_aliases_are_bounded(tmp_path):
+    cache = SpecCache(8, tmp_path, 1)
+    for n in range(SpecCache.ALIASES_PER_SPEC + 3):
+        cache.write_disk("digest", _spec("a.xls"), f"file{n}")
+        for path in (tmp_path / "by_file_id").iterdir():
+            _age(path, 10)
+
+    names = sorted(p.name for p in (tmp_path / "by_file_id").iterdir())
+    assert len(names) == SpecCache.ALIASES_PER_SPEC
+    # Остались самые свежие
+    assert "file0" not in names and f"file{SpecCache.ALIASES_PER_SPEC + 2}" in names
@@ -0,0 +1,115 @@
+"""Полосы обработки обновлений: распределение и пределы одновременных обработчиков."""
+
+import asyncio
+
+import pytest
+from telegram import Update
+
+from conftest import make_update
+from main import PerUserUpdateProcessor, UpdateLane, UpdateLanes
+
+
+@pytest.mark.parametrize(
+    "update, lane",
+    [
+        (make_update(1, document="шкаф.xls"), "heavy"),
+        (make_update(1, document="пакет.zip"), "heavy"),
+        (make_update(1, text="3600"), "recalc"),
+        (make_update(1, text="ширина 3 600"), "recalc"),
+        (make_update(1, text="/sweep 2000 3000 100"), "heavy"),
+        (make_update(1, text="/SWEEP@wardrobe_bot 2000 3000"), "heavy"),
+        (make_update(1, text="/start"), "command"),
+        (make_update(1, text="/stats"), "command"),
+        (Update(update_id=1), "command"),
+    ],
+    ids=["spec", "zip", "width", "width-text", "sweep", "sweep-mention", "start", "stats", "no-message"],
+)
+def test_lane_for_update(update, lane):
+    assert UpdateLanes(1, 1, 1).for_update(update).name == lane
+
+
+def test_lane_limits_concurrency():
+    async def scenario():
+        lane = UpdateLane("heavy", 2)
+        running = peak = 0
+
+        async def job():
+            nonlocal running, peak
+            await lane.acquire()
+            try:
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+            finally:
+                lane.release()
+
+        await asyncio.gather(*(job() for _ in range(6)))
+        return lane, peak
+
+    lane, peak = asyncio.run(scenario())
+    assert peak == 2
+    assert lane.processed == 6 and lane.running == 0 and lane.waiting == 0
+
+
+def test_processor_applies_lane_limits():
+    async def scenario():
+        lanes = UpdateLanes(8, 8, 2)
+        proc = PerUserUpdateProcessor(100, lanes)
+        release = asyncio.Event()
+
+        async def handler():
+            await release.wait()
+
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(100 + i, document="шкаф.xls"), handler()))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0.01)
+        stats = lanes.stats()["heavy"]
+        release.set()
+        await asyncio.gather(*tasks)
+        return stats, lanes.stats()["heavy"]
+
+    during, after = asyncio.run(scenario())
+    assert during == {"waiting": 3, "running": 2, "limit": 2, "processed": 0}
+    assert after == {"waiting": 0, "running": 0, "limit": 2, "processed": 5}
+
+
+def test_heavy_uploads_do_not_starve_commands_and_recalcs():
+    """Пока все слоты тяжёлой полосы заняты файлами, /start и ширина других пользователей проходят сразу."""
+    async def scenario():
+        lanes = UpdateLanes(2, 2, 1)
+        proc = PerUserUpdateProcessor(100, lanes)
+        release = asyncio.Event()
+        done = []
+
+        async def upload(i):
+            await release.wait()
+            done.append(f"file{i}")
+
+        async def quick(name):
+            done.append(name)
+
+        uploads = [
+            asyncio.create_task(proc.process_update(make_update(100 + i, document="шкаф.xls"), upload(i)))
+            for i in range(10)
+        ]
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(
+            asyncio.gather(
+                proc.process_update(make_update(1, text="/start"), quick("start")),
+                proc.process_update(make_update(2, text="3600"), quick("width")),
+            ),
+            timeout=1,
+        )
+        quick_done = list(done)
+        heavy = lanes.stats()["heavy"]
+        release.set()
+        await asyncio.gather(*uploads)
+        return quick_done, heavy, done
+
+    quick_done, heavy, done = asyncio.run(scenario())
+    assert quick_done == ["start", "width"]
+    assert heavy["running"] == 1 and heavy["waiting"] == 9
+    assert len(done) == 12
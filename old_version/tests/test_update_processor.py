@@ -0,0 +1,226 @@
+"""
+PerUserUpdateProcessor: порядок обновлений одного пользователя и отмена
+устаревших — новый файл отменяет прежние файлы и ширины, ширина — только
+прежние ширины.
+"""
+
+import asyncio
+
+import main
+from conftest import make_update
+from main import ParsedSpec, PerUserUpdateProcessor, SessionStore, SingleFlight, UpdateLanes
+
+
+def _processor() -> PerUserUpdateProcessor:
+    return PerUserUpdateProcessor(100, UpdateLanes(8, 8, 8))
+
+
+def _spec(name: str) -> ParsedSpec:
+    return ParsedSpec(name, 2000, 600, 2800, 2, 1000)
+
+
+async def _handler(log, name, release: asyncio.Event = None):
+    log.append(("start", name))
+    if release is not None:
+        await release.wait()
+    log.append(("done", name))
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_update_weights():
+    assert main._update_weight(make_update(1, document="шкаф.xls")) == 2
+    assert main._update_weight(make_update(1, document="шкаф.XLSX")) == 2
+    assert main._update_weight(make_update(1, text="3600")) == 1
+    assert main._update_weight(make_update(1, text="/start")) == 0
+    # Архив не отменяет и не отменяется: это отдельная пакетная задача
+    assert main._update_weight(make_update(1, document="пакет.zip")) == 0
+
+
+def test_file_supersedes_running_width():
+    async def scenario():
+        proc, log = _processor(), []
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, text="3000"), _handler(log, "width", asyncio.Event()))),
+        ]
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, document="b.xls"), _handler(log, "file"))))
+        await asyncio.gather(*tasks)
+        return proc, log
+
+    proc, log = asyncio.run(scenario())
+    # Пересчёт прерван на середине
+    assert log == [("start", "width"), ("start", "file"), ("done", "file")]
+    assert proc.superseded == 1
+
+
+def test_file_supersedes_older_file_and_queued_width():
+    async def scenario():
+        proc, log = _processor(), []
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, document="a.xls"), _handler(log, "a", asyncio.Event()))),
+        ]
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, text="3600"), _handler(log, "width"))))
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, document="b.xls"), _handler(log, "b"))))
+        await asyncio.gather(*tasks)
+        return proc, log
+
+    proc, log = asyncio.run(scenario())
+    # Ширина ждала файла a и так и не началась
+    assert log == [("start", "a"), ("start", "b"), ("done", "b")]
+    assert proc.superseded == 2
+
+
+def test_width_does_not_cancel_file():
+    async def scenario():
+        proc, log, release = _processor(), [], asyncio.Event()
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, document="a.xls"), _handler(log, "file", release))),
+        ]
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, text="3600"), _handler(log, "width"))))
+        await _settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        return proc, log
+
+    proc, log = asyncio.run(scenario())
+    assert log == [("start", "file"), ("done", "file"), ("start", "width"), ("done", "width")]
+    assert proc.superseded == 0
+
+
+def test_newer_width_supersedes_older_width_only_for_same_user():
+    async def scenario():
+        proc, log, release = _processor(), [], asyncio.Event()
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, text="3000"), _handler(log, "u1", release))),
+            asyncio.create_task(proc.process_update(make_update(2, text="3000"), _handler(log, "u2", release))),
+        ]
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, text="3200"), _handler(log, "u1-new"))))
+        await _settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        return log
+
+    log = asyncio.run(scenario())
+    assert ("done", "u1") not in log
+    assert ("done", "u2") in log and ("done", "u1-new") in log
+
+
+def _race_scenario(tmp_path, cancel_first: bool):
+    """
+    Файл a.xls разбирается, и в тот же шаг цикла приходит b.xls. Что бы ни
+    случилось раньше — отмена a или его USER_STATE.set, — в сессии должен
+    остаться b, а ширина после b считается уже по нему.
+    """
+    store = SessionStore(tmp_path / "sessions.sqlite3", 8, 3600)
+    sent = []
+
+    async def upload(name, parsed: asyncio.Future, reply: asyncio.Event):
+        spec = await parsed
+        store.set(1, spec)
+        await reply.wait()
+        sent.append(name)
+
+    async def width():
+        sent.append(("width", store.get(1).source_filename))
+
+    async def scenario():
+        proc = _processor()
+        loop = asyncio.get_running_loop()
+        parsed_a, parsed_b = loop.create_future(), loop.create_future()
+        reply = asyncio.Event()
+        parsed_b.set_result(_spec("b.xls"))
+        reply.set()
+        reply_a = asyncio.Event()
+
+        task_a = asyncio.create_task(proc.process_update(make_update(1, document="a.xls"), upload("a", parsed_a, reply_a)))
+        await _settle()
+        if cancel_first:
+            task_b = asyncio.create_task(proc.process_update(make_update(1, document="b.xls"), upload("b", parsed_b, reply)))
+            parsed_a.set_result(_spec("a.xls"))
+        else:
+            parsed_a.set_result(_spec("a.xls"))
+            task_b = asyncio.create_task(proc.process_update(make_update(1, document="b.xls"), upload("b", parsed_b, reply)))
+        await asyncio.gather(task_a, task_b)
+        await proc.process_update(make_update(1, text="3600"), width())
+        return proc
+
+    proc = asyncio.run(scenario())
+    assert store.get(1).source_filename == "b.xls"
+    assert sent == ["b", ("width", "b.xls")]
+    assert proc.superseded == 1
+
+
+def test_cancel_before_user_state_set(tmp_path):
+    _race_scenario(tmp_path, cancel_first=True)
+
+
+def test_cancel_after_user_state_set(tmp_path):
+    _race_scenario(tmp_path, cancel_first=False)
+
+
+def test_cancelled_waiter_keeps_coalesced_flight_for_others():
+    """
+    Два пользователя загрузили один и тот же файл, разбор склеен. Первый
+    присылает другой файл — его ожидание отменяется, но разбор продолжается
+    для второго и не считается брошенным.
+    """
+    flights = SingleFlight()
+    parse_started = 0
+    results = {}
+
+    async def parse(release: asyncio.Event):
+        nonlocal parse_started
+        parse_started += 1
+        await release.wait()
+        return "разобран"
+
+    async def upload(user_id, release):
+        results[user_id] = await flights.run(("file", "same"), lambda: parse(release))
+
+    async def other_file():
+        results["new"] = "другой файл"
+
+    async def scenario():
+        proc, release = _processor(), asyncio.Event()
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, document="same.xls"), upload(1, release))),
+            asyncio.create_task(proc.process_update(make_update(2, document="same.xls"), upload(2, release))),
+        ]
+        await _settle()
+        tasks.append(asyncio.create_task(proc.process_update(make_update(1, document="other.xls"), other_file())))
+        await _settle()
+        assert flights.in_flight == 1
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert results == {2: "разобран", "new": "другой файл"}
+    assert parse_started == 1
+    assert flights.executed == {"file": 1} and flights.coalesced == {"file": 1}
+    assert flights.abandoned == {}
+    assert flights.in_flight == 0
+
+
+def test_superseded_before_start_closes_handler():
+    """Обработчик, отменённый до первого шага, закрывается, а не бросается недождавшимся."""
+    async def scenario():
+        proc, log = _processor(), []
+        first = _handler(log, "3000")
+        tasks = [
+            asyncio.create_task(proc.process_update(make_update(1, text="3000"), first)),
+            asyncio.create_task(proc.process_update(make_update(1, text="3200"), _handler(log, "3200"))),
+        ]
+        await asyncio.gather(*tasks)
+        return first, log
+
+    first, log = asyncio.run(scenario())
+    assert log == [("start", "3200"), ("done", "3200")]
+    assert first.cr_frame is None
@@ -0,0 +1,101 @@
+"""Склейка загрузок: временный файл живёт, пока его разбор кому-то нужен."""
+
+import asyncio
+from functools import partial
+from pathlib import Path
+
+import main
+from conftest import EXAMPLES_DIR
+from main import SingleFlight, SpecCache
+
+DATA = sorted(EXAMPLES_DIR.glob("*.xls"))[0].read_bytes()
+
+
+class _File:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    async def download_to_memory(self, out) -> None:
+        out.write(self.data)
+
+
+class _Document:
+    def __init__(self, file_unique_id: str, data: bytes) -> None:
+        self.file_unique_id = file_unique_id
+        self.file_name = f"{file_unique_id}.xls"
+        self.file_size = len(data)
+        self.data = data
+
+    async def get_file(self) -> _File:
+        return _File(self.data)
+
+
+class _QueuedPool:
+    """Пул разбора, в котором задача стоит в очереди, пока её не отпустят."""
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+        self.sources = []
+
+    async def run_measured(self, stage, func, *args):
+        self.sources.append(args[0])
+        await self.release.wait()
+        return func(*args)
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def _fetch(flights, doc):
+    return asyncio.create_task(flights.run(("file", doc.file_unique_id), partial(main._fetch_spec, doc)))
+
+
+def test_cancelled_first_uploader_keeps_spooled_file_for_others(monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_SPOOL_BYTES", 0)
+    monkeypatch.setattr(main, "SPEC_CACHE", SpecCache(8, None, 0))
+    flights = SingleFlight()
+    monkeypatch.setattr(main, "UPLOAD_FLIGHTS", flights)
+    pool = _QueuedPool()
+    monkeypatch.setattr(main, "PARSE_POOL", pool)
+
+    async def scenario():
+        first = _fetch(flights, _Document("A", DATA))
+        await _settle()
+        second = _fetch(flights, _Document("B", DATA))
+        await _settle()
+        # Разбор идёт по пути к временному файлу первого загрузившего
+        assert len(pool.sources) == 1 and isinstance(pool.sources[0], str)
+        first.cancel()
+        await _settle()
+        assert Path(pool.sources[0]).exists()
+        pool.release.set()
+        return await second
+
+    spec = asyncio.run(scenario())
+    assert spec.corpus_rows
+    assert flights.coalesced == {"sha256": 1}
+    # После разбора временный файл удалён
+    assert not Path(pool.sources[0]).exists()
+
+
+def test_spooled_file_is_removed_when_everyone_cancels(monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_SPOOL_BYTES", 0)
+    monkeypatch.setattr(main, "SPEC_CACHE", SpecCache(8, None, 0))
+    flights = SingleFlight()
+    monkeypatch.setattr(main, "UPLOAD_FLIGHTS", flights)
+    pool = _QueuedPool()
+    monkeypatch.setattr(main, "PARSE_POOL", pool)
+
+    async def scenario():
+        tasks = [_fetch(flights, _Document(name, DATA)) for name in ("A", "B")]
+        await _settle()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await _settle()
+
+    asyncio.run(scenario())
+    assert flights.abandoned == {"sha256": 1, "file": 2}
+    assert not Path(pool.sources[0]).exists()
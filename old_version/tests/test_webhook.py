@@ -0,0 +1,94 @@
+"""Вебхук: проверка секретного токена Telegram."""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+SECRET = "s3cret-token"
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Тест"},
+        "text": "/start",
+    },
+}
+
+
+async def _post(port: int, body: bytes, token=None) -> str:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = f"POST {main.WEBHOOK_PATH} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+    if token is not None:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {token}\r\n"
+    writer.write(headers.encode("latin-1") + b"\r\n" + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    await writer.wait_closed()
+    return status_line.decode("latin-1").split(" ", 1)[1].strip()
+
+
+def _serve(monkeypatch, token, body: bytes = None):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+
+    async def scenario():
+        app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        server = await asyncio.start_server(partial(main._serve_webhook, app), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status = await _post(port, body if body is not None else json.dumps(UPDATE).encode("utf-8"), token)
+        finally:
+            server.close()
+            await server.wait_closed()
+        return status, app.update_queue.qsize()
+
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong", SECRET + "x", "сек"], ids=["missing", "empty", "wrong", "longer", "non-ascii"])
+def test_wrong_secret_is_forbidden(monkeypatch, token):
+    if token == "сек":
+        token = token.encode("utf-8").decode("latin-1")
+    status, queued = _serve(monkeypatch, token)
+    assert status == "403 Forbidden"
+    assert queued == 0
+
+
+def test_right_secret_queues_update(monkeypatch):
+    status, queued = _serve(monkeypatch, SECRET)
+    assert status == "200 OK"
+    assert queued == 1
+
+
+def test_malformed_update_is_rejected(monkeypatch):
+    status, queued = _serve(monkeypatch, SECRET, b"{not json")
+    assert status == "400 Bad Request"
+    assert queued == 0
+
+
+
+def test_webhook_mode_requires_secret(tmp_path):
+    env = {
+        **os.environ,
+        "WEBHOOK_URL": "https://bot.example.com",
+        "WEBHOOK_SECRET": "",
+        "LOG_FILE": str(tmp_path / "bot.log"),
+        "SESSION_DB": str(tmp_path / "sessions.sqlite3"),
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", "import main"],
+        cwd=Path(main.__file__).parent, env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode != 0
+    assert "WEBHOOK_SECRET" in result.stderr
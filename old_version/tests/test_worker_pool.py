@@ -0,0 +1,70 @@
+"""WorkerPool: очередь, таймаут и отмена задач, ответ на которые больше не нужен."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from main import WorkerPool
+
+
+def _block(event: threading.Event, started: list, name: str) -> str:
+    started.append(name)
+    event.wait(5)
+    return name
+
+
+def _sleep(seconds: float) -> str:
+    time.sleep(seconds)
+    return "готово"
+
+
+def test_timed_out_queued_job_is_withdrawn():
+    pool = WorkerPool("test", "thread", 1, 10, 0.1)
+    release, started = threading.Event(), []
+
+    async def scenario():
+        running = asyncio.create_task(pool.run(_block, release, started, "running"))
+        await asyncio.sleep(0.02)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(_block, release, started, "queued")
+        with pytest.raises(asyncio.TimeoutError):
+            await running
+        release.set()
+        # Запущенную задачу в потоке не прервать — ждём, пока она освободит слот
+        for _ in range(100):
+            if pool.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        pool.shutdown()
+    assert started == ["running"]
+    assert pool.cancelled == 1
+    assert pool.pending == 0
+
+
+def test_timed_out_sandbox_job_is_aborted():
+    pool = WorkerPool("test", "sandbox", 1, 10, 0.5)
+    # Собственный срок песочницы отодвинут, чтобы задачу прервал именно таймаут run()
+    pool._get_executor().deadline_s = 30
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(_sleep, 30)
+        started = time.perf_counter()
+        # Процесс заменён, следующая задача не ждёт досчёта брошенной
+        result = await pool.run(_sleep, 0)
+        return result, time.perf_counter() - started
+
+    try:
+        result, elapsed = asyncio.run(scenario())
+    finally:
+        pool.shutdown()
+    assert result == "готово"
+    assert elapsed < 5
+    assert pool.cancelled == 1